@@ -0,0 +1,130 @@
+"""Benchmark nhận diện loại file (utils/file_types) trên một corpus mẫu.
+
+Chạy:
+    python -m benchmarks.bench_file_types                 # corpus tổng hợp sẵn
+    python -m benchmarks.bench_file_types path/to/dir     # mọi file trong thư mục
+    python -m benchmarks.bench_file_types --rounds 2000
+
+So sánh với chuỗi if/elif cũ trong prepare_qwen_request (chạy trên toàn bộ file,
+decode UTF-8 cả file ở nhánh cuối) để thấy chênh lệch.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.file_types import detect_file_type  # noqa: E402
+from utils.attachment_ingest import SNIFF_BYTES  # noqa: E402
+
+
+def _synthetic_corpus():
+    text_body = ("lorem ipsum dolor sit amet " * 40 + "\n") * 200
+    return {
+        "image.png": b"\x89PNG\r\n\x1a\n" + os.urandom(256 * 1024),
+        "photo.jpg": b"\xff\xd8\xff\xe0" + os.urandom(512 * 1024),
+        "anim.gif": b"GIF89a" + os.urandom(64 * 1024),
+        "pic.webp": b"RIFF\x00\x00\x00\x00WEBPVP8 " + os.urandom(128 * 1024),
+        "doc.pdf": b"%PDF-1.7\n" + os.urandom(256 * 1024),
+        "archive.zip": b"PK\x03\x04" + os.urandom(128 * 1024),
+        "script.py": b"#!/usr/bin/env python\nprint('hi')\n" * 500,
+        "run.sh": b"#!/bin/bash\necho hi\n" * 500,
+        "run.bat": b"@echo off\necho hi\n" * 500,
+        "data.json": b'{"a": 1, "b": [1, 2, 3]}\n' * 2000,
+        "page.html": b"<!DOCTYPE html><html><body>hi</body></html>\n" * 1000,
+        "style.css": b"/* css */\nbody { color: red; }\n" * 1000,
+        "app.js": b"const x = 1;\n" * 2000,
+        "conf.yml": b"---\nkey: value\n" * 1000,
+        "README.md": b"# Title\n\nSome text\n" * 1000,
+        "notes.txt": text_body.encode("utf-8"),
+        "blob.bin": os.urandom(256 * 1024),
+    }
+
+
+def _directory_corpus(path):
+    corpus = {}
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            try:
+                with open(full, "rb") as f:
+                    corpus[os.path.relpath(full, path)] = f.read()
+            except OSError:
+                continue
+    return corpus
+
+
+def _legacy_detect(file_bytes):
+    """Bản rút gọn chuỗi if/elif cũ (trước utils/file_types) để so sánh"""
+    checks = [
+        (lambda b: b.startswith(b'\x89PNG\r\n\x1a\n'), "png"),
+        (lambda b: b.startswith(b'\xff\xd8\xff'), "jpg"),
+        (lambda b: b.startswith(b'GIF87a') or b.startswith(b'GIF89a'), "gif"),
+        (lambda b: b.startswith(b'RIFF') and b[8:12] == b'WEBP', "webp"),
+        (lambda b: b.startswith(b'%PDF'), "pdf"),
+        (lambda b: b.startswith(b'PK\x03\x04'), "zip"),
+        (lambda b: b.startswith(b'#!/usr/bin/env python') or b.startswith(b'#!python'), "py"),
+        (lambda b: b.startswith(b'#!/bin/bash') or b.startswith(b'#!/usr/bin/bash') or b.startswith(b'#!/bin/sh'), "sh"),
+        (lambda b: b.startswith(b'@echo off') or b.startswith(b'@echo on'), "bat"),
+        (lambda b: b.startswith(b'#Requires') or b.startswith(b'param(') or b.startswith(b'function '), "ps1"),
+        (lambda b: b.startswith(b'<?xml'), "xml"),
+        (lambda b: b.startswith(b'{') or b.startswith(b'['), "json"),
+        (lambda b: b.startswith(b'<!DOCTYPE') or b.startswith(b'<html'), "html"),
+        (lambda b: b.startswith(b'/*') or b.startswith(b'@import'), "css"),
+        (lambda b: b.startswith(b'function') or b.startswith(b'var ') or b.startswith(b'const '), "js"),
+        (lambda b: b.startswith(b'---') and b'\n' in b, "yml"),
+        (lambda b: b.startswith(b'# ') and b'\n' in b, "md"),
+        (lambda b: b.startswith(b'#') and b'\n' in b, "txt"),
+    ]
+    for check, ext in checks:
+        if check(file_bytes):
+            return ext
+    try:
+        text_content = file_bytes.decode('utf-8')
+        if text_content.isprintable() or '\n' in text_content:
+            return "txt"
+    except Exception:
+        pass
+    return "bin"
+
+
+def _time_it(fn, samples, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for sample in samples:
+            fn(sample)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark utils.file_types")
+    parser.add_argument("corpus", nargs="?", help="Thư mục chứa file mẫu (mặc định: corpus tổng hợp)")
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    corpus = _directory_corpus(args.corpus) if args.corpus else _synthetic_corpus()
+    if not corpus:
+        print("Corpus rỗng")
+        return 1
+
+    print(f"{'file':<24} {'size':>10}  {'ext':<6} content_type")
+    for name, data in sorted(corpus.items()):
+        ext, content_type = detect_file_type(data[:SNIFF_BYTES])
+        print(f"{name[:24]:<24} {len(data):>10}  {ext:<6} {content_type}")
+
+    heads = [data[:SNIFF_BYTES] for data in corpus.values()]
+    fulls = list(corpus.values())
+    calls = args.rounds * len(corpus)
+
+    new_s = _time_it(detect_file_type, heads, args.rounds)
+    old_s = _time_it(_legacy_detect, fulls, args.rounds)
+    print()
+    print(f"file_types.detect_file_type: {calls / new_s:,.0f} files/s ({new_s * 1e6 / calls:.2f} us/file)")
+    print(f"legacy if/elif chain:        {calls / old_s:,.0f} files/s ({old_s * 1e6 / calls:.2f} us/file)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
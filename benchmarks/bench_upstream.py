@@ -0,0 +1,140 @@
+"""Benchmark hot loop upstream (services/qwen_upstream) và các adapter API.
+
+Chạy:
+    python -m benchmarks.bench_upstream                  # 2000 token/response, 20 vòng
+    python -m benchmarks.bench_upstream --tokens 500 --think 200 --rounds 50
+
+Stream SSE tổng hợp được phát lại từ bộ nhớ (không có mạng), nên số đo là chi phí CPU
+của server cho mỗi token: parse SSE + phase think/answer + render chunk cho từng API.
+So sánh với vòng lặp cũ (decode, json.loads, dựng dict + uuid4 mỗi chunk, json.dumps).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import services.qwen_upstream as upstream_module  # noqa: E402
+from models.request_state import RequestState  # noqa: E402
+from services.qwen_upstream import qwen_upstream, UpstreamStream  # noqa: E402
+from services.chat_service import chat_service  # noqa: E402
+from services.ollama_service import ollama_service  # noqa: E402
+
+MODEL = "qwen3-235b-a22b"
+
+
+class _ReplayResponse:
+    """Giả lập requests.Response streaming: phát lại các dòng SSE có sẵn"""
+
+    status_code = 200
+    headers = {"content-type": "text/event-stream"}
+
+    def __init__(self, lines):
+        self._lines = lines
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def close(self):
+        pass
+
+
+def _synthetic_stream(tokens, think_tokens):
+    def sse(obj):
+        return b"data: " + json.dumps(obj).encode("utf-8")
+
+    words = ["Hello", " world", ",", " xin", " chào", " 你好", " the", " quick", " brown", " fox"]
+    lines = [sse({"response.created": {"parent_id": "p-bench", "response_id": "r-bench"}}), b""]
+    for i in range(think_tokens):
+        lines.append(sse({"choices": [{"delta": {"content": words[i % len(words)], "phase": "think"}}]}))
+        lines.append(b"")
+    if think_tokens:
+        lines.append(sse({"choices": [{"delta": {"content": "", "phase": "think", "status": "finished"}}]}))
+    for i in range(tokens):
+        lines.append(sse({"choices": [{"delta": {"content": words[i % len(words)], "phase": "answer"}}]}))
+        lines.append(b"")
+    lines.append(sse({"choices": [{"delta": {"content": "", "phase": "answer"}, "finish_reason": "stop"}]}))
+    lines.append(b"data: [DONE]")
+    return lines
+
+
+def _legacy_chat(lines):
+    """Vòng lặp cũ của ChatService (rút gọn) để so sánh"""
+    for line in lines:
+        if not line:
+            continue
+        line_text = line.decode("utf-8")
+        if not line_text.startswith("data: ") or line_text.startswith("data: [DONE]"):
+            continue
+        qwen_data = json.loads(line_text[6:])
+        if "response.created" in qwen_data:
+            continue
+        delta = qwen_data["choices"][0].get("delta", {})
+        finish_reason = qwen_data["choices"][0].get("finish_reason")
+        if "content" in delta:
+            out = {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": MODEL,
+                "system_fingerprint": MODEL,
+                "choices": [{"index": 0, "delta": {"content": delta["content"]},
+                             "logprobs": None, "finish_reason": finish_reason}],
+            }
+            yield f"data: {json.dumps(out)}\n\n"
+        if finish_reason:
+            yield "data: [DONE]\n\n"
+            return
+
+
+def _install_replay(lines):
+    """Bỏ qua mạng/cookie/chat_id: mọi request upstream phát lại `lines`"""
+    upstream_module.build_header = lambda base_headers: dict(base_headers)
+    qwen_upstream._prepare = lambda *args: {}
+    qwen_upstream._post = lambda *args: _ReplayResponse(lines)
+    chat_service._current_chat = lambda model: ("bench-chat", None)
+    ollama_service._open_session = lambda session_key, model, client_key=None: ("bench-chat", None, None)
+
+
+def _cases(lines):
+    data = {"model": MODEL, "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    return [
+        ("engine events only", lambda: UpstreamStream(_ReplayResponse(lines), "bench-chat",
+                                                      RequestState("bench", MODEL)).events()),
+        ("OpenAI chat SSE", lambda: chat_service.stream_qwen_response(data)),
+        ("Ollama /api/chat", lambda: ollama_service.stream_ollama_response(data)),
+        ("Ollama /api/generate", lambda: ollama_service.stream_ollama_response(data, target="generate")),
+        ("legacy chat loop", lambda: _legacy_chat(lines)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark services.qwen_upstream")
+    parser.add_argument("--tokens", type=int, default=2000, help="Số token answer mỗi response")
+    parser.add_argument("--think", type=int, default=500, help="Số token think mỗi response")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    lines = _synthetic_stream(args.tokens, args.think)
+    _install_replay(lines)
+    total_tokens = (args.tokens + args.think) * args.rounds
+
+    print(f"{args.rounds} responses x {args.tokens + args.think} tokens ({args.think} think)")
+    for name, make in _cases(lines):
+        chunks = 0
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for _chunk in make():
+                chunks += 1
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22} {total_tokens / elapsed:>12,.0f} tokens/s "
+              f"({elapsed * 1e6 / total_tokens:.2f} us/token, {chunks // args.rounds} chunks/response)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
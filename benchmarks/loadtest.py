@@ -0,0 +1,398 @@
+"""Load test end-to-end cho proxy: TTFT, inter-token latency, tổng latency, token/s, tỉ lệ lỗi và
+queue wait theo từng endpoint, ở N client đồng thời.
+
+Chạy:
+    python -m benchmarks.loadtest benchmarks/scenarios/lmstudio_smoke.json
+    python -m benchmarks.loadtest benchmarks/scenarios/lmstudio_mixed.json --concurrency 200 --duration 120
+    python -m benchmarks.loadtest benchmarks/scenarios/ollama_smoke.json --url http://127.0.0.1:11434 \\
+        --out results/ollama-1.0.5.json
+
+Chạy offline với benchmarks.mock_qwen (xem README). Proxy chỉ phục vụ endpoint của mode đang
+chạy (lmstudio: /v1/*, ollama: /api/*), nên mỗi scenario nhắm một mode.
+
+Scenario (JSON):
+    {
+      "name": "lmstudio-mixed",
+      "url": "http://127.0.0.1:1235",
+      "model": "qwen3-235b-a22b",
+      "concurrency": 50,          # số client
+      "ramp_up": 10,              # giây để khởi động hết client (tuyến tính)
+      "duration": 60,             # giây chạy (tính cả ramp-up)
+      "max_requests": null,       # dừng sớm khi đủ số request
+      "timeout": 300,
+      "seed": 0,
+      "mix": [
+        {"endpoint": "/v1/chat/completions", "stream": true, "weight": 3, "prompt_words": 50},
+        {"endpoint": "/v1/chat/completions", "stream": false, "weight": 1, "attachment_bytes": 65536},
+        {"endpoint": "/v1/completions", "stream": true, "weight": 1, "output_tokens": 128}
+      ]
+    }
+
+Field của mix: endpoint, stream, weight, prompt_words (độ dài prompt), attachment_bytes (0 = không
+gửi ảnh; ảnh PNG ngẫu nhiên, khác nhau mỗi request), output_tokens (marker [mock:tokens=N] cho mock),
+cacheable (true: prompt cố định, để đo response cache).
+
+Queue wait lấy từ /debug/requests của proxy theo X-Request-ID mà load test gửi kèm mỗi request.
+Kết quả JSON (--out) gồm cấu hình, phiên bản server, tổng hợp toàn bộ và theo endpoint.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+_WORDS = ["alpha", "beta", "gamma", "delta", "kernel", "proxy", "stream", "token", "latency", "queue",
+          "xin", "chào", "thế", "giới", "model", "context"]
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+_CHAT_ENDPOINTS = ("/v1/chat/completions", "/api/chat")
+_SSE_ENDPOINTS = ("/v1/chat/completions", "/v1/completions")
+ENDPOINTS = ("/v1/chat/completions", "/v1/completions", "/api/chat", "/api/generate")
+
+
+def _percentiles(values):
+    """p50/p90/p99 (nội suy tuyến tính), mean, max; None nếu không có mẫu"""
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def pct(p):
+        k = (len(ordered) - 1) * p / 100.0
+        lo = int(k)
+        hi = min(lo + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+    return {
+        "p50": round(pct(50), 3),
+        "p90": round(pct(90), 3),
+        "p99": round(pct(99), 3),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class Result:
+    __slots__ = ("label", "request_id", "status", "error", "ttft_ms", "total_ms", "gaps_ms", "tokens",
+                 "tokens_per_sec", "queue_wait_ms")
+
+    def __init__(self, label, request_id):
+        self.label = label
+        self.request_id = request_id
+        self.status = None
+        self.error = None
+        self.ttft_ms = None
+        self.total_ms = None
+        self.gaps_ms = []
+        self.tokens = 0
+        self.tokens_per_sec = None
+        self.queue_wait_ms = None
+
+
+class LoadTest:
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.url = scenario["url"].rstrip("/")
+        self.model = scenario.get("model", "qwen3-235b-a22b")
+        self.timeout = scenario.get("timeout", 300)
+        self.mix = scenario["mix"]
+        for entry in self.mix:
+            if entry["endpoint"] not in ENDPOINTS:
+                raise ValueError(f"Unsupported endpoint in mix: {entry['endpoint']}")
+        self.weights = [entry.get("weight", 1) for entry in self.mix]
+        self.results = []
+        self._lock = threading.Lock()
+        self._issued = 0
+
+    # --- request ---
+
+    def _prompt(self, entry, rng):
+        words = entry.get("prompt_words", 32)
+        if entry.get("cacheable"):
+            text = " ".join(_WORDS[i % len(_WORDS)] for i in range(words))
+        else:
+            text = " ".join(rng.choice(_WORDS) for _ in range(words)) + f" #{uuid.uuid4().hex[:8]}"
+        if entry.get("output_tokens"):
+            text += f" [mock:tokens={int(entry['output_tokens'])}]"
+        return text
+
+    def _body(self, entry, rng):
+        endpoint = entry["endpoint"]
+        stream = bool(entry.get("stream", True))
+        prompt = self._prompt(entry, rng)
+        images = []
+        if entry.get("attachment_bytes"):
+            images.append(base64.b64encode(_PNG_MAGIC + os.urandom(int(entry["attachment_bytes"]))).decode())
+        body = {"model": self.model, "stream": stream}
+        if endpoint in _CHAT_ENDPOINTS:
+            message = {"role": "user", "content": prompt}
+            if images:
+                message["images"] = images
+            body["messages"] = [message]
+        else:
+            body["prompt"] = prompt
+            if images:
+                body["images"] = images
+        if stream and endpoint in _SSE_ENDPOINTS:
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    @staticmethod
+    def _label(entry):
+        return f"{entry['endpoint']} {'stream' if entry.get('stream', True) else 'non-stream'}"
+
+    def _run_one(self, entry, rng):
+        request_id = uuid.uuid4().hex[:16]
+        result = Result(self._label(entry), request_id)
+        endpoint = entry["endpoint"]
+        body = self._body(entry, rng)
+        start = time.perf_counter()
+        last = None
+        try:
+            # Mỗi request một kết nối: server dev werkzeug đóng kết nối sau mỗi response, và bản cũ của
+            # proxy gửi "Connection: keep-alive" trên response stream khiến client dùng lại socket rồi treo
+            response = requests.post(self.url + endpoint, json=body, stream=body["stream"], timeout=self.timeout,
+                                     headers={"X-Request-ID": request_id})
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = f"HTTP {response.status_code}: {response.text[:200]}"
+            elif body["stream"]:
+                for content, usage_tokens, error in self._stream_items(endpoint, response):
+                    now = time.perf_counter()
+                    if error:
+                        result.error = str(error)[:200]
+                        break
+                    if usage_tokens is not None:
+                        result.tokens = usage_tokens
+                    if content:
+                        if result.ttft_ms is None:
+                            result.ttft_ms = (now - start) * 1000
+                        else:
+                            result.gaps_ms.append((now - last) * 1000)
+                        last = now
+                if not result.tokens:
+                    result.tokens = len(result.gaps_ms) + (1 if result.ttft_ms is not None else 0)
+            else:
+                data = response.json()
+                if isinstance(data, dict) and data.get("error"):
+                    result.error = str(data["error"])[:200]
+                result.tokens = self._response_tokens(data)
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"[:200]
+        finally:
+            if response is not None:
+                response.close()
+        result.total_ms = (time.perf_counter() - start) * 1000
+        generation_ms = result.total_ms - (result.ttft_ms or 0)
+        if result.tokens and generation_ms > 0 and result.error is None:
+            result.tokens_per_sec = result.tokens / (generation_ms / 1000)
+        return result
+
+    @staticmethod
+    def _stream_items(endpoint, response):
+        """yield (content, usage_tokens, error) cho mỗi dòng SSE (OpenAI) hoặc NDJSON (Ollama)"""
+        sse = endpoint in _SSE_ENDPOINTS
+        for line in response.iter_lines():
+            if not line:
+                continue
+            if sse:
+                if not line.startswith(b"data: "):
+                    continue
+                line = line[6:]
+                if line == b"[DONE]":
+                    return
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                continue
+            if obj.get("error"):
+                yield None, None, obj["error"]
+                return
+            if sse:
+                usage = obj.get("usage") or {}
+                choices = obj.get("choices") or [{}]
+                delta = choices[0].get("delta") or {}
+                content = delta.get("content") or delta.get("reasoning_content") or choices[0].get("text")
+                yield content, usage.get("completion_tokens"), None
+            else:
+                message = obj.get("message") or {}
+                content = message.get("content") or message.get("thinking") or obj.get("response")
+                yield content, obj.get("eval_count") if obj.get("done") else None, None
+
+    @staticmethod
+    def _response_tokens(data):
+        if not isinstance(data, dict):
+            return 0
+        usage = data.get("usage") or {}
+        return usage.get("completion_tokens") or data.get("eval_count") or 0
+
+    # --- workers ---
+
+    def _take_slot(self, max_requests):
+        with self._lock:
+            if max_requests is not None and self._issued >= max_requests:
+                return False
+            self._issued += 1
+            return True
+
+    def _worker(self, index, start_at, deadline, max_requests, seed):
+        rng = random.Random(f"{seed}:{index}")
+        delay = start_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        while time.monotonic() < deadline and self._take_slot(max_requests):
+            entry = rng.choices(self.mix, weights=self.weights)[0]
+            result = self._run_one(entry, rng)
+            with self._lock:
+                self.results.append(result)
+
+    def run(self, concurrency, duration, ramp_up, max_requests=None, progress=True):
+        seed = self.scenario.get("seed", 0)
+        began = time.monotonic()
+        deadline = began + duration
+        threads = []
+        for i in range(concurrency):
+            start_at = began + (ramp_up * i / concurrency if concurrency > 1 else 0)
+            thread = threading.Thread(target=self._worker, args=(i, start_at, deadline, max_requests, seed),
+                                      daemon=True, name=f"loadtest-{i}")
+            thread.start()
+            threads.append(thread)
+        while any(t.is_alive() for t in threads):
+            time.sleep(1.0)
+            if progress:
+                with self._lock:
+                    done = len(self.results)
+                    errors = sum(1 for r in self.results if r.error)
+                print(f"\r{time.monotonic() - began:6.1f}s  {done} requests  {errors} errors", end="",
+                      file=sys.stderr, flush=True)
+        if progress:
+            print(file=sys.stderr)
+        return time.monotonic() - began
+
+    # --- kết quả ---
+
+    def attach_queue_wait(self):
+        """Ghép queue_wait_ms từ /debug/requests theo request id; trả về số request ghép được"""
+        try:
+            ledger = requests.get(f"{self.url}/debug/requests", params={"limit": 100000}, timeout=30).json()
+        except Exception:
+            return 0
+        by_id = {item.get("request_id"): item for item in ledger.get("data", [])}
+        matched = 0
+        for result in self.results:
+            item = by_id.get(result.request_id)
+            if item is not None:
+                result.queue_wait_ms = item.get("queue_wait_ms")
+                matched += 1
+        return matched
+
+    @staticmethod
+    def summarize(results, elapsed):
+        errors = [r for r in results if r.error]
+        ok = [r for r in results if not r.error]
+        status_codes = {}
+        for r in results:
+            key = str(r.status) if r.status is not None else "exception"
+            status_codes[key] = status_codes.get(key, 0) + 1
+        gaps = [gap for r in ok for gap in r.gaps_ms]
+        return {
+            "requests": len(results),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(results), 4) if results else 0.0,
+            "throughput_rps": round(len(results) / elapsed, 3) if elapsed > 0 else None,
+            "output_tokens": sum(r.tokens for r in ok),
+            "ttft_ms": _percentiles([r.ttft_ms for r in ok if r.ttft_ms is not None]),
+            "inter_token_ms": _percentiles(gaps),
+            "total_ms": _percentiles([r.total_ms for r in ok]),
+            "tokens_per_sec": _percentiles([r.tokens_per_sec for r in ok if r.tokens_per_sec is not None]),
+            "queue_wait_ms": _percentiles([r.queue_wait_ms for r in results if r.queue_wait_ms is not None]),
+            "status_codes": status_codes,
+            "error_samples": [r.error for r in errors[:5]],
+        }
+
+    def report(self, elapsed, config):
+        matched = self.attach_queue_wait()
+        try:
+            server_version = requests.get(f"{self.url}/api/version", timeout=5).json().get("version")
+        except Exception:
+            server_version = None
+        by_label = {}
+        for result in self.results:
+            by_label.setdefault(result.label, []).append(result)
+        return {
+            "scenario": self.scenario.get("name"),
+            "url": self.url,
+            "server_version": server_version,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - elapsed)),
+            "elapsed_s": round(elapsed, 3),
+            "config": config,
+            "queue_wait_matched": matched,
+            "overall": self.summarize(self.results, elapsed),
+            "by_endpoint": {label: self.summarize(items, elapsed) for label, items in sorted(by_label.items())},
+        }
+
+
+def _print_table(report):
+    def fmt(stats):
+        return "-" if stats["p50"] is None else f"{stats['p50']:.0f}/{stats['p90']:.0f}/{stats['p99']:.0f}"
+
+    print(f"\n{report['scenario']} @ {report['url']} ({report['elapsed_s']}s)")
+    header = f"{'endpoint':<34} {'req':>6} {'err%':>6} {'TTFT p50/90/99':>16} {'ITL p50/90/99':>14} " \
+             f"{'total p50/90/99':>20} {'tok/s p50':>10} {'queue p90':>10}"
+    print(header)
+    rows = list(report["by_endpoint"].items()) + [("overall", report["overall"])]
+    for label, stats in rows:
+        tps = stats["tokens_per_sec"]["p50"]
+        queue = stats["queue_wait_ms"]["p90"]
+        print(f"{label:<34} {stats['requests']:>6} {stats['error_rate'] * 100:>5.1f}% {fmt(stats['ttft_ms']):>16} "
+              f"{fmt(stats['inter_token_ms']):>14} {fmt(stats['total_ms']):>20} "
+              f"{'-' if tps is None else f'{tps:.1f}':>10} {'-' if queue is None else f'{queue:.0f}':>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test for the proxy")
+    parser.add_argument("scenario", help="Scenario JSON file")
+    parser.add_argument("--url", help="Override proxy base URL")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--ramp-up", type=float)
+    parser.add_argument("--max-requests", type=int)
+    parser.add_argument("--out", help="Write JSON results to this file")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(args.scenario, "r", encoding="utf-8") as f:
+        scenario = json.load(f)
+    if args.url:
+        scenario["url"] = args.url
+    scenario.setdefault("url", "http://127.0.0.1:1235")
+    config = {
+        "concurrency": args.concurrency or scenario.get("concurrency", 10),
+        "duration": args.duration or scenario.get("duration", 30),
+        "ramp_up": args.ramp_up if args.ramp_up is not None else scenario.get("ramp_up", 0),
+        "max_requests": args.max_requests or scenario.get("max_requests"),
+        "mix": scenario["mix"],
+    }
+
+    test = LoadTest(scenario)
+    elapsed = test.run(config["concurrency"], config["duration"], config["ramp_up"], config["max_requests"],
+                       progress=not args.quiet)
+    report = test.report(elapsed, config)
+    _print_table(report)
+    if args.out:
+        out_dir = os.path.dirname(args.out)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.out}")
+    return 0 if report["overall"]["requests"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
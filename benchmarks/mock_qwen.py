@@ -0,0 +1,379 @@
+"""Mock server Qwen upstream chạy cục bộ (không cần chat.qwen.ai hay cookie).
+
+Chạy:
+    python -m benchmarks.mock_qwen                                   # 127.0.0.1:8999
+    python -m benchmarks.mock_qwen --ttft 0.5 --tokens-per-sec 40 --answer-tokens 200
+    python -m benchmarks.mock_qwen --error-in-progress 0.05 --error-429 0.02 --brotli
+
+Rồi trỏ proxy vào mock:
+    QWEN_API_BASE=http://127.0.0.1:8999/api QWEN_UPLOAD_URL=http://127.0.0.1:8999/upload python main.py
+
+Endpoint: GET /api/models, POST /api/v2/chats/new, POST /api/v2/chat/completions (SSE với
+response.created + phase think/answer, hoặc JSON khi stream=false), POST /upload (kiểu 0x0.st),
+DELETE /api/v2/chats/, GET /mock/stats.
+
+Output xác định theo (seed, prompt): cùng prompt luôn ra cùng text. Marker trong prompt để
+điều khiển từng request qua proxy: [mock:tokens=N], [mock:think=N], [mock:error=in_progress|
+parent_missing|429]. Lỗi "chat is in progress" cũng xảy ra thật khi hai request cùng chat_id
+chạy song song, và "parent_id not exist" khi parent_id không do mock này cấp.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn
+    brotli = None
+
+_WORDS = ["Hello", " world", ",", " xin", " chào", " 你好", " the", " quick", " brown", " fox", " jumps",
+          " over", " lazy", " dog", ".", "\n", " Qwen", " proxy", " stream", " token"]
+_MARKER = re.compile(r"\[mock:(\w+)=([\w.]+)\]")
+_MAX_KNOWN_IDS = 100000
+
+MODELS = [
+    ("qwen3-235b-a22b", 131072, 32768, True),
+    ("qwen3-coder-plus", 1048576, 65536, False),
+    ("qwen-max-latest", 131072, 8192, False),
+]
+
+
+def _models_body():
+    data = []
+    for model_id, context, generation, thinking in MODELS:
+        data.append({
+            "id": model_id,
+            "name": model_id,
+            "object": "model",
+            "owned_by": "qwen",
+            "info": {
+                "id": model_id,
+                "is_active": True,
+                "meta": {
+                    "max_context_length": context,
+                    "max_generation_length": generation,
+                    "max_thinking_generation_length": generation if thinking else None,
+                    "capabilities": {"vision": True, "document": True, "video": True, "audio": True,
+                                     "citations": True, "thinking": thinking},
+                    "abilities": {"vision": 1, "document": 1, "thinking": 1 if thinking else 0},
+                },
+            },
+        })
+    return {"data": data}
+
+
+def _error_body(code, details):
+    return {"success": False, "request_id": uuid.uuid4().hex, "data": {"code": code, "details": details}}
+
+
+class MockState:
+    """Trạng thái dùng chung giữa các request: id đã cấp, chat đang stream, bộ đếm"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.known_ids = OrderedDict()
+        self.busy_chats = set()
+        self.stats = {"models": 0, "chats": 0, "completions": 0, "streams_active": 0, "uploads": 0,
+                      "upload_bytes": 0, "errors": {}}
+        self._rng = random.Random(options.seed)
+
+    def remember(self, *ids):
+        with self.lock:
+            for item in ids:
+                self.known_ids[item] = True
+                self.known_ids.move_to_end(item)
+            while len(self.known_ids) > _MAX_KNOWN_IDS:
+                self.known_ids.popitem(last=False)
+
+    def known(self, item):
+        with self.lock:
+            return item in self.known_ids
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def count_error(self, kind):
+        with self.lock:
+            self.stats["errors"][kind] = self.stats["errors"].get(kind, 0) + 1
+
+    def roll(self, rate):
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self._rng.random() < rate
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class MockQwenHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockQwen/1.0"
+
+    @property
+    def state(self):
+        return self.server.mock_state
+
+    @property
+    def options(self):
+        return self.server.mock_state.options
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    # --- I/O ---
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, text, status=200):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # --- routes ---
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/api/models":
+            self.state.count("models")
+            self._send_json(_models_body())
+        elif path == "/mock/stats":
+            self._send_json(self.state.snapshot())
+        elif path.startswith("/api/v2/users/user/settings"):
+            self._send_json({"success": True, "data": {}})
+        elif path.startswith("/files/"):
+            self._send_text("mock file\n")
+        else:
+            self._send_json(_error_body("Not_Found", f"No route for {path}"), 404)
+
+    def do_DELETE(self):
+        self._read_body()
+        self._send_json({"success": True, "data": {"status": True}})
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        body = self._read_body()
+        if path == "/api/v2/chats/new":
+            self._new_chat()
+        elif path == "/api/v2/chat/completions":
+            self._completions(body)
+        elif path == "/upload":
+            self._upload(body)
+        else:
+            self._send_json(_error_body("Not_Found", f"No route for {path}"), 404)
+
+    def _new_chat(self):
+        chat_id = str(uuid.uuid4())
+        self.state.remember(chat_id)
+        self.state.count("chats")
+        self._send_json({"success": True, "request_id": uuid.uuid4().hex, "data": {"id": chat_id}})
+
+    def _upload(self, body):
+        options = self.options
+        if options.upload_latency > 0:
+            time.sleep(options.upload_latency)
+        self.state.count("uploads")
+        self.state.count("upload_bytes", len(body))
+        name = f"{uuid.uuid4().hex[:12]}.bin"
+        self._send_text(f"http://{self.headers.get('Host', f'{options.host}:{options.port}')}/files/{name}\n")
+
+    def _completions(self, body):
+        options = self.options
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json(_error_body("Bad_Request", "Invalid JSON body"), 400)
+            return
+        self.state.count("completions")
+        chat_id = data.get("chat_id") or self.path.partition("chat_id=")[2] or "unknown"
+        parent_id = data.get("parent_id")
+        messages = data.get("messages") or [{}]
+        prompt = str(messages[-1].get("content") or "")
+        markers = dict(_MARKER.findall(prompt))
+
+        forced = markers.get("error")
+        if forced == "429" or (forced is None and self.state.roll(options.error_429)):
+            self.state.count_error("429")
+            self._send_json(_error_body("RateLimited", "Too many requests, please try again later"), 429)
+            return
+        if forced == "parent_missing" or (forced is None and self.state.roll(options.error_parent_missing)) \
+                or (parent_id and not self.state.known(parent_id)):
+            self.state.count_error("parent_missing")
+            self._send_json(_error_body("Bad_Request", f"The parent_id {parent_id} does not exist in chat"))
+            return
+        if forced == "in_progress" or (forced is None and self.state.roll(options.error_in_progress)):
+            self.state.count_error("in_progress")
+            self._send_json(_error_body("Bad_Request", "The chat is in progress!"))
+            return
+        with self.state.lock:
+            in_progress = chat_id in self.state.busy_chats
+            if not in_progress:
+                self.state.busy_chats.add(chat_id)
+        if in_progress:
+            self.state.count_error("in_progress")
+            self._send_json(_error_body("Bad_Request", "The chat is in progress!"))
+            return
+
+        try:
+            thinking = bool((messages[-1].get("feature_config") or {}).get("thinking_enabled"))
+            answer_tokens = int(markers.get("tokens", options.answer_tokens))
+            think_tokens = int(markers.get("think", options.think_tokens if thinking else 0))
+            rng = random.Random(f"{options.seed}:{prompt}")
+            think = [_WORDS[rng.randrange(len(_WORDS))] for _ in range(think_tokens)]
+            answer = [_WORDS[rng.randrange(len(_WORDS))] for _ in range(answer_tokens)]
+            parent = str(uuid.uuid4())
+            response_id = str(uuid.uuid4())
+            self.state.remember(parent, response_id)
+            if data.get("stream", True):
+                self._stream(chat_id, parent, response_id, think, answer)
+            else:
+                time.sleep(options.ttft + (len(think) + len(answer)) / max(options.tokens_per_sec, 1e-6))
+                self._send_json({
+                    "success": True,
+                    "response": {"created": {"chat_id": chat_id, "parent_id": parent, "response_id": response_id}},
+                    "choices": [{"message": {"role": "assistant", "content": "".join(answer)},
+                                 "finish_reason": "stop"}],
+                    "usage": {"input_tokens": len(prompt.split()), "output_tokens": len(answer)},
+                })
+        finally:
+            with self.state.lock:
+                self.state.busy_chats.discard(chat_id)
+
+    def _stream(self, chat_id, parent, response_id, think, answer):
+        options = self.options
+        compressor = None
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        if options.brotli and brotli is not None and "br" in self.headers.get("Accept-Encoding", ""):
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+            self.send_header("Content-Encoding", "br")
+        self.end_headers()
+
+        def write(payload):
+            raw = payload.encode("utf-8")
+            if compressor is not None:
+                raw = compressor.process(raw) + compressor.flush()
+            if raw:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+                self.wfile.flush()
+
+        def event(obj):
+            write("data: " + json.dumps(obj, ensure_ascii=False) + "\n\n")
+
+        def delta(content, phase, status="typing", finish_reason=None):
+            choice = {"delta": {"role": "assistant", "content": content, "phase": phase, "status": status}}
+            if finish_reason:
+                choice["finish_reason"] = finish_reason
+            event({"choices": [choice]})
+
+        step = max(1, options.chunk_tokens)
+        gap = step / max(options.tokens_per_sec, 1e-6)
+        self.state.count("streams_active")
+        try:
+            event({"response.created": {"chat_id": chat_id, "parent_id": parent, "response_id": response_id}})
+            time.sleep(options.ttft)
+            for i in range(0, len(think), step):
+                delta("".join(think[i:i + step]), "think")
+                time.sleep(gap)
+            if think:
+                delta("", "think", status="finished")
+            for i in range(0, len(answer), step):
+                delta("".join(answer[i:i + step]), "answer")
+                time.sleep(gap)
+            delta("", "answer", status="finished", finish_reason="stop")
+            write("data: [DONE]\n\n")
+            if compressor is not None:
+                tail = compressor.finish()
+                if tail:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(tail), tail))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.state.count("streams_active", -1)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Mock Qwen upstream server (offline)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--ttft", type=float, default=0.3, help="Giây trước delta đầu tiên")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="Số token mỗi SSE delta")
+    parser.add_argument("--answer-tokens", type=int, default=64)
+    parser.add_argument("--think-tokens", type=int, default=32, help="Khi request bật thinking_enabled")
+    parser.add_argument("--upload-latency", type=float, default=0.05)
+    parser.add_argument("--error-in-progress", type=float, default=0.0, help="Tỉ lệ lỗi 'chat is in progress'")
+    parser.add_argument("--error-parent-missing", type=float, default=0.0, help="Tỉ lệ lỗi parent_id not exist")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Tỉ lệ HTTP 429")
+    parser.add_argument("--brotli", action="store_true", help="Nén SSE bằng brotli nếu client chấp nhận br")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    return parser
+
+
+def start_server(options, background=True):
+    """Khởi động mock; background=True trả về server chạy trên thread daemon (dùng trong script khác)"""
+    server = ThreadingHTTPServer((options.host, options.port), MockQwenHandler)
+    server.daemon_threads = True
+    server.mock_state = MockState(options)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True, name="mock-qwen").start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    if options.brotli and brotli is None:
+        print("brotli is not installed; streams will be sent uncompressed", file=sys.stderr)
+    base = f"http://{options.host}:{options.port}"
+    print(f"Mock Qwen listening on {base}")
+    print(f"  QWEN_API_BASE={base}/api QWEN_UPLOAD_URL={base}/upload python main.py")
+    try:
+        start_server(options, background=False)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,94 @@
 import os
 import uuid
+from urllib.parse import urlparse
 x_request_id = str(uuid.uuid4())
 
 # Application version
 VERSION = "1.0.5"
 TMP_FOLDER = "./tmp"
 
-# URLs
-QWEN_API_BASE = "https://chat.qwen.ai/api"
+# Upload: file <= ngưỡng được upload thẳng từ bộ nhớ, lớn hơn thì spool ra TMP_FOLDER
+UPLOAD_SPOOL_THRESHOLD = int(os.environ.get("QWEN_UPLOAD_SPOOL_THRESHOLD", str(16 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Xử lý ảnh trước khi upload (cần Pillow): giới hạn cạnh dài, encode lại webp/jpeg, bỏ EXIF
+IMAGE_PREPROCESS_ENABLED = os.environ.get("QWEN_IMAGE_PREPROCESS", "0").lower() in ("1", "true", "yes", "on")
+IMAGE_MAX_DIMENSION = int(os.environ.get("QWEN_IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_OUTPUT_FORMAT = os.environ.get("QWEN_IMAGE_FORMAT", "webp").lower()
+IMAGE_OUTPUT_QUALITY = int(os.environ.get("QWEN_IMAGE_QUALITY", "85"))
+IMAGE_PREPROCESS_MIN_BYTES = int(os.environ.get("QWEN_IMAGE_MIN_BYTES", str(256 * 1024)))
+IMAGE_PREPROCESS_CACHE_BYTES = 64 * 1024 * 1024
+
+# Embeddings (/api/embed, /v1/embeddings)
+EMBEDDING_DIM = 768
+EMBEDDING_LRU_SIZE = int(os.environ.get("QWEN_EMBEDDING_LRU_SIZE", "4096"))
+# "hashing": n-gram hashing + TF-IDF + random projection (có ngữ nghĩa), "random": vector giả theo hash text
+EMBEDDING_BACKEND = os.environ.get("QWEN_EMBEDDING_BACKEND", "hashing").lower()
+EMBEDDING_HASH_BUCKETS = int(os.environ.get("QWEN_EMBEDDING_HASH_BUCKETS", "4096"))
+# Cache embedding trên đĩa (memmap), mỗi backend/số chiều một thư mục con; để rỗng để tắt
+EMBEDDING_CACHE_DIR = os.environ.get("QWEN_EMBEDDING_CACHE_DIR", "./cache/embeddings")
+EMBEDDING_CACHE_MAX_ROWS = int(os.environ.get("QWEN_EMBEDDING_CACHE_MAX_ROWS", "200000"))
+
+# Ollama `context` handle -> upstream chat đã tạo (session cache LRU + TTL)
+SESSION_CACHE_SIZE = int(os.environ.get("QWEN_SESSION_CACHE_SIZE", "1024"))
+SESSION_CACHE_TTL = int(os.environ.get("QWEN_SESSION_CACHE_TTL", "3600"))
+# Ollama keep_alive: thời gian giữ chat upstream "ấm" cho mỗi model + client (mặc định như Ollama: 5m)
+SESSION_KEEP_ALIVE_DEFAULT = os.environ.get("QWEN_KEEP_ALIVE", "5m")
+SESSION_REAPER_INTERVAL = 5
+# Cache URL file đã upload theo hash nội dung (LRU + TTL giây kể từ lúc upload)
+UPLOAD_CACHE_SIZE = int(os.environ.get("QWEN_UPLOAD_CACHE_SIZE", "256"))
+UPLOAD_CACHE_TTL = int(os.environ.get("QWEN_UPLOAD_CACHE_TTL", "1800"))
+
+# Cache response exact-match (opt-in): key = hash của request đã chuẩn hóa, lưu chuỗi delta
+# để phát lại dạng stream hoặc body đầy đủ. Header bypass: X-Cache-Bypass: 1 / Cache-Control: no-cache
+RESPONSE_CACHE_ENABLED = os.environ.get("QWEN_RESPONSE_CACHE", "0").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_SIZE = int(os.environ.get("QWEN_RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("QWEN_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = int(os.environ.get("QWEN_RESPONSE_CACHE_TTL", "3600"))
+# Khoảng nghỉ (giây) giữa hai delta khi phát lại stream từ cache; 0 = phát ngay
+RESPONSE_CACHE_REPLAY_DELAY = float(os.environ.get("QWEN_RESPONSE_CACHE_REPLAY_DELAY", "0"))
+RESPONSE_CACHE_BYPASS_HEADER = "X-Cache-Bypass"
+
+# Cache response ngữ nghĩa (opt-in): embed lượt user cuối bằng embedding cục bộ, trả lời đã cache
+# nếu cosine >= ngưỡng và phần hội thoại trước đó giống hệt. Mỗi model một index tối đa SIZE entry
+SEMANTIC_CACHE_ENABLED = os.environ.get("QWEN_SEMANTIC_CACHE", "0").lower() in ("1", "true", "yes", "on")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("QWEN_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("QWEN_SEMANTIC_CACHE_SIZE", "2048"))
+SEMANTIC_CACHE_TTL = int(os.environ.get("QWEN_SEMANTIC_CACHE_TTL", "3600"))
+
+# Batch API (/v1/files, /v1/batches): file + trạng thái batch lưu trên đĩa để chạy tiếp sau restart.
+# Runner chạy tối đa CONCURRENCY request song song, mỗi request một chat riêng, và chỉ bắt đầu
+# request mới khi queue interactive rảnh (kiểm tra lại mỗi IDLE_POLL giây)
+BATCH_DIR = os.environ.get("QWEN_BATCH_DIR", "./cache/batches")
+BATCH_CONCURRENCY = int(os.environ.get("QWEN_BATCH_CONCURRENCY", "2"))
+BATCH_IDLE_POLL = 0.5
+BATCH_MAX_REQUESTS = int(os.environ.get("QWEN_BATCH_MAX_REQUESTS", "50000"))
+BATCH_CHECKPOINT_INTERVAL = 2.0
+
+# Fan-out: prompt dạng mảng (/v1/completions) và n>1 chạy song song, mỗi choice một chat riêng
+FANOUT_CONCURRENCY = int(os.environ.get("QWEN_FANOUT_CONCURRENCY", "4"))
+FANOUT_MAX_CHOICES = int(os.environ.get("QWEN_FANOUT_MAX_CHOICES", "16"))
+
+# Tracing theo request: tỉ lệ sample (0 = tắt, 1 = mọi request), span ghi ra JSONL xoay vòng
+# trong TRACE_DIR; đặt QWEN_TRACE_OTLP_ENDPOINT (vd. http://localhost:4318/v1/traces) để gửi OTLP-JSON
+TRACE_SAMPLE_RATE = float(os.environ.get("QWEN_TRACE_SAMPLE_RATE", "0"))
+TRACE_DIR = os.environ.get("QWEN_TRACE_DIR", "./logs/traces")
+TRACE_FILE_MAX_BYTES = int(os.environ.get("QWEN_TRACE_FILE_MAX_BYTES", str(16 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.environ.get("QWEN_TRACE_FILE_BACKUPS", "5"))
+TRACE_OTLP_ENDPOINT = os.environ.get("QWEN_TRACE_OTLP_ENDPOINT", "")
+TRACE_QUEUE_SIZE = 10000
+
+# Ledger request gần nhất cho /debug/requests (ring buffer cố định, bộ nhớ không tăng theo tải)
+REQUEST_LEDGER_SIZE = int(os.environ.get("QWEN_REQUEST_LEDGER_SIZE", "2048"))
+
+# Sampling profiler qua /admin/profile (tắt mặc định; khi không chạy không có thread nào)
+PROFILER_ENABLED = os.environ.get("QWEN_PROFILER", "0").lower() in ("1", "true", "yes", "on")
+PROFILER_MAX_SECONDS = int(os.environ.get("QWEN_PROFILER_MAX_SECONDS", "60"))
+PROFILER_DEFAULT_INTERVAL_MS = 10
+
+# URLs (QWEN_API_BASE / QWEN_UPLOAD_URL đổi được qua env, vd. trỏ về benchmarks.mock_qwen để chạy offline)
+QWEN_API_BASE = os.environ.get("QWEN_API_BASE", "https://chat.qwen.ai/api").rstrip("/")
+QWEN_UPLOAD_URL = os.environ.get("QWEN_UPLOAD_URL", "https://0x0.st")
 QWEN_MODELS_URL = f"{QWEN_API_BASE}/models"
 QWEN_NEW_CHAT_URL = f"{QWEN_API_BASE}/v2/chats/new"
 QWEN_CHAT_COMPLETIONS_URL = f"{QWEN_API_BASE}/v2/chat/completions"
@@ -17,10 +98,12 @@ QWEN_COMPLETIONS_BODY_VERSION = "2.1"
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36"
 qwen_version = "0.2.0"
-qwen_host = "chat.qwen.ai"
-qwen_origin = "https://chat.qwen.ai"
-qwen_referer = "https://chat.qwen.ai/c/guest"
-QWEN_REFERER_NEW_CHAT = "https://chat.qwen.ai/c/new-chat"
+# Host/Origin/Referer lấy theo QWEN_API_BASE để khớp upstream khác mặc định
+_qwen_base = urlparse(QWEN_API_BASE)
+qwen_host = _qwen_base.netloc
+qwen_origin = f"{_qwen_base.scheme}://{_qwen_base.netloc}"
+qwen_referer = f"{qwen_origin}/c/guest"
+QWEN_REFERER_NEW_CHAT = f"{qwen_origin}/c/new-chat"
 curl_user_agent = "curl/8.12.1"
 
 # Optional anti-bot headers for Qwen web API (set via env or leave default for bx-v)
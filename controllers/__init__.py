@@ -3,6 +3,8 @@
 __all__ = [
     "lmstudio",
     "ollama",
+    "admin",
+    "batch",
 ]
 
 
@@ -0,0 +1,78 @@
+from flask import Blueprint, Response, jsonify, current_app, request
+from config import PROFILER_ENABLED, PROFILER_MAX_SECONDS, PROFILER_DEFAULT_INTERVAL_MS
+
+
+admin_bp = Blueprint('admin', __name__)
+
+
+@admin_bp.route('/admin/cache', methods=['GET'])
+def admin_cache_stats():
+    """Thống kê response cache: số entry, dung lượng, hit/miss/bypass (+ semantic cache)"""
+    response_cache = current_app.config['response_cache']
+    stats = response_cache.stats()
+    stats["semantic"] = current_app.config['semantic_cache'].stats()
+    return jsonify(stats)
+
+
+@admin_bp.route('/admin/cache', methods=['DELETE'])
+def admin_cache_clear():
+    """Xóa toàn bộ response cache và semantic cache (giữ bộ đếm)"""
+    response_cache = current_app.config['response_cache']
+    response_cache.clear()
+    current_app.config['semantic_cache'].clear()
+    return jsonify({"status": "cleared"})
+
+
+@admin_bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition: request, queue, upstream, token, upload, cache metrics"""
+    metrics = current_app.config['metrics']
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@admin_bp.route('/admin/profile', methods=['POST', 'GET'])
+def admin_profile():
+    """Lấy mẫu stack mọi thread trong ?seconds=N (mặc định 10), trả collapsed stack cho flamegraph.
+
+    Tắt mặc định (bật bằng QWEN_PROFILER=1). ?interval_ms= khoảng lấy mẫu (mặc định 10ms).
+    """
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Profiler is disabled (set QWEN_PROFILER=1 to enable)"}), 404
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms', PROFILER_DEFAULT_INTERVAL_MS))
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be in (0, {PROFILER_MAX_SECONDS}]"}), 400
+    interval_ms = min(1000.0, max(1.0, interval_ms))
+
+    profiler = current_app.config['sampling_profiler']
+    result = profiler.profile(seconds, interval_ms / 1000.0)
+    if result is None:
+        return jsonify({"error": "A profiling session is already running"}), 409
+    response = Response(profiler.collapsed(result["stacks"]), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(result["samples"])
+    return response
+
+
+@admin_bp.route('/debug/requests', methods=['GET'])
+def debug_requests():
+    """Các request gần nhất trong ledger + percentile (p50/p90/p95/p99) của total/TTFT/queue wait.
+
+    Filter: ?model=, ?endpoint= (route pattern), ?errors=1, ?slowest=N (N request chậm nhất),
+    ?limit=N (mặc định 100, mới nhất trước). Summary tính trên tập đã lọc.
+    """
+    request_ledger = current_app.config['request_ledger']
+    try:
+        slowest = int(request.args['slowest']) if 'slowest' in request.args else None
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "slowest and limit must be integers"}), 400
+    return jsonify(request_ledger.query(
+        model=request.args.get('model'),
+        endpoint=request.args.get('endpoint'),
+        errors=request.args.get('errors', '').lower() in ('1', 'true', 'yes'),
+        slowest=max(1, slowest) if slowest is not None else None,
+        limit=max(1, limit),
+    ))
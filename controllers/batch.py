@@ -0,0 +1,113 @@
+from flask import Blueprint, jsonify, request, current_app, send_file
+from services.batch_service import BatchError
+from utils.request_utils import parse_json_request
+
+
+batch_bp = Blueprint('batch', __name__)
+
+
+def _error_response(e):
+    return jsonify({
+        "error": {
+            "message": e.message,
+            "type": "invalid_request_error",
+            "code": e.code
+        }
+    }), e.status
+
+
+@batch_bp.route('/v1/files', methods=['POST'])
+def upload_file():
+    """Upload file (multipart: file + purpose), vd. JSONL input cho /v1/batches"""
+    batch_service = current_app.config['batch_service']
+    upload = request.files.get('file')
+    if upload is None:
+        return _error_response(BatchError("Missing required parameter: 'file'.", code="missing_required_parameter"))
+    try:
+        return jsonify(batch_service.create_file(upload, upload.filename, request.form.get('purpose')))
+    except BatchError as e:
+        return _error_response(e)
+
+
+@batch_bp.route('/v1/files', methods=['GET'])
+def list_files():
+    batch_service = current_app.config['batch_service']
+    return jsonify(batch_service.list_files(request.args.get('purpose')))
+
+
+@batch_bp.route('/v1/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    batch_service = current_app.config['batch_service']
+    try:
+        return jsonify(batch_service.get_file(file_id))
+    except BatchError as e:
+        return _error_response(e)
+
+
+@batch_bp.route('/v1/files/<file_id>/content', methods=['GET'])
+def get_file_content(file_id):
+    batch_service = current_app.config['batch_service']
+    try:
+        path = batch_service.file_content_path(file_id)
+    except BatchError as e:
+        return _error_response(e)
+    return send_file(path, mimetype='application/jsonl', download_name=batch_service.get_file(file_id)['filename'])
+
+
+@batch_bp.route('/v1/files/<file_id>', methods=['DELETE'])
+def delete_file(file_id):
+    batch_service = current_app.config['batch_service']
+    try:
+        return jsonify(batch_service.delete_file(file_id))
+    except BatchError as e:
+        return _error_response(e)
+
+
+@batch_bp.route('/v1/batches', methods=['POST'])
+@parse_json_request()
+def create_batch():
+    """Tạo batch từ input_file_id; runner nền chạy với độ ưu tiên thấp hơn request interactive"""
+    batch_service = current_app.config['batch_service']
+    data = request.json_data or {}
+    for field in ('input_file_id', 'endpoint'):
+        if not data.get(field):
+            return _error_response(BatchError(f"Missing required parameter: '{field}'.",
+                                              code="missing_required_parameter"))
+    try:
+        return jsonify(batch_service.create_batch(
+            data['input_file_id'],
+            data['endpoint'],
+            data.get('completion_window', '24h'),
+            data.get('metadata')
+        ))
+    except BatchError as e:
+        return _error_response(e)
+
+
+@batch_bp.route('/v1/batches', methods=['GET'])
+def list_batches():
+    batch_service = current_app.config['batch_service']
+    try:
+        limit = max(1, min(100, int(request.args.get('limit', 20))))
+    except ValueError:
+        limit = 20
+    return jsonify(batch_service.list_batches(limit, request.args.get('after')))
+
+
+@batch_bp.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Batch object; khi đang chạy có thêm x_progress (phần trăm, req/s, token/s, ETA)"""
+    batch_service = current_app.config['batch_service']
+    try:
+        return jsonify(batch_service.get_batch(batch_id))
+    except BatchError as e:
+        return _error_response(e)
+
+
+@batch_bp.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    batch_service = current_app.config['batch_service']
+    try:
+        return jsonify(batch_service.cancel_batch(batch_id))
+    except BatchError as e:
+        return _error_response(e)
@@ -4,6 +4,10 @@ import uuid
 
 from utils.request_utils import parse_json_request
 from utils.context_manager import context_manager
+from utils.token_counter import count_tokens
+from utils.embedding_codec import parse_dimensions, parse_encoding_format, truncate_dimensions, encode_vectors
+from utils.response_cache import bypass_requested
+from config import FANOUT_MAX_CHOICES
 
 
 lmstudio_bp = Blueprint('lmstudio', __name__)
@@ -39,28 +43,29 @@ def list_models():
 
 
     models = get_cached_qwen_models()
+    metadata_cache = app.config['metadata_cache']
+
+    def build():
+        if SERVER_MODE == "ollama":
+            formatted_models = []
+            for model in models:
+                model_id = model.get('id', '')
+                if model_id:
+                    model_name_with_latest = f"{model_id}:latest"
+                    formatted_models.append({
+                        "id": model_name_with_latest,
+                        "object": "model",
+                        "created": metadata_cache.updated_at,
+                        "owned_by": "library"
+                    })
+        else:
+            formatted_models = models
+        return {
+            "object": "list",
+            "data": formatted_models
+        }
 
-    if SERVER_MODE == "ollama":
-        formatted_models = []
-        for model in models:
-            model_id = model.get('id', '')
-            if model_id:
-                model_name_with_latest = f"{model_id}:latest"
-                formatted_models.append({
-                    "id": model_name_with_latest,
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "library"
-                })
-    else:
-        formatted_models = models
-
-    response = jsonify({
-        "object": "list",
-        "data": formatted_models
-    })
-    response.headers['Content-Type'] = 'application/json'
-    return response
+    return metadata_cache.respond(('v1/models', SERVER_MODE), build)
 
 
 @lmstudio_bp.route('/v1/models/<model_id>', methods=['GET'])
@@ -90,58 +95,10 @@ def get_model(model_id):
                 }
             }), 404
 
-        model_info = target_model.get('info', {})
-        meta = model_info.get('meta', {})
-        capabilities = meta.get('capabilities', {})
-
-        context_window = meta.get('max_context_length', 131072)
-
-        if 'max_thinking_generation_length' in meta:
-            reserved_output_space = meta.get('max_thinking_generation_length')
-        elif 'max_summary_generation_length' in meta:
-            reserved_output_space = meta.get('max_summary_generation_length')
-        elif 'max_generation_length' in meta:
-            reserved_output_space = meta.get('max_generation_length')
-        else:
-            reserved_output_space = 8192
-
-        supports_thinking = capabilities.get('thinking', False) or capabilities.get('thinking_budget', False)
-
-        lm_capabilities = {
-            "vision": capabilities.get('vision', False),
-            "function_calling": True,
-            "json_output": True,
-            "streaming": True,
-            "document": capabilities.get('document', False),
-            "video": capabilities.get('video', False),
-            "audio": capabilities.get('audio', False),
-            "citations": capabilities.get('citations', False)
-        }
-
-        model_config = {
-            "id": model_id,
-            "object": "model",
-            "created": int(time.time()),
-            "owned_by": "qwen",
-            "permission": [],
-            "root": model_id,
-            "parent": None,
-            "contextWindow": context_window,
-            "reservedOutputTokenSpace": reserved_output_space,
-            "supportsSystemMessage": "system-role",
-            "reasoningCapabilities": {
-                "supportsReasoning": supports_thinking,
-                "canTurnOffReasoning": supports_thinking,
-                "canIOReasoning": supports_thinking,
-                "openSourceThinkTags": ["<think>", "</think>"] if supports_thinking else []
-            },
-            "capabilities": lm_capabilities,
-            "pricing": {"prompt": 0.0001, "completion": 0.0002}
-        }
-
-        response = jsonify(model_config)
-        response.headers['Content-Type'] = 'application/json'
-        return response
+        metadata_cache = app.config['metadata_cache']
+        meta = target_model.get('info', {}).get('meta', {})
+        return metadata_cache.respond(('v1/models/id', model_id),
+                                         lambda: _model_config(model_id, meta, metadata_cache.updated_at))
 
     except Exception as e:
         logger = app.config['logger']
@@ -154,6 +111,57 @@ def get_model(model_id):
         }), 500
 
 
+def _model_config(model_id, meta, created):
+    """Body /v1/models/<model_id> theo format LM Studio"""
+    capabilities = meta.get('capabilities', {})
+
+    context_window = meta.get('max_context_length', 131072)
+
+    if 'max_thinking_generation_length' in meta:
+        reserved_output_space = meta.get('max_thinking_generation_length')
+    elif 'max_summary_generation_length' in meta:
+        reserved_output_space = meta.get('max_summary_generation_length')
+    elif 'max_generation_length' in meta:
+        reserved_output_space = meta.get('max_generation_length')
+    else:
+        reserved_output_space = 8192
+
+    supports_thinking = capabilities.get('thinking', False) or capabilities.get('thinking_budget', False)
+
+    lm_capabilities = {
+        "vision": capabilities.get('vision', False),
+        "function_calling": True,
+        "json_output": True,
+        "streaming": True,
+        "document": capabilities.get('document', False),
+        "video": capabilities.get('video', False),
+        "audio": capabilities.get('audio', False),
+        "citations": capabilities.get('citations', False)
+    }
+
+    model_config = {
+        "id": model_id,
+        "object": "model",
+        "created": created,
+        "owned_by": "qwen",
+        "permission": [],
+        "root": model_id,
+        "parent": None,
+        "contextWindow": context_window,
+        "reservedOutputTokenSpace": reserved_output_space,
+        "supportsSystemMessage": "system-role",
+        "reasoningCapabilities": {
+            "supportsReasoning": supports_thinking,
+            "canTurnOffReasoning": supports_thinking,
+            "canIOReasoning": supports_thinking,
+            "openSourceThinkTags": ["<think>", "</think>"] if supports_thinking else []
+        },
+        "capabilities": lm_capabilities,
+        "pricing": {"prompt": 0.0001, "completion": 0.0002}
+    }
+    return model_config
+
+
 @lmstudio_bp.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     app = current_app
@@ -191,14 +199,70 @@ def chat_completions():
 
     route_info = f"POST /v1/chat/completions - Chat ({model}, stream: {stream})"
     ui_manager.update_route(route_info, _make_display_data_short(data))
+    include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+    use_cache = not bypass_requested(request.headers)
+    try:
+        n = int(data.get('n') or 1)
+    except (TypeError, ValueError):
+        n = 0
+    if n < 1 or n > FANOUT_MAX_CHOICES:
+        return jsonify({"error": {"message": f"n must be between 1 and {FANOUT_MAX_CHOICES}", "type": "invalid_request_error"}}), 400
+
+    def choice_requests(data):
+        """n>1: n request giống nhau chạy song song (không dùng cache để các choice độc lập)"""
+        requests_data = [dict(data) for _ in range(n)]
+        request_states = [RequestState(str(uuid.uuid4()), model) for _ in range(n)]
+        return requests_data, request_states
+
+    def stream_choices_with_queue(data):
+        request_id = str(uuid.uuid4())
+        if not queue_manager.acquire_lock(request_id, data):
+            yield f"data: {{\"error\": \"Server busy, request timed out\"}}\n\n"
+            return
+        try:
+            model_out = f"{model}:latest" if SERVER_MODE == "ollama" else model
+            requests_data, request_states = choice_requests(data)
+            yield from chat_service.stream_qwen_choices(requests_data, request_states, use_cache=False,
+                                                        model_out=model_out, include_usage=include_usage)
+        except Exception as e:
+            logger.error(f"Error in stream_choices_with_queue: {e}")
+            yield f"data: {{\"error\": \"Stream error: {str(e)}\"}}\n\n"
+        finally:
+            queue_manager.release_lock(request_id)
+
+    def complete_choices_with_queue(data):
+        request_id = str(uuid.uuid4())
+        if not queue_manager.acquire_lock(request_id, data):
+            return jsonify({"error": {"message": "Server busy, please try again later", "type": "server_error", "code": "server_busy"}}), 503
+        try:
+            requests_data, request_states = choice_requests(data)
+            result = chat_service.complete_choices(requests_data, request_states, use_cache=False)
+            if isinstance(result, tuple):
+                return jsonify(result[0]), result[1]
+            if SERVER_MODE == "ollama":
+                result['model'] = model + ":latest"
+                result['system_fingerprint'] = "fp_ollama"
+            else:
+                result['system_fingerprint'] = model
+                result['stats'] = request_states[0].lmstudio_stats()
+            return result
+        finally:
+            queue_manager.release_lock(request_id)
+
+    if n > 1:
+        if stream:
+            return Response(stream_choices_with_queue(data), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        return complete_choices_with_queue(data)
 
     def stream_qwen_response_with_queue(data):
         request_id = str(uuid.uuid4())
+        request_state = RequestState(request_id, model)
+        request_state.mark_queued()
         if not queue_manager.acquire_lock(request_id, data):
             yield f"data: {{\"error\": \"Server busy, request timed out\"}}\n\n"
             return
+        request_state.mark_dequeued()
         try:
-            request_state = RequestState(request_id, model)
             # Prepare client-facing fields
             server_mode = SERVER_MODE
             model_out = f"{model}:latest" if server_mode == "ollama" and not str(model).endswith(":latest") else model
@@ -207,6 +271,21 @@ def chat_completions():
             import time as _time, json as _json
             created_ts = int(_time.time())
             completion_id = f"chatcmpl-{int(_time.time()*1000)%1000}"
+
+            def usage_chunk():
+                # stream_options.include_usage: chunk cuối có usage, choices rỗng
+                request_state.mark_finished()
+                out = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created_ts,
+                    "model": model_out,
+                    "system_fingerprint": system_fingerprint,
+                    "choices": [],
+                    "usage": request_state.openai_usage()
+                }
+                return 'data: ' + _json.dumps(out) + '\n\n'
+
             try:
                 status = queue_manager.get_status()
                 ui_manager.update_queue_status(True, status.get('queue_size', 0))
@@ -215,7 +294,7 @@ def chat_completions():
             with app_obj.app_context():
                 sent_done = False
                 saw_stop = False
-                for chunk in chat_service.stream_qwen_response(data, request_state):
+                for chunk in chat_service.stream_qwen_response(data, request_state, use_cache):
                     try:
                         line = chunk.decode('utf-8') if isinstance(chunk, (bytes, bytearray)) else str(chunk)
                         if not line.startswith('data: '):
@@ -241,6 +320,8 @@ def chat_completions():
                                     }]
                                 }
                                 yield 'data: ' + _json.dumps(out) + '\n\n'
+                            if include_usage:
+                                yield usage_chunk()
                             yield 'data: [DONE]\n\n'
                             sent_done = True
                             break
@@ -266,6 +347,8 @@ def chat_completions():
                                 "finish_reason": finish_reason
                             }]
                         }
+                        if 'x_cache' in obj:
+                            out['x_cache'] = obj['x_cache']
                         yield 'data: ' + _json.dumps(out) + '\n\n'
                     except Exception:
                         # Fallback raw
@@ -289,6 +372,8 @@ def chat_completions():
                             }]
                         }
                         yield 'data: ' + _json.dumps(out) + '\n\n'
+                    if include_usage:
+                        yield usage_chunk()
                     yield 'data: [DONE]\n\n'
         except Exception as e:
             logger.error(f"Error in stream_qwen_response_with_queue: {e}")
@@ -303,15 +388,18 @@ def chat_completions():
 
     def stream_qwen_response_non_streaming_with_queue(data):
         request_id = str(uuid.uuid4())
+        request_state = RequestState(request_id, model)
+        request_state.mark_queued()
         if not queue_manager.acquire_lock(request_id, data):
             return jsonify({"error": {"message": "Server busy, please try again later", "type": "server_error", "code": "server_busy"}}), 503
+        request_state.mark_dequeued()
         try:
             try:
                 status = queue_manager.get_status()
                 ui_manager.update_queue_status(True, status.get('queue_size', 0))
             except Exception:
                 pass
-            result = chat_service.stream_qwen_response_non_streaming(data)
+            result = chat_service.stream_qwen_response_non_streaming(data, request_state, use_cache)
             
             # Handle tuple return (data, status) from service
             if isinstance(result, tuple) and len(result) >= 1:
@@ -324,7 +412,7 @@ def chat_completions():
             else:
                 # LMStudio mode - use exact format
                 result['system_fingerprint'] = model
-                result['stats'] = {}
+                result['stats'] = request_state.lmstudio_stats()
                 
             return result
         except Exception as e:
@@ -339,7 +427,7 @@ def chat_completions():
                 pass
                 
     if stream:
-        return Response(stream_qwen_response_with_queue(data), mimetype='text/plain', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive', 'Content-Type': 'text/event-stream'})
+        return Response(stream_qwen_response_with_queue(data), mimetype='text/plain', headers={'Cache-Control': 'no-cache', 'Content-Type': 'text/event-stream'})
     else:
         return stream_qwen_response_non_streaming_with_queue(data)
 
@@ -351,6 +439,8 @@ def v1_completions_shared():
     app_obj = current_app._get_current_object()
     ui_manager = app.config['ui_manager']
     chat_service = app.config['chat_service']
+    queue_manager = app.config['queue_manager']
+    RequestState = app.config['RequestState']
     server_mode = app.config.get('SERVER_MODE')
 
     data = request.json_data or {}
@@ -360,6 +450,17 @@ def v1_completions_shared():
     if server_mode == "ollama" and isinstance(model, str) and model.endswith(':latest'):
         model = model[:-7]
 
+    # prompt dạng mảng và n>1: mỗi choice là một request chạy song song, index = prompt * n + j
+    prompts = [p if isinstance(p, str) else str(p) for p in prompt] if isinstance(prompt, list) and prompt else [prompt]
+    try:
+        n = int(data.get('n') or 1)
+    except (TypeError, ValueError):
+        n = 0
+    if n < 1 or len(prompts) * n > FANOUT_MAX_CHOICES:
+        return jsonify({"error": {"message": f"Number of choices (prompts x n) must be between 1 and {FANOUT_MAX_CHOICES}", "type": "invalid_request_error"}}), 400
+    prompt = prompts[0]
+    fan_out = len(prompts) * n > 1
+
     route_info = f"POST /v1/completions - Text Completions ({model}, stream: {stream})"
     ui_manager.update_route(route_info, _make_display_data_short(data))
 
@@ -374,19 +475,52 @@ def v1_completions_shared():
 
     system_fingerprint = "fp_ollama" if server_mode == "ollama" else model
     model_out = f"{model}:latest" if server_mode == "ollama" and not str(model).endswith(":latest") else model
+    use_cache = not bypass_requested(request.headers)
+    choice_data = [dict(openai_data, messages=[{"role": "user", "content": p}]) for p in prompts for _ in range(n)]
+    choice_states = [RequestState(str(uuid.uuid4()), model) for _ in choice_data]
+    # n>1: các choice của cùng prompt phải độc lập nên không dùng cache
+    choice_cache = use_cache and n == 1
+
+    def _total_usage():
+        for rs in choice_states:
+            rs.mark_finished()
+        return chat_service.choices_usage(choice_states, n)
 
     if stream:
         import json as _json, time as _time
         created_ts = int(_time.time())
         completion_id = f"cmpl-{int(_time.time()*1000) % 1000}"
+        include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+        request_state = choice_states[0]
 
         def _to_sse():
+            # Fan-out chiếm upstream như chat n>1 nên cũng đi qua queue
+            queue_id = str(uuid.uuid4()) if fan_out else None
+            if queue_id is not None and not queue_manager.acquire_lock(queue_id, data):
+                yield f"data: {{\"error\": \"Server busy, request timed out\"}}\n\n"
+                return
+            try:
+                yield from _completion_chunks()
+            finally:
+                if queue_id is not None:
+                    queue_manager.release_lock(queue_id)
+
+        def _completion_chunks():
             with app_obj.app_context():
-                for line in chat_service.stream_qwen_response(openai_data):
+                if fan_out:
+                    source = chat_service.stream_qwen_choices(choice_data, choice_states, choice_cache,
+                                                              choices_per_prompt=n)
+                else:
+                    source = chat_service.stream_qwen_response(openai_data, request_state, use_cache)
+                for line in source:
                     try:
                         obj = _json.loads(line[6:]) if isinstance(line, (str, bytes)) and str(line).startswith('data: ') else _json.loads(line)
                     except Exception:
                         continue
+                    if 'error' in obj and 'index' in obj:
+                        # Choice lỗi khi fan-out: chuyển tiếp lỗi của index đó như chat n>1
+                        yield "data: " + _json.dumps({"error": obj['error'], "index": obj['index']}) + "\n\n"
+                        continue
                     text_piece = ''
                     try:
                         delta = (obj.get('choices') or [{}])[0].get('delta') or {}
@@ -394,21 +528,61 @@ def v1_completions_shared():
                     except Exception:
                         text_piece = ''
                     finish_reason = (obj.get('choices') or [{}])[0].get('finish_reason')
+                    index = (obj.get('choices') or [{}])[0].get('index', obj.get('index', 0))
                     out = {
                         "id": completion_id,
                         "object": "text_completion",
                         "created": created_ts,
-                        "choices": [{"text": text_piece, "index": 0, "finish_reason": finish_reason}],
+                        "choices": [{"text": text_piece, "index": index, "finish_reason": finish_reason}],
                         "model": model_out,
                         "system_fingerprint": system_fingerprint
                     }
+                    if 'x_cache' in obj:
+                        out['x_cache'] = obj['x_cache']
                     yield "data: " + _json.dumps(out) + "\n\n"
+                if include_usage:
+                    usage_out = {
+                        "id": completion_id,
+                        "object": "text_completion",
+                        "created": created_ts,
+                        "choices": [],
+                        "model": model_out,
+                        "system_fingerprint": system_fingerprint,
+                        "usage": _total_usage()
+                    }
+                    yield "data: " + _json.dumps(usage_out) + "\n\n"
                 yield "data: [DONE]\n\n"
 
-        return Response(_to_sse(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
+        return Response(_to_sse(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
     # Non-streaming
-    service_resp = chat_service.stream_qwen_response_non_streaming(openai_data)
+    request_state = choice_states[0]
+    if fan_out:
+        queue_id = str(uuid.uuid4())
+        if not queue_manager.acquire_lock(queue_id, data):
+            return jsonify({"error": {"message": "Server busy, please try again later", "type": "server_error", "code": "server_busy"}}), 503
+        try:
+            service_resp = chat_service.complete_choices(choice_data, choice_states, choice_cache, choices_per_prompt=n)
+        finally:
+            queue_manager.release_lock(queue_id)
+        if isinstance(service_resp, tuple):
+            return jsonify(service_resp[0]), service_resp[1]
+        non_stream_out = {
+            "id": f"cmpl-{int(__import__('time').time()*1000) % 1000}",
+            "object": "text_completion",
+            "created": service_resp['created'],
+            "model": model_out,
+            "system_fingerprint": system_fingerprint,
+            "choices": [dict({"text": c['message']['content'], "index": c['index'], "finish_reason": c['finish_reason']},
+                             **({"error": c['error']} if 'error' in c else {}))
+                        for c in service_resp['choices']],
+            "usage": service_resp['usage']
+        }
+        if server_mode != "ollama":
+            non_stream_out['stats'] = request_state.lmstudio_stats()
+        return jsonify(non_stream_out)
+
+    service_resp = chat_service.stream_qwen_response_non_streaming(openai_data, request_state, use_cache)
     # Normalize tuple (data, status) to dict
     if isinstance(service_resp, tuple) and len(service_resp) >= 1:
         service_resp = service_resp[0]
@@ -433,10 +607,12 @@ def v1_completions_shared():
         "choices": [{"text": content, "index": 0, "finish_reason": "stop"}],
         "usage": usage
     }
+    if isinstance(service_resp, dict) and 'x_cache' in service_resp:
+        non_stream_out['x_cache'] = service_resp['x_cache']
     
     # Add stats field for LMStudio mode
     if server_mode != "ollama":
-        non_stream_out['stats'] = {}
+        non_stream_out['stats'] = request_state.lmstudio_stats()
     
     return jsonify(non_stream_out)
 
@@ -462,16 +638,16 @@ def v1_embeddings():
     if server_mode == "ollama" and isinstance(effective_model, str) and effective_model.endswith(':latest'):
         effective_model = effective_model[:-7]
 
-    # Deterministic pseudo-embeddings similar to ollama /api/embed
-    import time as _t, hashlib, random
-    start_ns = _t.perf_counter_ns()
-    dim = 768
+    embedding_service = app.config['embedding_service']
+    try:
+        dimensions = parse_dimensions(data.get('dimensions'), embedding_service.dim)
+        encoding_format = parse_encoding_format(data.get('encoding_format'))
+    except ValueError as e:
+        return jsonify({"error": {"message": str(e), "type": "invalid_request_error"}}), 400
 
-    def _embed_text(text: str):
-        seed_bytes = hashlib.sha256(text.encode('utf-8', 'ignore')).digest()
-        seed_int = int.from_bytes(seed_bytes[:8], 'big', signed=False)
-        rnd = random.Random(seed_int)
-        return [rnd.uniform(-0.05, 0.05) for _ in range(dim)]
+    # Deterministic pseudo-embeddings (shared engine with ollama /api/embed)
+    import time as _t
+    start_ns = _t.perf_counter_ns()
 
     # Apply optional truncate hint (no-op for now; placeholder for parity)
     texts = inp
@@ -479,13 +655,11 @@ def v1_embeddings():
         # Simple safe cap to emulate truncation behavior (does not affect determinism much)
         texts = [s if not isinstance(s, str) else s[:8192] for s in texts]
 
-    embeddings = [_embed_text(s if isinstance(s, str) else str(s)) for s in texts]
+    matrix = truncate_dimensions(embedding_service.embed(texts), dimensions, embedding_service.fold_dimensions)
+    embeddings = encode_vectors(matrix, encoding_format)
 
-    # Usage estimates (prompt tokens ~= whitespace-separated tokens)
-    try:
-        prompt_tokens = sum(len(str(x).split()) for x in texts)
-    except Exception:
-        prompt_tokens = 0
+    # Usage (shared token counter)
+    prompt_tokens = sum(count_tokens(x) for x in texts)
 
     total_duration = _t.perf_counter_ns() - start_ns
     _ = total_duration  # kept for parity; not exposed in OpenAI embedding response
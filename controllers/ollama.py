@@ -1,6 +1,9 @@
 from flask import Blueprint, jsonify, Response, request, current_app
 from utils.request_utils import parse_json_request
 from utils.context_manager import context_manager
+from utils.embedding_codec import parse_dimensions, truncate_dimensions
+from utils.token_counter import count_tokens
+from utils.response_cache import bypass_requested
 import logging
 
 logger = logging.getLogger(__name__)
@@ -81,28 +84,29 @@ def v1_list_models_shared():
     route_info = "GET /v1/models - List Models (shared)"
 
     models = get_cached_qwen_models()
+    metadata_cache = app.config['metadata_cache']
+
+    def build():
+        if SERVER_MODE == "ollama":
+            formatted_models = []
+            for model in models:
+                model_id = model.get('id', '')
+                if model_id:
+                    model_name_with_latest = f"{model_id}:latest"
+                    formatted_models.append({
+                        "id": model_name_with_latest,
+                        "object": "model",
+                        "created": metadata_cache.updated_at,
+                        "owned_by": "library"
+                    })
+        else:
+            formatted_models = models
+        return {
+            "object": "list",
+            "data": formatted_models
+        }
 
-    if SERVER_MODE == "ollama":
-        formatted_models = []
-        for model in models:
-            model_id = model.get('id', '')
-            if model_id:
-                model_name_with_latest = f"{model_id}:latest"
-                formatted_models.append({
-                    "id": model_name_with_latest,
-                    "object": "model",
-                    "created": int(__import__('time').time()),
-                    "owned_by": "library"
-                })
-    else:
-        formatted_models = models
-
-    response = jsonify({
-        "object": "list",
-        "data": formatted_models
-    })
-    response.headers['Content-Type'] = 'application/json'
-    return response
+    return metadata_cache.respond(('v1/models', SERVER_MODE), build)
 
 @ollama_bp.route('/api/tags', methods=['GET'])
 def ollama_list_models():
@@ -116,36 +120,41 @@ def ollama_list_models():
 
     try:
         qwen_models = get_cached_qwen_models()
-        ollama_models = []
-        from datetime import datetime
-        for model in qwen_models:
-            model_id = model.get('id', '')
-            if model_id:
-                modified_at = datetime.now().isoformat() + "+07:00"
-                model_name_with_latest = f"{model_id}:latest"
-                ollama_models.append({
-                    "name": model_name_with_latest,
-                    "model": model_name_with_latest,
-                    "modified_at": modified_at,
-                    "size": 4661224676,
-                    "digest": "365c0bd3c000a25d28ddbf732fe1c6add414de7275464c4e4d1c3b5fcb5d8ad1",
-                    "details": {
-                        "parent_model": "",
-                        "format": "gguf",
-                        "family": "qwen",
-                        "families": ["qwen"],
-                        "parameter_size": "235B",
-                        "quantization_level": "Q4_0"
-                    }
-                })
-
-        return jsonify({"models": ollama_models})
+        metadata_cache = app.config['metadata_cache']
+        return metadata_cache.respond('api/tags', lambda: _tags_body(qwen_models, metadata_cache.updated_at))
 
     except Exception as e:
         logger.error(f"Error listing Ollama models: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+def _tags_body(qwen_models, updated_at):
+    """Body /api/tags; modified_at = thời điểm danh sách model thay đổi lần cuối"""
+    from datetime import datetime
+    modified_at = datetime.fromtimestamp(updated_at).isoformat() + "+07:00"
+    ollama_models = []
+    for model in qwen_models:
+        model_id = model.get('id', '')
+        if model_id:
+            model_name_with_latest = f"{model_id}:latest"
+            ollama_models.append({
+                "name": model_name_with_latest,
+                "model": model_name_with_latest,
+                "modified_at": modified_at,
+                "size": 4661224676,
+                "digest": "365c0bd3c000a25d28ddbf732fe1c6add414de7275464c4e4d1c3b5fcb5d8ad1",
+                "details": {
+                    "parent_model": "",
+                    "format": "gguf",
+                    "family": "qwen",
+                    "families": ["qwen"],
+                    "parameter_size": "235B",
+                    "quantization_level": "Q4_0"
+                }
+            })
+    return {"models": ollama_models}
+
+
 @ollama_bp.route('/api/version', methods=['GET'])
 def ollama_version():
     app = current_app
@@ -153,7 +162,7 @@ def ollama_version():
     if SERVER_MODE != "ollama":
         return jsonify({"error": "Endpoint not available in current mode"}), 404
 
-    return jsonify({"version":"0.11.7"})
+    return app.config['metadata_cache'].respond('api/version', lambda: {"version": "0.11.7"})
 
 
 @ollama_bp.route('/api/ps', methods=['GET'])
@@ -163,40 +172,59 @@ def ollama_list_running_models():
     if SERVER_MODE != "ollama":
         return jsonify({"error": "Endpoint not available in current mode"}), 404
 
-    get_cached_qwen_models = app.config['get_cached_qwen_models']
+    session_table = app.config['session_table']
     logger = app.config['logger']
 
     try:
-        qwen_models = get_cached_qwen_models()
-        from datetime import datetime, timedelta
-        running_models = []
-        for model in qwen_models:
-            model_id = model.get('id', '')
-            if model_id:
-                expires_at = (datetime.now() + timedelta(minutes=30)).isoformat() + "+07:00"
-                model_name_with_latest = f"{model_id}:latest"
-                running_models.append({
-                    "name": model_name_with_latest,
-                    "model": model_name_with_latest,
-                    "size": 6654289920,
-                    "digest": "365c0bd3c000a25d28ddbf732fe1c6add414de7275464c4e4d1c3b5fcb5d8ad1",
-                    "details": {
-                        "parent_model": "",
-                        "format": "gguf",
-                        "family": "qwen",
-                        "families": ["qwen"],
-                        "parameter_size": "235B",
-                        "quantization_level": "Q4_0"
-                    },
-                    "expires_at": expires_at,
-                    "size_vram": 6654289920
-                })
-        return jsonify({"models": running_models})
+        # Một entry mỗi model có session ấm, expires_at = hạn xa nhất của các session
+        latest_expiry = {}
+        for session in session_table.live_sessions():
+            model_id = session['model']
+            expires = session['expires_at']
+            if model_id in latest_expiry:
+                current = latest_expiry[model_id]
+                # None = giữ vô hạn, luôn là hạn xa nhất
+                if current is None or (expires is not None and expires <= current):
+                    continue
+            latest_expiry[model_id] = expires
+        # Body chỉ dựng lại khi tập (model, hạn) của session ấm thay đổi
+        return app.config['metadata_cache'].respond('api/ps', lambda: _ps_body(latest_expiry),
+                                                    version=tuple(latest_expiry.items()))
     except Exception as e:
         logger.error(f"Error listing running Ollama models: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+def _ps_body(latest_expiry):
+    """Body /api/ps từ {model_id: hạn xa nhất (None = vô hạn)}"""
+    from datetime import datetime, timezone
+    running_models = []
+    for model_id, expires in latest_expiry.items():
+        if expires is None:
+            # keep_alive âm: giữ vô hạn
+            expires_at = datetime.max.replace(tzinfo=timezone.utc).isoformat()
+        else:
+            expires_at = datetime.fromtimestamp(expires, tz=timezone.utc).astimezone().isoformat()
+        model_name_with_latest = f"{model_id}:latest"
+        running_models.append({
+            "name": model_name_with_latest,
+            "model": model_name_with_latest,
+            "size": 6654289920,
+            "digest": "365c0bd3c000a25d28ddbf732fe1c6add414de7275464c4e4d1c3b5fcb5d8ad1",
+            "details": {
+                "parent_model": "",
+                "format": "gguf",
+                "family": "qwen",
+                "families": ["qwen"],
+                "parameter_size": "235B",
+                "quantization_level": "Q4_0"
+            },
+            "expires_at": expires_at,
+            "size_vram": 6654289920
+        })
+    return {"models": running_models}
+
+
 @ollama_bp.route('/api/show', methods=['POST'])
 @parse_json_request()
 def ollama_show_model():
@@ -223,14 +251,20 @@ def ollama_show_model():
         if not target_model:
             return jsonify({"error": f"Model {model_name} not found"}), 404
 
-        model_info = target_model.get('info', {})
-        meta = model_info.get('meta', {})
-        
-        # Demo license - short version for testing
-        demo_license = "DEMO LICENSE AGREEMENT\n\nThis is a demo model for testing purposes.\n\nBy using this model, you agree to use it responsibly and in accordance with applicable laws.\n\nThis model is provided 'as is' without any warranties."
-        
-        # Generate modelfile content
-        modelfile_content = f"""# Modelfile generated by "ollama show"
+        meta = target_model.get('info', {}).get('meta', {})
+        return app.config['metadata_cache'].respond(('api/show', model_name), lambda: _show_body(model_name, meta))
+    except Exception as e:
+        logger.error(f"Error showing Ollama model {model_name}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def _show_body(model_name, meta):
+    """Body /api/show của một model (modelfile/template/model_info giả lập dạng gguf)"""
+    # Demo license - short version for testing
+    demo_license = "DEMO LICENSE AGREEMENT\n\nThis is a demo model for testing purposes.\n\nBy using this model, you agree to use it responsibly and in accordance with applicable laws.\n\nThis model is provided 'as is' without any warranties."
+    
+    # Generate modelfile content
+    modelfile_content = f"""# Modelfile generated by "ollama show"
 # To build a new Modelfile based on this, replace FROM with:
 # FROM {model_name}:latest
 
@@ -248,63 +282,60 @@ PARAMETER stop "<|end_header_id|>"
 PARAMETER stop "<|eot_id|>"
 LICENSE "{demo_license}\""""
 
-        ollama_model_info = {
-            "license": demo_license,
-            "modelfile": modelfile_content,
-            "parameters": f"num_keep                       24\nstop                           \"<|start_header_id|>\"\nstop                           \"<|end_header_id|>\"\nstop                           \"<|eot_id|>\"",
-            "template": "{{ if .System }}<|start_header_id|>system<|end_header_id|>\n\n{{ .System }}<|eot_id|>{{ end }}{{ if .Prompt }}<|start_header_id|>user<|end_header_id|>\n\n{{ .Prompt }}<|eot_id|>{{ end }}<|start_header_id|>assistant<|end_header_id|>\n\n{{ .Response }}<|eot_id|>",
-            "details": {
-                "parent_model": "",
-                "format": "gguf",
-                "family": "qwen",
-                "families": ["qwen"],
-                "parameter_size": str(meta.get('max_context_length', 131072)),
-                "quantization_level": "Q4_0"
-            },
-            "model_info": {
-                "general.architecture": "qwen",
-                "general.file_type": 2,
-                "general.parameter_count": meta.get('max_context_length', 131072) * 1000,
-                "general.quantization_version": 2,
-                "qwen.attention.head_count": 32,
-                "qwen.attention.head_count_kv": 8,
-                "qwen.attention.layer_norm_rms_epsilon": 0.00001,
-                "qwen.block_count": 32,
-                "qwen.context_length": meta.get('max_context_length', 131072),
-                "qwen.embedding_length": 8192,
-                "qwen.feed_forward_length": meta.get('max_context_length', 131072),
-                "qwen.rope.dimension_count": 128,
-                "qwen.rope.freq_base": 500000,
-                "qwen.vocab_size": meta.get('max_context_length', 131072),
-                "tokenizer.ggml.bos_token_id": 128000,
-                "tokenizer.ggml.eos_token_id": 128009,
-                "tokenizer.ggml.merges": None,
-                "tokenizer.ggml.model": "gpt2",
-                "tokenizer.ggml.pre": "qwen-bpe",
-                "tokenizer.ggml.token_type": None,
-                "tokenizer.ggml.tokens": None
-            },
-            "tensors": [
-                {"name": "token_embd.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.attn_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', meta.get('max_context_length', 131072))]},
-                {"name": "blk.0.ffn_down.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.ffn_gate.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.ffn_up.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.ffn_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.attn_k.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.attn_output.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.attn_q.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "blk.0.attn_v.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "output.weight", "type": "Q6_K", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
-                {"name": "output_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', 131072)]}
-            ],
-            "capabilities": ["completion"],
-            "modified_at": "2025-01-27T12:00:00.0000000+07:00"
-        }
-        return jsonify(ollama_model_info)
-    except Exception as e:
-        logger.error(f"Error showing Ollama model {model_name}: {e}")
-        return jsonify({"error": str(e)}), 500
+    ollama_model_info = {
+        "license": demo_license,
+        "modelfile": modelfile_content,
+        "parameters": f"num_keep                       24\nstop                           \"<|start_header_id|>\"\nstop                           \"<|end_header_id|>\"\nstop                           \"<|eot_id|>\"",
+        "template": "{{ if .System }}<|start_header_id|>system<|end_header_id|>\n\n{{ .System }}<|eot_id|>{{ end }}{{ if .Prompt }}<|start_header_id|>user<|end_header_id|>\n\n{{ .Prompt }}<|eot_id|>{{ end }}<|start_header_id|>assistant<|end_header_id|>\n\n{{ .Response }}<|eot_id|>",
+        "details": {
+            "parent_model": "",
+            "format": "gguf",
+            "family": "qwen",
+            "families": ["qwen"],
+            "parameter_size": str(meta.get('max_context_length', 131072)),
+            "quantization_level": "Q4_0"
+        },
+        "model_info": {
+            "general.architecture": "qwen",
+            "general.file_type": 2,
+            "general.parameter_count": meta.get('max_context_length', 131072) * 1000,
+            "general.quantization_version": 2,
+            "qwen.attention.head_count": 32,
+            "qwen.attention.head_count_kv": 8,
+            "qwen.attention.layer_norm_rms_epsilon": 0.00001,
+            "qwen.block_count": 32,
+            "qwen.context_length": meta.get('max_context_length', 131072),
+            "qwen.embedding_length": 8192,
+            "qwen.feed_forward_length": meta.get('max_context_length', 131072),
+            "qwen.rope.dimension_count": 128,
+            "qwen.rope.freq_base": 500000,
+            "qwen.vocab_size": meta.get('max_context_length', 131072),
+            "tokenizer.ggml.bos_token_id": 128000,
+            "tokenizer.ggml.eos_token_id": 128009,
+            "tokenizer.ggml.merges": None,
+            "tokenizer.ggml.model": "gpt2",
+            "tokenizer.ggml.pre": "qwen-bpe",
+            "tokenizer.ggml.token_type": None,
+            "tokenizer.ggml.tokens": None
+        },
+        "tensors": [
+            {"name": "token_embd.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.attn_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', meta.get('max_context_length', 131072))]},
+            {"name": "blk.0.ffn_down.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.ffn_gate.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.ffn_up.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.ffn_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.attn_k.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.attn_output.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.attn_q.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "blk.0.attn_v.weight", "type": "Q4_0", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "output.weight", "type": "Q6_K", "shape": [meta.get('max_context_length', 131072), meta.get('max_context_length', 131072)]},
+            {"name": "output_norm.weight", "type": "F32", "shape": [meta.get('max_context_length', 131072)]}
+        ],
+        "capabilities": ["completion"],
+        "modified_at": "2025-01-27T12:00:00.0000000+07:00"
+    }
+    return ollama_model_info
 
 
 @ollama_bp.route('/api/generate', methods=['POST'])
@@ -339,13 +370,27 @@ def ollama_generate():
     route_info = f"POST /api/generate - Ollama Generate ({model}, stream: {stream})"
     ui_manager.update_route(route_info, _make_display_data_short(data))
 
+    # `context` là handle do server trả về ở lần trước: tiếp tục chat upstream đó
+    client_key = request.remote_addr
+    use_cache = not bypass_requested(request.headers)
+    session_cache = app.config['session_cache']
+    session_key = session_cache.decode_context(context)
+    if session_key is not None and session_cache.get(session_key, model) is None:
+        logger.info("Ollama context handle expired or unknown, starting a new session")
+        session_key = None
+
     messages = []
-    if system:
-        messages.append({"role": "system", "content": system})
-    if prompt:
-        messages.append({"role": "prompt", "content": prompt})
-    if template:
-        messages.append({"role": "template", "content": template})
+    if session_key is not None:
+        # Upstream đã có system/lịch sử: chỉ gửi prompt mới
+        if prompt:
+            messages.append({"role": "prompt", "content": prompt})
+    else:
+        if system:
+            messages.append({"role": "system", "content": system})
+        if prompt:
+            messages.append({"role": "prompt", "content": prompt})
+        if template:
+            messages.append({"role": "template", "content": template})
 
     # Xử lý context limiting cho generate endpoint
     try:
@@ -390,69 +435,19 @@ def ollama_generate():
         openai_data["response_format"] = {"type": "json_object"}
 
     if stream:
-        import json as _json
-        def _transform_stream():
-            for line in ollama_service.stream_ollama_response(openai_data):
-                try:
-                    obj = _json.loads(line)
-                except Exception:
-                    yield line
-                    continue
-                # If already in expected format with 'response', pass through and normalize model
-                if 'response' in obj:
-                    obj['model'] = data.get('model', model)
-                    yield _json.dumps(obj) + "\n"
-                    continue
-                # If error from service, forward as-is
-                if 'error' in obj:
-                    yield _json.dumps(obj) + "\n"
-                    continue
-                transformed = {
-                    "model": data.get('model', model)
-                }
-                if 'created_at' in obj:
-                    transformed["created_at"] = obj["created_at"]
-                # Map message.content -> response if present
-                msg = obj.get('message') or {}
-                if isinstance(msg, dict) and 'content' in msg:
-                    transformed['response'] = msg.get('content')
-                # done flags and reasons
-                if 'done' in obj:
-                    transformed['done'] = obj['done']
-                if 'done_reason' in obj:
-                    transformed['done_reason'] = obj['done_reason']
-                # include context if present; otherwise empty list for compatibility
-                if 'context' in obj:
-                    transformed['context'] = obj['context']
-                else:
-                    transformed['context'] = []
-                # timings / counters if available
-                for k in ("total_duration","load_duration","prompt_eval_count","prompt_eval_duration","eval_count","eval_duration"):
-                    if k in obj:
-                        transformed[k] = obj[k]
-                yield _json.dumps(transformed) + "\n"
-        return Response(_transform_stream(), mimetype='application/json', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'})
+        return Response(
+            ollama_service.stream_ollama_response(openai_data, session_key=session_key, with_context=True,
+                                                  client_key=client_key, keep_alive=keep_alive,
+                                                  target="generate", model_name=data.get('model', model),
+                                                  use_cache=use_cache),
+            mimetype='application/json',
+            headers={'Cache-Control': 'no-cache'}
+        )
     else:
-        # Non-streaming: adapt service response shape to Ollama /generate
-        service_resp = ollama_service.stream_ollama_response_non_streaming(openai_data)
-        try:
-            created_at = service_resp.get('created_at')
-            message = service_resp.get('message') or {}
-            content = message.get('content', '')
-            out = {
-                "model": data.get('model', model),
-                "created_at": created_at,
-                "response": content,
-                "done": True,
-                "done_reason": service_resp.get('done_reason', 'stop'),
-                "context": service_resp.get('context', [])
-            }
-            for k in ("total_duration","load_duration","prompt_eval_count","prompt_eval_duration","eval_count","eval_duration"):
-                if k in service_resp:
-                    out[k] = service_resp[k]
-            return jsonify(out)
-        except Exception:
-            return jsonify(service_resp)
+        return ollama_service.stream_ollama_response_non_streaming(openai_data, session_key=session_key, with_context=True,
+                                                                   client_key=client_key, keep_alive=keep_alive,
+                                                                   target="generate", model_name=data.get('model', model),
+                                                                   use_cache=use_cache)
 
 
 @ollama_bp.route('/api/chat', methods=['POST'])
@@ -472,6 +467,9 @@ def ollama_chat():
     messages = data.get('messages', [])
     stream = data.get('stream', True)
     tools = data.get('tools', [])
+    keep_alive = data.get('keep_alive')
+    client_key = request.remote_addr
+    use_cache = not bypass_requested(request.headers)
     if model.endswith(':latest'):
         model = model[:-7]
 
@@ -510,12 +508,14 @@ def ollama_chat():
 
     if stream:
         return Response(
-            ollama_service.stream_ollama_response(openai_data),
+            ollama_service.stream_ollama_response(openai_data, client_key=client_key, keep_alive=keep_alive,
+                                                  use_cache=use_cache),
             mimetype='application/json',
-            headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'}
+            headers={'Cache-Control': 'no-cache'}
         )
     else:
-        return ollama_service.stream_ollama_response_non_streaming(openai_data)
+        return ollama_service.stream_ollama_response_non_streaming(openai_data, client_key=client_key, keep_alive=keep_alive,
+                                                                   use_cache=use_cache)
 
 
 @ollama_bp.route('/api/delete', methods=['DELETE'])
@@ -582,7 +582,7 @@ def ollama_create_model():
     return Response(
         _stream_create(),
         mimetype='application/json',
-        headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive'}
+        headers={'Cache-Control': 'no-cache'}
     )
 
 
@@ -600,22 +600,22 @@ def ollama_embed():
     if isinstance(inp, str):
         inp = [inp]
 
-    # Generate deterministic pseudo-embeddings per input (non-zero, stable)
-    import time as _t, hashlib, random
-    start_ns = _t.perf_counter_ns()
-    dim = 768
-
-    def _embed_text(text: str):
-        seed_bytes = hashlib.sha256(text.encode('utf-8', 'ignore')).digest()
-        seed_int = int.from_bytes(seed_bytes[:8], 'big', signed=False)
-        rnd = random.Random(seed_int)
-        # Small range similar to typical normalized embeddings
-        return [rnd.uniform(-0.05, 0.05) for _ in range(dim)]
+    embedding_service = app.config['embedding_service']
+    try:
+        dimensions = parse_dimensions(data.get('dimensions'), embedding_service.dim)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    embeddings = [_embed_text(s if isinstance(s, str) else str(s)) for s in inp]
+    # Deterministic pseudo-embeddings per input (shared engine with /v1/embeddings)
+    import time as _t
+    start_ns = _t.perf_counter_ns()
+    texts = [s if isinstance(s, str) else str(s) for s in inp]
+    embeddings = truncate_dimensions(embedding_service.embed(texts), dimensions,
+                                     embedding_service.fold_dimensions).tolist()
     total_duration = _t.perf_counter_ns() - start_ns
-    load_duration = int(total_duration * 0.15)
-    prompt_eval_count = sum(len(str(x).split()) for x in inp)
+    # Không có bước load model: load_duration = 0, toàn bộ thời gian là embed
+    load_duration = 0
+    prompt_eval_count = sum(count_tokens(x) for x in texts)
 
     # Normalize model name by removing :latest suffix
     if isinstance(model, str) and model.endswith(':latest'):
@@ -15,14 +15,28 @@ from utils.logging_config import setup_logging
 from utils.queue_manager import queue_manager
 from utils.ui_manager import ui_manager
 from utils.chat_manager import chat_manager
+from utils.session_cache import session_cache
+from utils.session_table import session_table
+from utils.response_cache import response_cache
+from utils.semantic_cache import semantic_cache
+from utils.metadata_cache import metadata_cache
+from utils.tracing import tracer
+from utils.profiler import sampling_profiler
+from utils.request_ledger import RequestLedger, LedgerMiddleware
+from config import REQUEST_LEDGER_SIZE
+from utils.metrics import metrics, HTTP_REQUESTS, HTTP_DURATION, QUEUE_DEPTH, QUEUE_PROCESSING, CACHE_LOOKUPS, CACHE_HIT_RATIO
 from services.qwen_service import qwen_service
 from services.chat_service import chat_service
 from services.ollama_service import ollama_service
+from services.embedding_service import embedding_service
+from services.batch_service import batch_service
 from models.request_state import RequestState
 from werkzeug.serving import make_server
 import threading
 from controllers.lmstudio import lmstudio_bp
 from controllers.ollama import ollama_bp
+from controllers.admin import admin_bp
+from controllers.batch import batch_bp
 
 # Parse command line arguments
 def parse_arguments():
@@ -67,20 +81,59 @@ app.config['JSONIFY_MIMETYPE'] = 'application/json'
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 app.config['JSON_SORT_KEYS'] = False
 
+# Ledger các request gần nhất (/debug/requests): middleware đo cả thời gian stream + byte trả về
+request_ledger = RequestLedger(REQUEST_LEDGER_SIZE)
+app.wsgi_app = LedgerMiddleware(app.wsgi_app, request_ledger)
+
 # Expose shared services/state to controllers via app.config
 app.config.update({
     'ui_manager': ui_manager,
     'qwen_service': qwen_service,
     'chat_service': chat_service,
     'ollama_service': ollama_service,
+    'embedding_service': embedding_service,
     'queue_manager': queue_manager,
+    'session_cache': session_cache,
+    'session_table': session_table,
+    'batch_service': batch_service,
+    'response_cache': response_cache,
+    'semantic_cache': semantic_cache,
+    'metadata_cache': metadata_cache,
+    'metrics': metrics,
+    'tracer': tracer,
+    'sampling_profiler': sampling_profiler,
+    'request_ledger': request_ledger,
     'RequestState': RequestState,
     'SERVER_MODE': None,
 })
 
+# Metrics đọc thẳng trạng thái queue/cache lúc scrape /metrics
+def _cache_lookup_counts():
+    return {
+        ("exact", "hit"): response_cache.hits,
+        ("exact", "miss"): response_cache.misses,
+        ("exact", "bypass"): response_cache.bypasses,
+        ("semantic", "hit"): semantic_cache.hits,
+        ("semantic", "miss"): semantic_cache.misses,
+    }
+
+def _cache_hit_ratios():
+    ratios = {}
+    for name, cache in (("exact", response_cache), ("semantic", semantic_cache)):
+        lookups = cache.hits + cache.misses
+        ratios[(name,)] = cache.hits / lookups if lookups else 0.0
+    return ratios
+
+QUEUE_DEPTH.set_callback(lambda: len(queue_manager.chat_queue))
+QUEUE_PROCESSING.set_callback(lambda: int(queue_manager.current_processing))
+CACHE_LOOKUPS.set_callback(_cache_lookup_counts)
+CACHE_HIT_RATIO.set_callback(_cache_hit_ratios)
+
 # Register blueprints
 app.register_blueprint(lmstudio_bp)
 app.register_blueprint(ollama_bp)
+app.register_blueprint(admin_bp)
+app.register_blueprint(batch_bp)
 
 # Tăng giới hạn JSON serialization
 import sys
@@ -107,6 +160,8 @@ def get_cached_qwen_models(force_refresh: bool = False):
                 models = qwen_service.get_models_from_qwen()
                 MODELS_CACHE = models or []
                 MODELS_CACHE_TIME = int(time.time())
+                # Body metadata dựng sẵn chỉ bị xóa khi danh sách model thực sự đổi
+                metadata_cache.set_catalogue(MODELS_CACHE)
             return MODELS_CACHE
     except Exception as e:
         logger.error(f"Error getting cached models: {e}")
@@ -332,6 +387,11 @@ def start_embedded(host: str, port: int):
         HTTP_THREAD = threading.Thread(target=HTTP_SERVER.serve_forever, daemon=True)
         HTTP_THREAD.start()
         _ui_log(f"🟢 Flask started (embedded) on {host}:{port}")
+        # Chạy tiếp các batch dở dang từ lần chạy trước
+        try:
+            batch_service.resume()
+        except Exception as e:
+            _ui_log(f"Failed to resume batches: {e}", level="error")
         return True
     except Exception as e:
         HTTP_SERVER = None
@@ -366,6 +426,15 @@ def stop_embedded(timeout: float = 2.0):
 @app.before_request
 def before_request():
     """Override để xử lý request không có Content-Type"""
+    # Request id (X-Request-ID của client nếu có) cho log + root span của trace (nếu được sample)
+    g.request_id = tracer.begin_request(request.headers.get('X-Request-ID'))
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    record = request_ledger.current()
+    if record is not None:
+        record.request_id = g.request_id
+        record.endpoint = rule
+    g._trace_span = tracer.start_trace(f"{request.method} {rule}", {"http.method": request.method,
+                                                                    "http.route": rule})
     # Log request cơ bản và đánh dấu thời điểm bắt đầu
     try:
         g._req_start_time = time.time()
@@ -421,8 +490,21 @@ def after_request(response):
     try:
         start = getattr(g, '_req_start_time', None)
         elapsed_ms = int((time.time() - start) * 1000) if start else -1
+        # Label theo route pattern (không theo path thật) để số series có giới hạn
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        HTTP_REQUESTS.inc(endpoint, request.method, str(response.status_code))
+        if start:
+            HTTP_DURATION.observe(elapsed_ms / 1000.0, endpoint)
     except Exception:
         pass
+    request_id = getattr(g, 'request_id', None)
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    span = getattr(g, '_trace_span', None)
+    if span is not None:
+        span.set("http.status_code", response.status_code)
+        # Stream: span kết thúc khi body đã gửi xong (hoặc client ngắt)
+        response.call_on_close(span.end)
     return response
 
 @app.route('/', methods=['GET'])
@@ -642,6 +724,9 @@ def internal_error(error):
     ui_manager.update_route(route_info)
     
     logger.error(f"Internal server error: {error}")
+    record = request_ledger.current()
+    if record is not None:
+        record.error = type(getattr(error, 'original_exception', None) or error).__name__
     queue_manager.release_lock("error_handler")
     return jsonify({
         "error": {
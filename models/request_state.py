@@ -1,5 +1,8 @@
 import time
 import logging
+from utils.token_counter import count_tokens, count_message_tokens
+from utils.metrics import TTFT, INTER_TOKEN, TOKENS_PER_SECOND, OUTPUT_TOKENS
+from utils.request_ledger import RequestLedger
 
 logger = logging.getLogger(__name__)
 
@@ -12,8 +15,141 @@ class RequestState:
         self.current_phase = None
         self.chunk_count = 0
         self.start_time = time.time()
+        # Mốc thời gian (perf_counter_ns) để tính duration thật cho response
+        self.created_ns = time.perf_counter_ns()
+        self.queued_ns = None
+        self.dequeued_ns = None
+        self.upstream_start_ns = None
+        self.connected_ns = None
+        self.first_token_ns = None
+        self.last_output_ns = None
+        self.finished_ns = None
+        # Số token (ước lượng bằng utils.token_counter)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Retry parent_id và lỗi upstream (tên class[:code]) cho /debug/requests
+        self.retries = 0
+        self.error = None
+        # Phát lại từ response cache: không ghi vào histogram TTFT/token của upstream
+        self.replayed = False
+        RequestLedger.attach(self)
     
     def log_phase_change(self, phase):
         """Log khi phase thay đổi"""
         if phase and self.current_phase != phase:
             self.current_phase = phase
+
+    def mark_queued(self):
+        self.queued_ns = time.perf_counter_ns()
+
+    def mark_dequeued(self):
+        self.dequeued_ns = time.perf_counter_ns()
+
+    def mark_upstream_start(self):
+        """Bắt đầu gọi Qwen (giữ mốc đầu tiên nếu có retry)"""
+        if self.upstream_start_ns is None:
+            self.upstream_start_ns = time.perf_counter_ns()
+
+    def mark_connected(self):
+        """Đã nhận status/header từ Qwen (lần gọi cuối cùng nếu có retry)"""
+        self.connected_ns = time.perf_counter_ns()
+
+    def set_prompt(self, messages):
+        self.prompt_tokens = count_message_tokens(messages or [])
+
+    def add_output(self, text):
+        """Ghi nhận một đoạn output: mốc token đầu tiên + cộng số token"""
+        if not text:
+            return
+        now = time.perf_counter_ns()
+        if self.first_token_ns is None:
+            self.first_token_ns = now
+            if not self.replayed:
+                TTFT.observe((now - self.created_ns) / 1e9)
+        elif not self.replayed:
+            INTER_TOKEN.observe((now - self.last_output_ns) / 1e9)
+        self.last_output_ns = now
+        self.completion_tokens += count_tokens(text)
+
+    def mark_finished(self):
+        if self.finished_ns is None:
+            self.finished_ns = time.perf_counter_ns()
+            if self.completion_tokens and not self.replayed:
+                OUTPUT_TOKENS.inc(amount=self.completion_tokens)
+                generation_s = self.generation_ns / 1e9
+                if generation_s > 0:
+                    TOKENS_PER_SECOND.observe(self.completion_tokens / generation_s)
+
+    @property
+    def generation_measured(self):
+        """False nếu output tới trong một lần (body JSON đầy đủ): không đo được tốc độ sinh token"""
+        return self.first_token_ns is not None and self.last_output_ns != self.first_token_ns
+
+    def _end_ns(self):
+        return self.finished_ns or time.perf_counter_ns()
+
+    @property
+    def queue_wait_ns(self):
+        if self.queued_ns is None or self.dequeued_ns is None:
+            return 0
+        return self.dequeued_ns - self.queued_ns
+
+    @property
+    def connect_ns(self):
+        if self.upstream_start_ns is None or self.connected_ns is None:
+            return 0
+        return self.connected_ns - self.upstream_start_ns
+
+    @property
+    def ttft_ns(self):
+        """Thời gian từ lúc nhận request tới token đầu tiên"""
+        if self.first_token_ns is None:
+            return 0
+        return self.first_token_ns - self.created_ns
+
+    @property
+    def generation_ns(self):
+        if not self.generation_measured:
+            return 0
+        return self._end_ns() - self.first_token_ns
+
+    @property
+    def total_ns(self):
+        return self._end_ns() - self.created_ns
+
+    def ollama_stats(self):
+        """Các field thống kê của Ollama (nanoseconds).
+
+        load_duration: từ lúc nhận request tới khi Qwen trả header (queue, tạo chat, upload, connect)
+        prompt_eval_duration: từ lúc connect tới token đầu tiên
+        eval_duration: thời gian sinh output
+        """
+        load_end = self.connected_ns or self.first_token_ns or self._end_ns()
+        prompt_eval_end = self.first_token_ns or self._end_ns()
+        return {
+            "total_duration": int(self.total_ns),
+            "load_duration": int(load_end - self.created_ns),
+            "prompt_eval_count": int(self.prompt_tokens),
+            "prompt_eval_duration": int(max(0, prompt_eval_end - load_end)),
+            "eval_count": int(self.completion_tokens),
+            "eval_duration": int(self.generation_ns),
+        }
+
+    def openai_usage(self):
+        return {
+            "prompt_tokens": int(self.prompt_tokens),
+            "completion_tokens": int(self.completion_tokens),
+            "total_tokens": int(self.prompt_tokens + self.completion_tokens),
+        }
+
+    def lmstudio_stats(self):
+        """Field `stats` kiểu LM Studio (giây)"""
+        generation_s = self.generation_ns / 1e9
+        return {
+            "tokens_per_second": round(self.completion_tokens / generation_s, 3) if generation_s > 0 else 0,
+            "time_to_first_token": round(self.ttft_ns / 1e9, 3),
+            "generation_time": round(generation_s, 3),
+            "queue_wait_time": round(self.queue_wait_ns / 1e9, 3),
+            "connect_time": round(self.connect_ns / 1e9, 3),
+            "stop_reason": "eosFound",
+        }
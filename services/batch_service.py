@@ -0,0 +1,548 @@
+"""Batch API kiểu OpenAI chạy cục bộ: /v1/files + /v1/batches.
+
+File upload lưu dưới BATCH_DIR/files (<id> + <id>.json metadata), mỗi batch một file trạng
+thái BATCH_DIR/batches/<id>.json. Runner nền chạy lần lượt từng batch, mỗi batch tối đa
+BATCH_CONCURRENCY request song song, mỗi request một chat Qwen riêng, và chỉ bắt đầu request
+mới khi queue interactive rảnh. Batch không giữ lock của queue: request batch đã bắt đầu vẫn
+chạy tiếp khi có request interactive tới (tối đa BATCH_CONCURRENCY request chạy song song với
+nó, mỗi request một chat riêng nên không tranh chat hiện tại), chỉ request batch kế tiếp nhường
+lượt. Kết quả được append vào output/error JSONL ngay khi xong (checkpoint): sau restart runner
+đọc lại các custom_id đã có kết quả và chạy tiếp phần còn lại. Finalize ghi trước file id của
+output/error rồi mới chuyển file, nên batch dừng giữa chừng lúc finalize chỉ làm nốt bước đó.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import BATCH_DIR, BATCH_CONCURRENCY, BATCH_IDLE_POLL, BATCH_MAX_REQUESTS, BATCH_CHECKPOINT_INTERVAL
+from models.request_state import RequestState
+from services.chat_service import chat_service
+from services.qwen_upstream import UpstreamError
+from utils.queue_manager import queue_manager
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+# Batch chưa kết thúc: được chạy tiếp khi server khởi động lại
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+# Số lỗi validate tối đa ghi vào batch.errors
+MAX_VALIDATION_ERRORS = 100
+
+
+class BatchError(Exception):
+    """Lỗi request Files/Batch API: message + HTTP status + code theo format OpenAI"""
+
+    def __init__(self, message, status=400, code=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+
+def _write_json(path, obj):
+    """Ghi JSON qua file tạm + os.replace để checkpoint không bao giờ bị ghi dở"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _public(record):
+    """Bỏ field nội bộ (tiền tố _) trước khi trả về client"""
+    return {k: v for k, v in record.items() if not k.startswith("_")}
+
+
+def _recover_results(path):
+    """(custom_id đã có kết quả, số dòng) của file kết quả; cắt dòng ghi dở ở cuối nếu có"""
+    done = set()
+    if not os.path.exists(path):
+        return done, 0
+    good_bytes = 0
+    with open(path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(raw)["custom_id"])
+            except (ValueError, KeyError, TypeError):
+                break
+            good_bytes += len(raw)
+    if good_bytes != os.path.getsize(path):
+        logger.warning(f"Truncating partial checkpoint line in {path}")
+        with open(path, "r+b") as f:
+            f.truncate(good_bytes)
+    return done, len(done)
+
+
+class BatchService:
+    """Lưu file/batch trên đĩa và chạy batch bằng một runner nền"""
+
+    def __init__(self, directory=BATCH_DIR, concurrency=BATCH_CONCURRENCY, execute=None):
+        self.directory = directory
+        self.concurrency = max(1, concurrency)
+        # execute(body, request_state) -> body chat.completion; raise UpstreamError nếu Qwen lỗi
+        self._execute = execute or chat_service.complete_in_new_chat
+        self._files = {}
+        self._batches = {}
+        self._runtime = {}
+        self._pending = deque()
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._runner = None
+        self._loaded = False
+
+    # ---- Lưu trữ ----
+
+    @property
+    def _files_dir(self):
+        return os.path.join(self.directory, "files")
+
+    @property
+    def _batches_dir(self):
+        return os.path.join(self.directory, "batches")
+
+    def _file_path(self, file_id):
+        return os.path.join(self._files_dir, file_id)
+
+    def _partial_paths(self, batch_id):
+        """Output/error JSONL của batch đang chạy (chuyển thành file khi batch kết thúc)"""
+        base = os.path.join(self._batches_dir, batch_id)
+        return base + ".output.jsonl", base + ".errors.jsonl"
+
+    def _load(self):
+        """Đọc file/batch đã lưu (một lần); batch chưa kết thúc được xếp lại vào hàng đợi"""
+        with self._lock:
+            if self._loaded:
+                return
+            os.makedirs(self._files_dir, exist_ok=True)
+            os.makedirs(self._batches_dir, exist_ok=True)
+            for directory, target in ((self._files_dir, self._files), (self._batches_dir, self._batches)):
+                for name in os.listdir(directory):
+                    if not name.endswith(".json"):
+                        continue
+                    try:
+                        with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                            record = json.load(f)
+                        target[record["id"]] = record
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.error(f"Skipping unreadable batch record {name}: {e}")
+            active = [b for b in self._batches.values() if b["status"] in ACTIVE_STATUSES]
+            for record in sorted(active, key=lambda b: b["created_at"]):
+                self._pending.append(record["id"])
+            self._loaded = True
+        if active:
+            logger.info(f"Resuming {len(active)} unfinished batch(es)")
+
+    def _save_batch(self, record):
+        with self._lock:
+            _write_json(os.path.join(self._batches_dir, record["id"] + ".json"), record)
+
+    def _register_file(self, path, filename, purpose, file_id=None):
+        file_id = file_id or "file-" + uuid.uuid4().hex[:24]
+        if path != self._file_path(file_id):
+            os.replace(path, self._file_path(file_id))
+        record = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self._file_path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+            "status_details": None,
+        }
+        _write_json(self._file_path(file_id) + ".json", record)
+        with self._lock:
+            self._files[file_id] = record
+        return record
+
+    # ---- Files API ----
+
+    def create_file(self, upload, filename, purpose):
+        """Lưu file upload (werkzeug FileStorage, ghi thẳng xuống đĩa theo chunk)"""
+        self._load()
+        if not purpose:
+            raise BatchError("Missing required parameter: 'purpose'.", code="missing_required_parameter")
+        file_id = "file-" + uuid.uuid4().hex[:24]
+        upload.save(self._file_path(file_id))
+        return _public(self._register_file(self._file_path(file_id), filename or file_id, purpose, file_id))
+
+    def _file_record(self, file_id):
+        self._load()
+        record = self._files.get(file_id)
+        if record is None:
+            raise BatchError(f"No such File object: {file_id}", status=404, code="not_found")
+        return record
+
+    def get_file(self, file_id):
+        return _public(self._file_record(file_id))
+
+    def file_content_path(self, file_id):
+        self._file_record(file_id)
+        return os.path.abspath(self._file_path(file_id))
+
+    def list_files(self, purpose=None):
+        self._load()
+        with self._lock:
+            files = [_public(f) for f in self._files.values() if purpose is None or f["purpose"] == purpose]
+        files.sort(key=lambda f: f["created_at"], reverse=True)
+        return {"object": "list", "data": files, "has_more": False}
+
+    def delete_file(self, file_id):
+        self._file_record(file_id)
+        with self._lock:
+            for batch in self._batches.values():
+                if batch["input_file_id"] == file_id and batch["status"] in ACTIVE_STATUSES:
+                    raise BatchError(f"File {file_id} is used by running batch {batch['id']}", code="file_in_use")
+            del self._files[file_id]
+        for path in (self._file_path(file_id), self._file_path(file_id) + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    # ---- Batch API ----
+
+    def _validate(self, path, endpoint):
+        """(danh sách lỗi, số request) của file input JSONL"""
+        errors = []
+        seen = set()
+
+        def error(code, message, line):
+            if len(errors) < MAX_VALIDATION_ERRORS:
+                errors.append({"code": code, "message": message, "param": None, "line": line})
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    error("invalid_json_line", "This line is not parseable as valid JSON.", line_no)
+                    continue
+                if not isinstance(item, dict) or not isinstance(item.get("custom_id"), str):
+                    error("missing_required_parameter", "Missing required parameter: 'custom_id'.", line_no)
+                    continue
+                if item["custom_id"] in seen:
+                    error("duplicate_custom_id", f"Duplicate custom_id '{item['custom_id']}'.", line_no)
+                seen.add(item["custom_id"])
+                if str(item.get("method", "")).upper() != "POST":
+                    error("invalid_method", "Only POST requests are supported.", line_no)
+                if item.get("url") != endpoint:
+                    error("mismatched_endpoint", f"The url must match the batch endpoint '{endpoint}'.", line_no)
+                if not isinstance(item.get("body"), dict):
+                    error("missing_required_parameter", "Missing required parameter: 'body'.", line_no)
+        if not seen and not errors:
+            error("empty_file", "The input file contains no requests.", None)
+        if len(seen) > BATCH_MAX_REQUESTS:
+            error("too_many_requests", f"A batch may contain at most {BATCH_MAX_REQUESTS} requests.", None)
+        return errors, len(seen)
+
+    def create_batch(self, input_file_id, endpoint, completion_window="24h", metadata=None):
+        """Tạo batch từ file input (purpose=batch); validate xong thì xếp vào hàng đợi runner"""
+        self._load()
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise BatchError(f"Unsupported endpoint '{endpoint}'. Supported: {', '.join(SUPPORTED_ENDPOINTS)}",
+                             code="invalid_value")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise BatchError(f"Unsupported completion_window '{completion_window}'. Supported: 24h",
+                             code="invalid_value")
+        file_record = self._file_record(input_file_id)
+        if file_record["purpose"] != "batch":
+            raise BatchError(f"File {input_file_id} must have purpose 'batch'.", code="invalid_value")
+
+        now = int(time.time())
+        record = {
+            "id": "batch_" + uuid.uuid4().hex[:24],
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        errors, total = self._validate(self._file_path(input_file_id), endpoint)
+        if errors:
+            record.update(status="failed", failed_at=now, errors={"object": "list", "data": errors})
+        else:
+            record["request_counts"]["total"] = total
+        with self._lock:
+            self._batches[record["id"]] = record
+            self._save_batch(record)
+            if not errors:
+                self._pending.append(record["id"])
+        if not errors:
+            logger.info(f"Batch {record['id']} queued: {total} requests from {input_file_id}")
+            self._ensure_runner()
+        return self._view(record)
+
+    def _batch_record(self, batch_id):
+        self._load()
+        record = self._batches.get(batch_id)
+        if record is None:
+            raise BatchError(f"No such Batch object: {batch_id}", status=404, code="not_found")
+        return record
+
+    def _view(self, record):
+        """Batch object cho client; batch đang chạy có thêm x_progress (tiến độ + throughput)"""
+        with self._lock:
+            view = _public(record)
+            view["request_counts"] = dict(record["request_counts"])
+            runtime = self._runtime.get(record["id"])
+            if runtime is None:
+                return view
+            elapsed = time.monotonic() - runtime["started"]
+            counts = view["request_counts"]
+            remaining = counts["total"] - counts["completed"] - counts["failed"]
+            rate = runtime["done"] / elapsed if elapsed > 0 else 0.0
+            view["x_progress"] = {
+                "percent": round(100.0 * (counts["total"] - remaining) / counts["total"], 2) if counts["total"] else 100.0,
+                "elapsed_seconds": round(elapsed, 1),
+                "requests_per_second": round(rate, 3),
+                "completion_tokens_per_second": round(runtime["tokens"] / elapsed, 1) if elapsed > 0 else 0.0,
+                "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+                "waiting_for_interactive": runtime["waiting"],
+            }
+            return view
+
+    def get_batch(self, batch_id):
+        return self._view(self._batch_record(batch_id))
+
+    def list_batches(self, limit=20, after=None):
+        self._load()
+        with self._lock:
+            batches = sorted(self._batches.values(), key=lambda b: b["created_at"], reverse=True)
+        if after:
+            ids = [b["id"] for b in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        data = [self._view(b) for b in page]
+        return {
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(batches) > len(page),
+        }
+
+    def cancel_batch(self, batch_id):
+        """Hủy batch: chưa chạy thì hủy ngay, đang chạy thì chờ các request dở dang xong"""
+        record = self._batch_record(batch_id)
+        now = int(time.time())
+        with self._lock:
+            status = record["status"]
+            if status == "validating":
+                if batch_id in self._pending:
+                    self._pending.remove(batch_id)
+                record.update(status="cancelled", cancelling_at=now, cancelled_at=now)
+            elif status == "in_progress":
+                record.update(status="cancelling", cancelling_at=now)
+            elif status != "cancelling":
+                raise BatchError(f"Cannot cancel a batch with status '{status}'.", code="invalid_state")
+            self._save_batch(record)
+        return self._view(record)
+
+    # ---- Runner ----
+
+    def resume(self):
+        """Đọc trạng thái trên đĩa và chạy tiếp các batch dở dang (gọi khi server khởi động)"""
+        self._load()
+        if self._pending:
+            self._ensure_runner()
+
+    def _ensure_runner(self):
+        with self._lock:
+            if self._runner is None or not self._runner.is_alive():
+                self._runner = threading.Thread(target=self._run_loop, name="batch-runner", daemon=True)
+                self._runner.start()
+        self._wakeup.set()
+
+    def _run_loop(self):
+        while True:
+            with self._lock:
+                batch_id = self._pending.popleft() if self._pending else None
+            if batch_id is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self._run_batch(self._batches[batch_id])
+            except Exception as e:
+                logger.error(f"Batch {batch_id} failed: {e}")
+                record = self._batches[batch_id]
+                with self._lock:
+                    self._runtime.pop(batch_id, None)
+                    record.update(status="failed", failed_at=int(time.time()), errors={"object": "list", "data": [
+                        {"code": "batch_failed", "message": str(e), "param": None, "line": None}]})
+                    self._save_batch(record)
+
+    def _wait_turn(self, record, runtime):
+        """Đợi queue interactive rảnh trước mỗi request batch; False nếu batch bị hủy hoặc hết hạn
+        trong lúc đợi. Không giữ queue: request interactive tới sau không phải đợi batch."""
+        while True:
+            if record["status"] == "cancelling":
+                return False
+            if time.time() > record["expires_at"]:
+                runtime["expired"] = True
+                return False
+            if not queue_manager.busy():
+                runtime["waiting"] = False
+                return True
+            runtime["waiting"] = True
+            time.sleep(BATCH_IDLE_POLL)
+
+    def _execute_line(self, item):
+        """Chạy một dòng input, trả về (dòng kết quả, thành công?, số completion token)"""
+        request_id = "batch_req_" + uuid.uuid4().hex[:24]
+        body = dict(item["body"])
+        body["stream"] = False
+        request_state = RequestState(request_id, body.get("model", "qwen3-235b-a22b"))
+        line = {"id": request_id, "custom_id": item["custom_id"], "response": None, "error": None}
+        try:
+            result = self._execute(body, request_state)
+            line["response"] = {"status_code": 200, "request_id": request_id, "body": result}
+            return line, True, request_state.completion_tokens
+        except UpstreamError as e:
+            line["response"] = {"status_code": e.status or 500, "request_id": request_id,
+                                "body": {"error": {"message": e.message, "type": "server_error"}}}
+        except Exception as e:
+            logger.error(f"Batch request {item['custom_id']} failed: {e}")
+            line["error"] = {"code": "batch_request_failed", "message": str(e)}
+        return line, False, 0
+
+    def _run_batch(self, record):
+        batch_id = record["id"]
+        if record["status"] == "finalizing" and record.get("_finalize"):
+            # Dừng giữa lúc finalize: kết quả đã đủ, chỉ làm nốt việc chuyển file
+            logger.info(f"Batch {batch_id}: resuming finalize")
+            self._finish_finalize(record)
+            return
+        output_path, error_path = self._partial_paths(batch_id)
+        completed_ids, completed = _recover_results(output_path)
+        failed_ids, failed = _recover_results(error_path)
+        done = completed_ids | failed_ids
+        runtime = {"started": time.monotonic(), "done": 0, "tokens": 0, "saved": 0.0,
+                   "waiting": False, "expired": False}
+        with self._lock:
+            counts = record["request_counts"]
+            counts.update(completed=completed, failed=failed)
+            if record["status"] == "validating":
+                record.update(status="in_progress", in_progress_at=int(time.time()))
+            self._runtime[batch_id] = runtime
+            self._save_batch(record)
+        if done:
+            logger.info(f"Batch {batch_id}: resuming after {len(done)}/{counts['total']} finished requests")
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+        write_lock = threading.Lock()
+
+        with open(output_path, "a", encoding="utf-8") as output_file, \
+                open(error_path, "a", encoding="utf-8") as error_file, \
+                ThreadPoolExecutor(self.concurrency, thread_name_prefix=f"batch-{batch_id[-6:]}") as pool:
+
+            def run(item):
+                try:
+                    line, ok, tokens = self._execute_line(item)
+                    with write_lock:
+                        target = output_file if ok else error_file
+                        target.write(json.dumps(line, ensure_ascii=False) + "\n")
+                        target.flush()
+                    with self._lock:
+                        counts["completed" if ok else "failed"] += 1
+                        runtime["done"] += 1
+                        runtime["tokens"] += tokens
+                        if time.monotonic() - runtime["saved"] >= BATCH_CHECKPOINT_INTERVAL:
+                            runtime["saved"] = time.monotonic()
+                            self._save_batch(record)
+                finally:
+                    slots.release()
+
+            with open(self._file_path(record["input_file_id"]), "r", encoding="utf-8") as input_file:
+                for raw in input_file:
+                    if not raw.strip():
+                        continue
+                    item = json.loads(raw)
+                    if item["custom_id"] in done:
+                        continue
+                    slots.acquire()
+                    if not self._wait_turn(record, runtime):
+                        slots.release()
+                        break
+                    pool.submit(run, item)
+
+        if record["status"] == "cancelling":
+            self._finalize(record, "cancelled")
+        elif runtime["expired"]:
+            self._finalize(record, "expired")
+        else:
+            self._finalize(record, "completed")
+
+    def _finalize(self, record, status):
+        """Chuyển output/error JSONL thành file (purpose batch_output) và lưu trạng thái cuối.
+
+        File id và trạng thái đích được lưu vào record (field nội bộ _finalize) trước khi chuyển
+        file, để sau restart _finish_finalize làm nốt thay vì chạy lại toàn bộ request.
+        """
+        file_ids = ["file-" + uuid.uuid4().hex[:24] if os.path.exists(path) and os.path.getsize(path) else None
+                    for path in self._partial_paths(record["id"])]
+        with self._lock:
+            record.update(status="finalizing", finalizing_at=int(time.time()),
+                          _finalize={"status": status, "file_ids": file_ids})
+            self._save_batch(record)
+        self._finish_finalize(record)
+
+    def _finish_finalize(self, record):
+        """Chuyển file theo kế hoạch trong record["_finalize"]; chạy lại được nhiều lần"""
+        batch_id = record["id"]
+        status = record["_finalize"]["status"]
+        file_ids = []
+        for path, suffix, file_id in zip(self._partial_paths(batch_id), ("output", "errors"),
+                                         record["_finalize"]["file_ids"]):
+            if file_id is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            elif os.path.exists(path) or os.path.exists(self._file_path(file_id)):
+                # File có thể đã được chuyển trước khi dừng (chỉ còn thiếu metadata)
+                source = path if os.path.exists(path) else self._file_path(file_id)
+                self._register_file(source, f"{batch_id}_{suffix}.jsonl", "batch_output", file_id)
+            else:
+                logger.error(f"Batch {batch_id}: {suffix} file {file_id} is missing")
+                file_id = None
+            file_ids.append(file_id)
+        with self._lock:
+            runtime = self._runtime.pop(batch_id, None)
+            record.pop("_finalize", None)
+            record.update(status=status, output_file_id=file_ids[0], error_file_id=file_ids[1])
+            record[f"{status}_at"] = int(time.time())
+            self._save_batch(record)
+            counts = dict(record["request_counts"])
+        if runtime is not None:
+            elapsed = time.monotonic() - runtime["started"]
+            rate = runtime["done"] / elapsed if elapsed > 0 else 0.0
+            logger.info(f"Batch {batch_id} {status}: {counts['completed']} completed, {counts['failed']} failed "
+                        f"in {elapsed:.1f}s ({rate:.2f} req/s, {runtime['tokens']} completion tokens)")
+
+
+# Global batch service instance
+batch_service = BatchService()
@@ -1,24 +1,38 @@
 import json
 import time
 import uuid
+import queue
+import threading
+import contextvars
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import FANOUT_CONCURRENCY
 from models.request_state import RequestState
 from services.qwen_service import qwen_service
+from services.qwen_upstream import qwen_upstream, UpstreamError, THINK_START, THINK, THINK_END, ANSWER, FINISH
 from utils.ui_manager import ui_manager
 from utils.chat_manager import chat_manager
-from config import QWEN_HEADERS, QWEN_CHAT_COMPLETIONS_URL
-from utils.cookie_parser import build_header
 
 logger = logging.getLogger(__name__)
 
+# Event lỗi của một choice khi fan-out (bên cạnh các event của services.qwen_upstream)
+CHOICE_ERROR = "error"
+
 class ChatService:
     """Service xử lý chat completions"""
     
     def __init__(self):
         pass
     
-    def stream_qwen_response(self, data, request_state=None):
+    def _current_chat(self, model):
+        """chat_id hiện tại (tạo mới nếu chưa có) và parent_id, chat_id None nếu không tạo được"""
+        chat_id = chat_manager.get_current_chat_id()
+        if not chat_id:
+            chat_id = chat_manager.initialize_chat(model)
+        return chat_id, chat_manager.get_current_parent_id()
+
+    def stream_qwen_response(self, data, request_state=None, use_cache=True):
         """Stream response from Qwen API with think mode support
         
         Think mode: When Qwen returns phase="think", the server will:
@@ -27,6 +41,8 @@ class ChatService:
         - Send </think> tag when think mode ends (status="finished")
         
         Answer mode: After think mode, Qwen switches to phase="answer" for normal response
+
+        use_cache=False: bỏ qua response cache (header bypass của client)
         """
         model = data.get('model', 'qwen3-235b-a22b')
         
@@ -34,104 +50,24 @@ class ChatService:
         if request_state is None:
             request_id = str(uuid.uuid4())
             request_state = RequestState(request_id, model)
+        request_state.set_prompt(data.get('messages'))
                 
         try:
-            # Sử dụng chat_id hiện tại hoặc tạo mới nếu chưa có
-            chat_id = chat_manager.get_current_chat_id()
-            if not chat_id:
-                chat_id = chat_manager.initialize_chat(model)
+            upstream, cache_key = qwen_upstream.lookup(data, request_state, use_cache)
+            if upstream is None:
+                # Sử dụng chat_id hiện tại hoặc tạo mới nếu chưa có
+                chat_id, parent_id = self._current_chat(model)
                 if not chat_id:
                     logger.error("Failed to create new chat")
                     yield f"data: {json.dumps({'error': 'Failed to create new chat'})}\n\n"
                     return
-            
-            # Lấy parent_id hiện tại
-            parent_id = chat_manager.get_current_parent_id()
-            
-            # Chuẩn bị request cho Qwen API
-            qwen_data = qwen_service.prepare_qwen_request(data, chat_id, model, parent_id)
-            
-            
-            # Gửi request đến Qwen API
-            # Build headers with cookie from settings
-            headers = build_header(QWEN_HEADERS)
-
-            response = requests.post(
-                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
-                headers=headers,
-                json=qwen_data,
-                stream=True,
-                timeout=300  # 5 phút timeout
-            )
-                        
-            # Kiểm tra response content trước khi xử lý
-            try:
-                # Chỉ log response headers và status, không log content vì có thể là binary/compressed            
-                # Kiểm tra content-type để xử lý phù hợp
-                content_type = response.headers.get('content-type', '')
-                if 'application/json' in content_type:
-                    try:
-                        response_json = response.json()
-                        
-                        if not response_json.get('success', True):
-                            error_code = response_json.get('data', {}).get('code', 'Unknown')
-                            error_details = response_json.get('data', {}).get('details', 'Unknown error')
-                            logger.error(f"Qwen API error: {error_code} - {error_details}")
-                            
-                            if error_code == "Bad_Request" and "chat is in progress" in error_details:
-                                error_msg = "Chat is currently in progress. Please wait for the current request to complete."
-                            elif error_code == "Bad_Request" and "parent_id" in error_details and "not exist" in error_details:
-                                # Xử lý lỗi parent_id không tồn tại
-                                logger.warning(f"Parent ID not exist error detected: {error_details}")
-                                
-                                # Tạo chat mới và reset parent_id
-                                new_chat_id = chat_manager.create_new_chat(model)
-                                if new_chat_id:
-                                    # Gửi lại request với parent_id = None
-                                    qwen_data = qwen_service.prepare_qwen_request(data, new_chat_id, model, None)
-                                    
-                                    retry_response = requests.post(
-                                        f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={new_chat_id}",
-                                        headers=headers,
-                                        json=qwen_data,
-                                        stream=True,
-                                        timeout=300
-                                    )
-                                    
-                                    if retry_response.status_code == 200:
-                                        # Tiếp tục xử lý response từ retry
-                                        response = retry_response
-                                        # Tiếp tục xử lý response bình thường
-                                        yield from self._process_qwen_stream_response(response, model, request_state)
-                                        return
-                                    else:
-                                        logger.error(f"Retry failed with status: {retry_response.status_code}")
-                                        error_msg = f"Failed to retry with new chat: {retry_response.status_code}"
-                                        yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                                        return
-                                else:
-                                    logger.error("Failed to create new chat for retry")
-                                    error_msg = "Failed to create new chat for retry"
-                                    yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                                    return
-                            else:
-                                error_msg = f"Qwen API error: {error_code} - {error_details}"
-                                yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                                return
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing JSON response: {e}")
-                else:
-                    logger.info(f"Qwen API response is not JSON (content-type: {content_type})")
-            except Exception as e:
-                logger.error(f"Error reading response content: {e}")
-            
-            if response.status_code == 200:
-                yield from self._process_qwen_stream_response(response, model, request_state)
-            else:
-                error_msg = f"Error from Qwen API: {response.status_code}"
-                logger.error(f"Qwen API error: {response.status_code} - {response.text}")
-                yield f"data: {json.dumps({'error': error_msg})}\n\n"
                 
+                upstream = qwen_upstream.open(data, model, chat_id, parent_id, request_state,
+                                              chat_manager.create_new_chat, cache_key=cache_key)
+            yield from self._process_qwen_stream_response(upstream, model, request_state)
+                
+        except UpstreamError as e:
+            yield f"data: {json.dumps({'error': e.message})}\n\n"
         except requests.exceptions.Timeout:
             error_msg = "Request timeout - server took too long to respond"
             logger.error("Qwen API request timeout")
@@ -140,269 +76,49 @@ class ChatService:
             error_msg = f"Error: {str(e)}"
             logger.error(f"Stream function error: {e}")
             yield f"data: {json.dumps({'error': error_msg})}\n\n"
+
+    def _chunk_writer(self, model, index=0, completion_id=None, created=None):
+        """Hàm dựng SSE chat.completion.chunk; id/created cố định cho cả stream,
+        phần cố định được dựng sẵn nên mỗi token chỉ json.dumps nội dung.
+        index/completion_id/created: choice thứ mấy, id và created dùng chung khi stream nhiều choice"""
+        completion_id = completion_id or uuid.uuid4().hex[:24]
+        created = created or int(time.time())
+        head = ('data: {"id": "chatcmpl-' + completion_id + '", "object": "chat.completion.chunk", '
+                '"created": ' + str(created) + ', "model": ' + json.dumps(model) +
+                ', "system_fingerprint": ' + json.dumps(model) + ', "choices": [{"index": ' + str(index) +
+                ', "delta": {"content": ')
+
+        def chunk(content, finish_reason=None, cache_info=None):
+            tail = '}]}\n\n' if cache_info is None else '}], "x_cache": ' + json.dumps(cache_info) + '}\n\n'
+            return head + json.dumps(content) + '}, "logprobs": null, "finish_reason": ' + json.dumps(finish_reason) + tail
+        return chunk
     
-    def _process_qwen_stream_response(self, response, model, request_state):
-        """Xử lý response streaming từ Qwen API"""
-        chunk_count = 0
+    def _process_qwen_stream_response(self, upstream, model, request_state):
+        """Render event của upstream thành SSE OpenAI chat.completion.chunk"""
+        chunk = self._chunk_writer(model)
         # Thu thập nội dung assistant để đẩy vào Chat tab khi kết thúc
         collected_answer = []
-        last_user_text = ""
-        try:
-            # Thử lấy user message cuối cùng từ request_state hoặc dữ liệu lưu cục bộ (không có: để server trích sau)
-            pass
-        except Exception:
-            pass
-        
-        # Xử lý response content dựa trên encoding
-        content_encoding = response.headers.get('content-encoding', '').lower()
-        
-        if content_encoding == 'br':
-            # Brotli compression - xử lý streaming từng line riêng biệt
-            try:
-                import brotli
-                logger.info("Processing Brotli compressed streaming response...")
-                
-                # Xử lý từng line streaming riêng biệt với timeout
-                start_time = time.time()
-                for line in response.iter_lines():
-                    # Kiểm tra timeout mỗi 10 giây
-                    if time.time() - start_time > 300:  # 5 phút timeout
-                        logger.error("Stream reading timeout")
-                        yield f"data: {json.dumps({'error': 'Stream reading timeout'})}\n\n"
-                        return
-                        
-                    if line:
-                        try:
-                            # Raw data đã được decompress sẵn, chỉ cần decode
-                            line_text = line.decode('utf-8')
-                            
-                            if line_text.startswith('data: '):
-                                data_content = line_text[6:]  # Bỏ 'data: '
-                                if data_content.strip():
-                                    chunk_count += 1
-                                    # Chuyển đổi response format để giống LM Studio
-                                    try:
-                                        qwen_data = json.loads(data_content)
-                                        
-                                        # Xử lý response.created để lấy parent_id và response_id
-                                        if 'response.created' in qwen_data:
-                                            response_created = qwen_data['response.created']
-                                            parent_id = response_created.get('parent_id')
-                                            response_id = response_created.get('response_id')
-                                            if parent_id and response_id:
-                                                chat_manager.update_parent_info(parent_id, response_id)
-                                            continue  # Bỏ qua chunk này, không gửi về client
-                                        
-                                        if 'choices' in qwen_data and len(qwen_data['choices']) > 0:
-                                            # Stream tất cả content như LM Studio thực sự làm
-                                            delta = qwen_data['choices'][0].get('delta', {})
-                                            finish_reason = qwen_data['choices'][0].get('finish_reason', None)
-                                            phase = delta.get('phase', None)
-                                            
-                                            # Log phase nếu có thay đổi
-                                            request_state.log_phase_change(phase)
-                                            
-                                            # Xử lý think mode
-                                            if phase == "think":
-                                                # Nếu bắt đầu think mode và chưa gửi <think> tag
-                                                if not request_state.think_started:
-                                                    request_state.think_started = True
-                                                    # Gửi <think> tag
-                                                    openai_format = {
-                                                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
-                                                        "object": "chat.completion.chunk",
-                                                        "created": int(time.time()),
-                                                        "model": model,
-                                                        "system_fingerprint": model,
-                                                        "choices": [{
-                                                            "index": 0,
-                                                            "delta": {"content": "<think>"},
-                                                            "logprobs": None,
-                                                            "finish_reason": None
-                                                        }]
-                                                    }
-                                                    yield f"data: {json.dumps(openai_format)}\n\n"
-                                                
-                                                # Gửi content trong think mode
-                                                if 'content' in delta:
-                                                    openai_format = {
-                                                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
-                                                        "object": "chat.completion.chunk",
-                                                        "created": int(time.time()),
-                                                        "model": model,
-                                                        "system_fingerprint": model,
-                                                        "choices": [{
-                                                            "index": 0,
-                                                            "delta": {"content": delta['content']},
-                                                            "logprobs": None,
-                                                            "finish_reason": finish_reason
-                                                        }]
-                                                    }
-                                                    # Thu thập content để hiển thị sau
-                                                    try:
-                                                        if 'content' in delta and isinstance(delta['content'], str):
-                                                            collected_answer.append(delta['content'])
-                                                    except Exception:
-                                                        pass
-                                                    yield f"data: {json.dumps(openai_format)}\n\n"
-                                                
-                                                # Nếu think mode kết thúc (status finished)
-                                                if delta.get('status') == 'finished':
-                                                    # Gửi </think> tag
-                                                    openai_format = {
-                                                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
-                                                        "object": "chat.completion.chunk",
-                                                        "created": int(time.time()),
-                                                        "model": model,
-                                                        "system_fingerprint": model,
-                                                        "choices": [{
-                                                            "index": 0,
-                                                            "delta": {"content": "</think>"},
-                                                            "logprobs": None,
-                                                            "finish_reason": None
-                                                        }]
-                                                    }
-                                                    # Thu thập content để hiển thị sau
-                                                    try:
-                                                        if 'content' in delta and isinstance(delta['content'], str):
-                                                            collected_answer.append(delta['content'])
-                                                    except Exception:
-                                                        pass
-                                                    yield f"data: {json.dumps(openai_format)}\n\n"
-                                                    # Reset think state
-                                                    request_state.think_started = False
-                                            elif phase == "answer" or phase is None:
-                                                # Normal content (answer phase hoặc không có phase)
-                                                if 'content' in delta:
-                                                    # Format giống LM Studio
-                                                    openai_format = {
-                                                        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
-                                                        "object": "chat.completion.chunk",
-                                                        "created": int(time.time()),
-                                                        "model": model,
-                                                        "system_fingerprint": model,
-                                                        "choices": [{
-                                                            "index": 0,
-                                                            "delta": {"content": delta['content']},
-                                                            "logprobs": None,
-                                                            "finish_reason": finish_reason
-                                                        }]
-                                                    }
-                                                    yield f"data: {json.dumps(openai_format)}\n\n"
-                                            
-                                            # Nếu có finish_reason, gửi [DONE] message
-                                            if finish_reason:
-                                                # Khi kết thúc, đẩy lịch sử chat vào UI (user + full assistant)
-                                                try:
-                                                    full_answer = ''.join(collected_answer)
-                                                    # Lấy user text cuối cùng từ chat_manager (nếu có)
-                                                    try:
-                                                        from utils.chat_manager import chat_manager as _cm
-                                                        # Không có API lấy user message; fallback: để trống, client hiển thị vẫn OK
-                                                        last_user_text = last_user_text or ""
-                                                    except Exception:
-                                                        last_user_text = last_user_text or ""
-                                                    ui_manager.add_chat_messages(last_user_text, full_answer)
-                                                except Exception:
-                                                    pass
-                                                yield "data: [DONE]\n\n"
-                                                return
-                                        else:
-                                            pass
-                                            # Bỏ qua các message không có choices
-                                    except json.JSONDecodeError as e:
-                                        logger.error(f"JSON decode error on chunk {chunk_count}: {e}")
-                                        # Gửi error message format đúng
-                                        error_format = {
-                                            "error": {
-                                                "message": f"Invalid JSON in response: {str(e)}",
-                                                "type": "server_error"
-                                            }
-                                        }
-                                        yield f"data: {json.dumps(error_format)}\n\n"
-                                        return
-                        except Exception as e:
-                            logger.error(f"Error processing line: {e}")
-                            continue
-            except Exception as e:
-                logger.error(f"Error in Brotli streaming: {e}")
-                yield f"data: {json.dumps({'error': f'Streaming error: {str(e)}'})}\n\n"
-                return
-        else:
-            # Xử lý response không nén
-            logger.info("Processing uncompressed streaming response...")
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        line_text = line.decode('utf-8')
-                        if line_text.startswith('data: '):
-                            data_content = line_text[6:]
-                            if data_content.strip():
-                                chunk_count += 1
-                                try:
-                                    qwen_data = json.loads(data_content)
-                                    
-                                    # Xử lý response.created
-                                    if 'response.created' in qwen_data:
-                                        response_created = qwen_data['response.created']
-                                        parent_id = response_created.get('parent_id')
-                                        response_id = response_created.get('response_id')
-                                        if parent_id and response_id:
-                                            chat_manager.update_parent_info(parent_id, response_id)
-                                        continue
-                                    
-                                    if 'choices' in qwen_data and len(qwen_data['choices']) > 0:
-                                        delta = qwen_data['choices'][0].get('delta', {})
-                                        finish_reason = qwen_data['choices'][0].get('finish_reason', None)
-                                        phase = delta.get('phase', None)
-                                        
-                                        request_state.log_phase_change(phase)
-                                        
-                                        if 'content' in delta:
-                                            openai_format = {
-                                                "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
-                                                "object": "chat.completion.chunk",
-                                                "created": int(time.time()),
-                                                "model": model,
-                                                "system_fingerprint": model,
-                                                "choices": [{
-                                                    "index": 0,
-                                                    "delta": {"content": delta['content']},
-                                                    "logprobs": None,
-                                                    "finish_reason": finish_reason
-                                                }]
-                                            }
-                                            yield f"data: {json.dumps(openai_format)}\n\n"
-                                        
-                                        if finish_reason:
-                                            try:
-                                                full_answer = ''.join(collected_answer)
-                                                last_user_text = last_user_text or ""
-                                                ui_manager.add_chat_messages(last_user_text, full_answer)
-                                            except Exception:
-                                                pass
-                                            yield "data: [DONE]\n\n"
-                                            return
-                                except json.JSONDecodeError as e:
-                                    logger.error(f"JSON decode error: {e}")
-                                    continue
-                    except Exception as e:
-                        logger.error(f"Error processing line: {e}")
-                        continue
+        for kind, text in upstream.events():
+            if kind == ANSWER:
+                collected_answer.append(text)
+                yield chunk(text)
+            elif kind == THINK:
+                yield chunk(text)
+            elif kind == THINK_START:
+                yield chunk("<think>")
+            elif kind == THINK_END:
+                yield chunk("</think>")
+            elif kind == FINISH:
+                try:
+                    ui_manager.add_chat_messages("", ''.join(collected_answer))
+                except Exception:
+                    pass
+                # Chunk cuối mang marker nếu response được phát lại từ cache
+                yield chunk("", text, upstream.cache_info)
+                yield "data: [DONE]\n\n"
     
-    def _process_qwen_non_streaming_response(self, response, model):
-        """Xử lý non-streaming response từ Qwen API"""
-        qwen_response = response.json()
-        
-        # Xử lý response.created để lấy parent_id và response_id (cho non-streaming)
-        if 'response' in qwen_response and 'created' in qwen_response['response']:
-            response_created = qwen_response['response']['created']
-            parent_id = response_created.get('parent_id')
-            response_id = response_created.get('response_id')
-            if parent_id and response_id:
-                chat_manager.update_parent_info(parent_id, response_id)
-        
-        # Chuyển đổi response từ Qwen format sang OpenAI format
+    def _completion_response(self, model, content, usage=None, request_state=None):
+        """Body chat.completion theo OpenAI format"""
         openai_response = {
             "id": f"chatcmpl-{uuid.uuid4()}",
             "object": "chat.completion",
@@ -412,105 +128,222 @@ class ChatService:
                 "index": 0,
                 "message": {
                     "role": "assistant",
-                    "content": qwen_response.get('choices', [{}])[0].get('message', {}).get('content', '')
+                    "content": content
                 },
                 "finish_reason": "stop"
             }],
-            "usage": qwen_response.get('usage', {
+            "usage": usage or {
                 "prompt_tokens": 0,
                 "completion_tokens": 0,
                 "total_tokens": 0
-            })
+            }
         }
+        # Qwen không trả usage: dùng số token đếm được
+        if request_state is not None and not openai_response['usage'].get('total_tokens'):
+            openai_response['usage'] = request_state.openai_usage()
         return openai_response
 
+    def _join_thinking(self, thinking, answer):
+        if thinking:
+            return f"<think>{thinking}</think>{answer}"
+        return answer
+
     def _collect_full_content_via_stream(self, data, model):
         """Fallback: gọi Qwen ở chế độ streaming để gom full content cho non-streaming API."""
         try:
-            # Sử dụng chat_id hiện tại hoặc tạo mới nếu chưa có
-            chat_id = chat_manager.get_current_chat_id()
+            chat_id, parent_id = self._current_chat(model)
             if not chat_id:
-                chat_id = chat_manager.initialize_chat(model)
-                if not chat_id:
-                    return ""
+                return ""
+            upstream = qwen_upstream.open(data, model, chat_id, parent_id, RequestState(str(uuid.uuid4()), model),
+                                          chat_manager.create_new_chat)
+            return self._join_thinking(*upstream.collect())
+        except Exception:
+            return ""
+    
+    def open_in_new_chat(self, data, request_state, use_cache=True):
+        """UpstreamStream trong một chat Qwen riêng (batch, fan-out nhiều choice).
 
-            parent_id = chat_manager.get_current_parent_id()
-            qwen_data = qwen_service.prepare_qwen_request({**data, "stream": True, "incremental_output": True}, chat_id, model, parent_id)
+        Không dùng và không cập nhật chat hiện tại của server nên chạy song song được với
+        request interactive. Raise UpstreamError nếu Qwen báo lỗi.
+        """
+        model = data.get('model', 'qwen3-235b-a22b')
+        request_state.set_prompt(data.get('messages'))
+        upstream, cache_key = qwen_upstream.lookup(data, request_state, use_cache)
+        if upstream is None:
+            chat_id = qwen_service.create_new_chat(model)
+            if not chat_id:
+                raise UpstreamError("Failed to create new chat")
+            upstream = qwen_upstream.open(data, model, chat_id, None, request_state, qwen_service.create_new_chat,
+                                          cache_key=cache_key, track_parent=False)
+        return upstream
 
-            headers = build_header(QWEN_HEADERS)
-            import requests
-            response = requests.post(
-                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
-                headers=headers,
-                json=qwen_data,
-                stream=True,
-                timeout=300
-            )
+    def complete_in_new_chat(self, data, request_state=None):
+        """Non-streaming completion trong một chat Qwen riêng (dùng cho batch)"""
+        model = data.get('model', 'qwen3-235b-a22b')
+        if request_state is None:
+            request_state = RequestState(str(uuid.uuid4()), model)
+        upstream = self.open_in_new_chat(data, request_state)
+        result = self._completion_response(model, self._join_thinking(*upstream.collect()),
+                                           request_state=request_state)
+        if upstream.cached:
+            result['x_cache'] = upstream.cache_info
+        return result
 
-            if response.status_code != 200:
-                return ""
+    def fan_out_events(self, requests_data, request_states, use_cache=True):
+        """Chạy song song nhiều request, mỗi request một chat riêng (tối đa FANOUT_CONCURRENCY
+        cùng lúc); yield (index, kind, text) theo thứ tự event đến. Choice lỗi: (index, CHOICE_ERROR,
+        message) và không có FINISH."""
+        events = queue.Queue()
+        # Client ngắt giữa chừng: báo các choice đang chạy dừng đọc upstream
+        stop = threading.Event()
 
-            full_content = []
-            thinking_started = False
+        def run(index):
+            upstream = None
+            try:
+                if stop.is_set():
+                    return
+                upstream = self.open_in_new_chat(requests_data[index], request_states[index], use_cache)
+                for kind, text in upstream.events():
+                    if stop.is_set():
+                        break
+                    events.put((index, kind, text))
+            except UpstreamError as e:
+                events.put((index, CHOICE_ERROR, e.message))
+            except Exception as e:
+                logger.error(f"Fan-out choice {index} failed: {e}")
+                events.put((index, CHOICE_ERROR, f"Error: {str(e)}"))
+            finally:
+                if stop.is_set() and upstream is not None and upstream.response is not None:
+                    upstream.response.close()
+                events.put((index, None, None))
 
-            for line in response.iter_lines():
-                if not line:
-                    continue
-                line_str = line.decode('utf-8')
-                if not line_str.startswith('data: '):
-                    continue
-                try:
-                    chunk = json.loads(line_str[6:])
-                except Exception:
-                    continue
-                if 'response.created' in chunk:
-                    # cập nhật parent/response id nếu có
-                    try:
-                        response_created = chunk['response.created']
-                        parent_id = response_created.get('parent_id')
-                        response_id = response_created.get('response_id')
-                        if parent_id and response_id:
-                            chat_manager.update_parent_info(parent_id, response_id)
-                    except Exception:
-                        pass
-                    continue
-                try:
-                    if chunk.get('choices') and chunk['choices'][0].get('delta'):
-                        delta = chunk['choices'][0]['delta']
-                        phase = delta.get('phase')
-                        content = delta.get('content')
-                        status = delta.get('status')
-                        if phase == 'think':
-                            if not thinking_started:
-                                full_content.append('<think>')
-                                thinking_started = True
-                            if content:
-                                full_content.append(content)
-                            if status == 'finished' and thinking_started:
-                                full_content.append('</think>')
-                                thinking_started = False
-                        else:
-                            if content:
-                                full_content.append(content)
-                        finish_reason = chunk['choices'][0].get('finish_reason')
-                        if finish_reason:
-                            break
-                except Exception:
+        pool = ThreadPoolExecutor(max_workers=min(FANOUT_CONCURRENCY, len(requests_data)),
+                                  thread_name_prefix="fanout")
+        try:
+            for index in range(len(requests_data)):
+                # Copy context để span của từng choice nằm trong trace của request
+                pool.submit(contextvars.copy_context().run, run, index)
+            remaining = len(requests_data)
+            while remaining:
+                item = events.get()
+                if item[1] is None:
+                    remaining -= 1
                     continue
+                yield item
+        finally:
+            # Bỏ các choice chưa bắt đầu, choice đang chạy tự dừng ở event kế tiếp
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
 
-            return ''.join(full_content)
-        except Exception:
-            return ""
-    
-    def stream_qwen_response_non_streaming(self, data):
-        """Non-streaming response from Qwen API"""
+    def choices_usage(self, request_states, choices_per_prompt=None):
+        """usage gộp của nhiều choice: prompt tính một lần cho mỗi prompt khác nhau, completion cộng dồn.
+
+        request_states xếp theo prompt (index = prompt * choices_per_prompt + j); mặc định mọi
+        choice cùng một prompt (n>1 của chat).
+        """
+        per_prompt = choices_per_prompt or len(request_states) or 1
+        prompt_tokens = sum(max(int(rs.prompt_tokens) for rs in request_states[start:start + per_prompt])
+                            for start in range(0, len(request_states), per_prompt))
+        completion_tokens = sum(int(rs.completion_tokens) for rs in request_states)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    def stream_qwen_choices(self, requests_data, request_states, use_cache=True, model_out=None,
+                            include_usage=False, choices_per_prompt=None):
+        """SSE chat.completion.chunk cho nhiều choice (n>1, prompt dạng mảng), đan xen theo index
+
+        model_out: tên model hiển thị trong chunk (vd. "<model>:latest" ở mode ollama)
+        include_usage: thêm chunk usage (choices rỗng, cùng id/created) trước [DONE]
+        """
+        model = model_out or requests_data[0].get('model', 'qwen3-235b-a22b')
+        completion_id = uuid.uuid4().hex[:24]
+        created = int(time.time())
+        writers = [self._chunk_writer(model, index, completion_id, created) for index in range(len(requests_data))]
+        for index, kind, text in self.fan_out_events(requests_data, request_states, use_cache):
+            chunk = writers[index]
+            if kind == ANSWER or kind == THINK:
+                yield chunk(text)
+            elif kind == THINK_START:
+                yield chunk("<think>")
+            elif kind == THINK_END:
+                yield chunk("</think>")
+            elif kind == FINISH:
+                yield chunk("", text)
+            elif kind == CHOICE_ERROR:
+                yield f"data: {json.dumps({'error': text, 'index': index})}\n\n"
+        if include_usage:
+            usage = {
+                "id": "chatcmpl-" + completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "system_fingerprint": model,
+                "choices": [],
+                "usage": self.choices_usage(request_states, choices_per_prompt)
+            }
+            yield f"data: {json.dumps(usage)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def complete_choices(self, requests_data, request_states, use_cache=True, choices_per_prompt=None):
+        """Body chat.completion với một choice cho mỗi request, ghép theo index.
+
+        Choice lỗi có finish_reason "error" + error; trả về (error, 500) nếu mọi choice đều lỗi.
+        choices_per_prompt: số choice mỗi prompt (n) để usage chỉ tính prompt một lần.
+        """
+        model = requests_data[0].get('model', 'qwen3-235b-a22b')
+        thinking = [[] for _ in requests_data]
+        answers = [[] for _ in requests_data]
+        finish = [None] * len(requests_data)
+        errors = [None] * len(requests_data)
+        for index, kind, text in self.fan_out_events(requests_data, request_states, use_cache):
+            if kind == ANSWER:
+                answers[index].append(text)
+            elif kind == THINK:
+                thinking[index].append(text)
+            elif kind == FINISH:
+                finish[index] = text
+            elif kind == CHOICE_ERROR:
+                errors[index] = text
+        if all(errors):
+            return {"error": {"message": errors[0], "type": "server_error"}}, 500
+
+        result = self._completion_response(model, "")
+        choices = []
+        for index in range(len(requests_data)):
+            choice = {
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": self._join_thinking(''.join(thinking[index]), ''.join(answers[index]))
+                },
+                "finish_reason": "error" if errors[index] else (finish[index] or "stop")
+            }
+            if errors[index]:
+                choice["error"] = {"message": errors[index], "type": "server_error"}
+            choices.append(choice)
+        result['choices'] = choices
+        result['usage'] = self.choices_usage(request_states, choices_per_prompt)
+        return result
+
+    def stream_qwen_response_non_streaming(self, data, request_state=None, use_cache=True):
+        """Non-streaming response from Qwen API
+
+        Qwen luôn được gọi ở chế độ stream rồi gom lại: đo được TTFT/tốc độ sinh token thật
+        và response cache lưu được chuỗi delta.
+        """
         model = data.get('model', 'qwen3-235b-a22b')
+        if request_state is None:
+            request_state = RequestState(str(uuid.uuid4()), model)
+        request_state.set_prompt(data.get('messages'))
         
         try:
-            # Sử dụng chat_id hiện tại hoặc tạo mới nếu chưa có
-            chat_id = chat_manager.get_current_chat_id()
-            if not chat_id:
-                chat_id = chat_manager.initialize_chat(model)
+            upstream, cache_key = qwen_upstream.lookup(data, request_state, use_cache)
+            if upstream is None:
+                # Sử dụng chat_id hiện tại hoặc tạo mới nếu chưa có
+                chat_id, parent_id = self._current_chat(model)
                 if not chat_id:
                     return {
                         "error": {
@@ -518,128 +351,46 @@ class ChatService:
                             "type": "server_error"
                         }
                     }, 500
-            
-            # Lấy parent_id hiện tại
-            parent_id = chat_manager.get_current_parent_id()
-            
-            # Chuẩn bị request cho Qwen API
-            qwen_data = qwen_service.prepare_qwen_request(data, chat_id, model, parent_id)
-            
-            # Gửi request đến Qwen API
-            headers = build_header(QWEN_HEADERS)
-
-            response = requests.post(
-                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
-                headers=headers,
-                json=qwen_data,
-                timeout=300  # 5 phút timeout
-            )
-                        
-            # Kiểm tra response content cho non-streaming
-            try:
                 
-                # Kiểm tra content-type để xử lý phù hợp
-                content_type = response.headers.get('content-type', '')
-                if 'application/json' in content_type:
-                    try:
-                        response_json = response.json()
-                        
-                        if not response_json.get('success', True):
-                            error_code = response_json.get('data', {}).get('code', 'Unknown')
-                            error_details = response_json.get('data', {}).get('details', 'Unknown error')
-                            logger.error(f"Qwen API error: {error_code} - {error_details}")
-                            
-                            if error_code == "Bad_Request" and "chat is in progress" in error_details:
-                                error_msg = "Chat is currently in progress. Please wait for the current request to complete."
-                            elif error_code == "Bad_Request" and "parent_id" in error_details and "not exist" in error_details:
-                                # Xử lý lỗi parent_id không tồn tại cho non-streaming
-                                logger.warning(f"Parent ID not exist error detected: {error_details}")
-                                
-                                # Tạo chat mới và reset parent_id
-                                new_chat_id = chat_manager.create_new_chat(model)
-                                if new_chat_id:
-                                    # Gửi lại request với parent_id = None
-                                    qwen_data = qwen_service.prepare_qwen_request(data, new_chat_id, model, None)
-                                    
-                                    retry_response = requests.post(
-                                        f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={new_chat_id}",
-                                        headers=headers,
-                                        json=qwen_data,
-                                        timeout=300
-                                    )
-                                    
-                                    if retry_response.status_code == 200:
-                                        # Tiếp tục xử lý response từ retry
-                                        response = retry_response
-                                        # Tiếp tục xử lý response bình thường
-                                        return self._process_qwen_non_streaming_response(response, model)
-                                    else:
-                                        logger.error(f"Retry failed with status: {retry_response.status_code}")
-                                        error_msg = f"Failed to retry with new chat: {retry_response.status_code}"
-                                        return {
-                                            "error": {
-                                                "message": error_msg,
-                                                "type": "server_error"
-                                            }
-                                        }, 500
-                                else:
-                                    logger.error("Failed to create new chat for retry")
-                                    error_msg = "Failed to create new chat for retry"
-                                    return {
-                                        "error": {
-                                            "message": error_msg,
-                                            "type": "server_error"
-                                        }
-                                    }, 500
-                            else:
-                                error_msg = f"Qwen API error: {error_code} - {error_details}"
-                            
-                            return {
-                                "error": {
-                                    "message": error_msg,
-                                    "type": "server_error"
-                                }
-                            }, 500
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing JSON response: {e}")
-                else:
-                    logger.info(f"Qwen API response is not JSON (content-type: {content_type})")
-            except Exception as e:
-                logger.error(f"Error reading response content: {e}")
-            
-            if response.status_code == 200:
-                result = self._process_qwen_non_streaming_response(response, model)
-                try:
-                    # Extract user message and assistant full content for chat history
-                    user_text = ""
-                    msgs = data.get('messages') or []
-                    for m in reversed(msgs):
-                        if isinstance(m, dict) and m.get('role') == 'user':
-                            user_text = str(m.get('content') or '')
-                            break
-                    assistant_text = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                    # Fallback nếu content rỗng: gom lại qua stream
-                    if not assistant_text:
-                        assistant_text = self._collect_full_content_via_stream(data, model)
-                        if assistant_text:
-                            # cập nhật vào result để trả về cho client theo OpenAI format
-                            try:
-                                result['choices'][0]['message']['content'] = assistant_text
-                                # usage tokens có thể không chính xác; giữ nguyên nếu có
-                            except Exception:
-                                pass
-                    ui_manager.add_chat_messages(user_text, assistant_text)
-                except Exception:
-                    pass
-                return result
-            else:
-                return {
-                    "error": {
-                        "message": f"Error from Qwen API: {response.status_code}",
-                        "type": "server_error"
-                    }
-                }, 500
+                upstream = qwen_upstream.open(data, model, chat_id, parent_id, request_state,
+                                              chat_manager.create_new_chat, cache_key=cache_key)
+            result = self._completion_response(model, self._join_thinking(*upstream.collect()),
+                                               request_state=request_state)
+            if upstream.cached:
+                result['x_cache'] = upstream.cache_info
+            try:
+                # Extract user message and assistant full content for chat history
+                user_text = ""
+                msgs = data.get('messages') or []
+                for m in reversed(msgs):
+                    if isinstance(m, dict) and m.get('role') == 'user':
+                        user_text = str(m.get('content') or '')
+                        break
+                assistant_text = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+                # Fallback nếu content rỗng: gom lại qua stream
+                if not assistant_text:
+                    assistant_text = self._collect_full_content_via_stream(data, model)
+                    if assistant_text:
+                        # cập nhật vào result để trả về cho client theo OpenAI format
+                        try:
+                            result['choices'][0]['message']['content'] = assistant_text
+                            request_state.add_output(assistant_text)
+                            result['usage'] = request_state.openai_usage()
+                        except Exception:
+                            pass
+                ui_manager.add_chat_messages(user_text, assistant_text)
+            except Exception:
+                pass
+            request_state.mark_finished()
+            return result
                 
+        except UpstreamError as e:
+            return {
+                "error": {
+                    "message": e.message,
+                    "type": "server_error"
+                }
+            }, 500
         except requests.exceptions.Timeout:
             return {
                 "error": {
@@ -0,0 +1,274 @@
+import re
+import zlib
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+import os
+from config import (
+    EMBEDDING_DIM,
+    EMBEDDING_LRU_SIZE,
+    EMBEDDING_BACKEND,
+    EMBEDDING_HASH_BUCKETS,
+    EMBEDDING_CACHE_DIR,
+    EMBEDDING_CACHE_MAX_ROWS,
+)
+from utils.embedding_store import EmbeddingStore
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Từ phổ biến (tiếng Anh + tiếng Việt) bị giảm trọng số ở feature unigram
+_STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have he her his i in is it its of on or our she
+so that the their them they this to was we were what when which who will with you your
+và là của có cho các những được một không với này đã trong thì mà để như khi
+""".split())
+_STOP_WORD_WEIGHT = 0.1
+
+# Trọng số IDF tĩnh theo loại feature (feature càng hiếm/đặc trưng càng nặng)
+_CHAR_NGRAM_WEIGHTS = {3: 0.5, 4: 0.7, 5: 0.9}
+_WORD_WEIGHT = 1.0
+_BIGRAM_WEIGHT = 1.3
+
+_HASH_MULT = np.uint64(0x100000001B3)
+_MIX_MULT = np.uint64(0x9E3779B97F4A7C15)
+# Số phần tử khác 0 trên mỗi hàng của ma trận chiếu thưa
+_PROJECTION_NNZ = 8
+_PROJECTION_SEED = 0x5157454E
+# Số document mỗi lượt chiếu (giới hạn bộ nhớ mảng bincount)
+_PROJECTION_CHUNK = 4096
+
+
+def _mix(h, salt):
+    """Trộn hash uint64 (vectorized) để bit cao phân bố đều"""
+    h = (h ^ np.uint64(salt)) * _MIX_MULT
+    return h ^ (h >> np.uint64(29))
+
+
+class HashingEmbedder:
+    """Embedding cục bộ kiểu hashing trick, không cần tải model hay mạng.
+
+    - Feature: char n-gram 3..5 (trên text đã chuẩn hóa, có khoảng trắng biên), từ đơn, cặp từ
+    - Hash feature vào `buckets` bucket có dấu (signed hashing để giảm va chạm)
+    - TF sublinear (log1p) x IDF tĩnh theo loại feature, stop word bị giảm trọng số
+    - Chiếu ngẫu nhiên thưa (mỗi bucket -> _PROJECTION_NNZ chiều, dấu ±1, seed cố định)
+      xuống `dim` chiều rồi chuẩn hóa L2
+
+    Toàn bộ batch được xử lý bằng NumPy: char n-gram dùng rolling hash trên mảng
+    codepoint của cả batch, từ được hash một lần cho mỗi từ khác nhau trong batch.
+    """
+
+    def __init__(self, dim, buckets=EMBEDDING_HASH_BUCKETS):
+        self.dim = dim
+        self.buckets = buckets
+        rng = np.random.default_rng(_PROJECTION_SEED)
+        nnz = min(_PROJECTION_NNZ, dim)
+        self.proj_index = np.argpartition(rng.random((buckets, dim)), nnz - 1, axis=1)[:, :nnz].astype(np.int64)
+        signs = rng.integers(0, 2, size=(buckets, nnz)) * 2 - 1
+        self.proj_value = (signs / np.sqrt(nnz)).astype(np.float64)
+
+    @staticmethod
+    def _char_features(normalized):
+        """Trả về (doc_idx, hash, weight) của mọi char n-gram trong batch"""
+        lengths = np.fromiter((len(t) for t in normalized), dtype=np.int64, count=len(normalized))
+        codes = np.frombuffer("".join(normalized).encode("utf-32-le"), dtype="<u4").astype(np.uint64)
+        doc_of = np.repeat(np.arange(len(normalized), dtype=np.int64), lengths)
+        ends = np.repeat(np.cumsum(lengths), lengths)
+        positions = np.arange(codes.size, dtype=np.int64)
+
+        docs, hashes, weights = [], [], []
+        h = np.zeros(codes.size, dtype=np.uint64)
+        for n in range(1, max(_CHAR_NGRAM_WEIGHTS) + 1):
+            # h[i] = hash(codes[i:i+n]) cập nhật dần từ n-1
+            valid_len = codes.size - n + 1
+            if valid_len <= 0:
+                break
+            h = h[:valid_len] * _HASH_MULT + codes[n - 1:]
+            if n not in _CHAR_NGRAM_WEIGHTS:
+                continue
+            valid = positions[:valid_len] + n <= ends[:valid_len]
+            docs.append(doc_of[:valid_len][valid])
+            hashes.append(_mix(h[valid], n))
+            weights.append(np.full(docs[-1].size, _CHAR_NGRAM_WEIGHTS[n]))
+        return docs, hashes, weights
+
+    @staticmethod
+    def _word_features(token_lists):
+        """Trả về (doc_idx, hash, weight) của từ đơn và cặp từ"""
+        vocab = {}
+        ids = np.fromiter(
+            (vocab.setdefault(tok, len(vocab)) for tokens in token_lists for tok in tokens),
+            dtype=np.int64,
+        )
+        counts = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=len(token_lists))
+        doc = np.repeat(np.arange(len(token_lists), dtype=np.int64), counts)
+
+        vocab_hash = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in vocab), dtype=np.uint64, count=len(vocab))
+        vocab_weight = np.fromiter(
+            (_STOP_WORD_WEIGHT if w in _STOP_WORDS else _WORD_WEIGHT for w in vocab),
+            dtype=np.float64,
+            count=len(vocab),
+        )
+        words = vocab_hash[ids]
+        # Cặp từ liền nhau trong cùng document
+        pair = doc[:-1] == doc[1:]
+        bigrams = words[:-1][pair] * _HASH_MULT + words[1:][pair]
+        return (
+            [doc, doc[:-1][pair]],
+            [_mix(words, 101), _mix(bigrams, 102)],
+            [vocab_weight[ids], np.full(bigrams.size, _BIGRAM_WEIGHT)],
+        )
+
+    def embed(self, texts):
+        token_lists = [_WORD_RE.findall(t.lower()) for t in texts]
+        normalized = [" " + " ".join(tokens) + " " for tokens in token_lists]
+
+        char_docs, char_hashes, char_weights = self._char_features(normalized)
+        word_docs, word_hashes, word_weights = self._word_features(token_lists)
+        docs = np.concatenate(char_docs + word_docs)
+        hashes = np.concatenate(char_hashes + word_hashes)
+        weights = np.concatenate(char_weights + word_weights)
+
+        # Gộp theo (document, bucket): TF có dấu, rồi lấy TF sublinear giữ dấu
+        buckets = ((hashes >> np.uint64(32)) % np.uint64(self.buckets)).astype(np.int64)
+        signed = np.where(hashes & np.uint64(1), -weights, weights)
+        cells, inverse = np.unique(docs * self.buckets + buckets, return_inverse=True)
+        tf = np.bincount(inverse.ravel(), weights=signed, minlength=cells.size)
+        tf = np.copysign(np.log1p(np.abs(tf)), tf)
+        cell_doc = cells // self.buckets
+        cell_bucket = cells % self.buckets
+
+        # Chiếu thưa: mỗi ô (doc, bucket) cộng vào _PROJECTION_NNZ chiều của output
+        n = len(texts)
+        out = np.empty((n, self.dim), dtype=np.float32)
+        bounds = np.searchsorted(cell_doc, np.arange(0, n + _PROJECTION_CHUNK, _PROJECTION_CHUNK))
+        for chunk, start in enumerate(range(0, n, _PROJECTION_CHUNK)):
+            lo, hi = bounds[chunk], bounds[chunk + 1]
+            rows = min(_PROJECTION_CHUNK, n - start)
+            b = cell_bucket[lo:hi]
+            target = (cell_doc[lo:hi, None] - start) * self.dim + self.proj_index[b]
+            values = tf[lo:hi, None] * self.proj_value[b]
+            dense = np.bincount(target.ravel(), weights=values.ravel(), minlength=rows * self.dim)
+            out[start:start + rows] = dense.reshape(rows, self.dim)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+
+class EmbeddingService:
+    """Sinh embedding dùng chung cho /api/embed và /v1/embeddings.
+
+    Backend "hashing" (mặc định) dùng HashingEmbedder; backend "random" sinh vector
+    tất định từ SHAKE-256 của text (không có ngữ nghĩa). Cả batch được xử lý bằng
+    NumPy trong một lượt, kết quả được giữ trong LRU theo hash text và (nếu bật)
+    trong EmbeddingStore trên đĩa, nên lần chạy sau không phải sinh lại.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, cache_size=EMBEDDING_LRU_SIZE, backend=EMBEDDING_BACKEND,
+                 cache_dir=EMBEDDING_CACHE_DIR):
+        self.dim = dim
+        self.cache_size = cache_size
+        if backend not in ("hashing", "random"):
+            logger.warning(f"Unknown embedding backend '{backend}', using 'hashing'")
+            backend = "hashing"
+        self.backend = backend
+        self._hashing = HashingEmbedder(dim) if backend == "hashing" else None
+        # Vector chiếu thưa: giảm `dimensions` bằng cách gập cột thay vì cắt prefix
+        self.fold_dimensions = backend == "hashing"
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self._store = None
+        self._store_ready = False
+
+    def _get_store(self):
+        """Mở EmbeddingStore lần đầu cần dùng; lỗi đĩa thì chỉ dùng cache bộ nhớ"""
+        if self._store_ready:
+            return self._store
+        with self._lock:
+            if not self._store_ready:
+                if self.cache_dir:
+                    # Vector khác nhau theo backend/số chiều nên mỗi cấu hình một thư mục
+                    name = f"{self.backend}-{self.dim}"
+                    if self._hashing is not None:
+                        name = f"{self.backend}-b{self._hashing.buckets}-{self.dim}"
+                    try:
+                        self._store = EmbeddingStore(os.path.join(self.cache_dir, name), self.dim, EMBEDDING_CACHE_MAX_ROWS)
+                    except Exception as e:
+                        logger.warning(f"Embedding disk cache disabled: {e}")
+                self._store_ready = True
+        return self._store
+
+    @staticmethod
+    def _normalize_text(text):
+        return text if isinstance(text, str) else str(text)
+
+    @staticmethod
+    def _text_key(text):
+        return hashlib.sha256(text.encode('utf-8', 'ignore')).digest()
+
+    def _generate(self, texts):
+        """Sinh ma trận (len(texts), dim) float32 cho các text chưa có trong cache"""
+        if self._hashing is not None:
+            return self._hashing.embed(texts)
+        nbytes = self.dim * 4
+        buf = b"".join(
+            hashlib.shake_256(t.encode('utf-8', 'ignore')).digest(nbytes) for t in texts
+        )
+        raw = np.frombuffer(buf, dtype='<u4').reshape(len(texts), self.dim)
+        # Ánh xạ uint32 -> [-0.05, 0.05), dải giá trị giống embedding đã chuẩn hóa
+        return (raw * (0.1 / 2 ** 32) - 0.05).astype(np.float32)
+
+    def embed(self, texts):
+        """Trả về ma trận embedding float32 shape (len(texts), dim)"""
+        texts = [self._normalize_text(t) for t in texts]
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        if not texts:
+            return out
+
+        keys = [self._text_key(t) for t in texts]
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                row = self._cache.get(key)
+                if row is not None:
+                    self._cache.move_to_end(key)
+                    out[i] = row
+                else:
+                    missing.setdefault(key, []).append(i)
+
+        if not missing:
+            return out
+        miss_keys = list(missing.keys())
+        found = {}
+        store = self._get_store()
+        if store is not None:
+            positions, vectors = store.get_many(miss_keys)
+            found = {miss_keys[p]: vectors[j] for j, p in enumerate(positions)}
+
+        to_generate = [k for k in miss_keys if k not in found]
+        if to_generate:
+            generated = self._generate([texts[missing[k][0]] for k in to_generate])
+            found.update(zip(to_generate, generated))
+            if store is not None:
+                try:
+                    store.add_many(to_generate, generated)
+                except Exception as e:
+                    logger.warning(f"Failed to write embedding disk cache: {e}")
+
+        with self._lock:
+            for key, row in found.items():
+                out[missing[key]] = row
+                # copy để cache không giữ cả ma trận batch
+                self._cache[key] = row.copy()
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return out
+
+
+# Global embedding service instance
+embedding_service = EmbeddingService()
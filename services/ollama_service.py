@@ -1,15 +1,13 @@
 import json
-import time
 import uuid
-import requests
 import logging
-from datetime import datetime
 from models.request_state import RequestState
 from services.qwen_service import qwen_service
-from utils.chat_manager import chat_manager
+from services.qwen_upstream import qwen_upstream, UpstreamError, THINK_START, THINK, THINK_END, ANSWER, FINISH
 from utils.ui_manager import ui_manager
-from config import QWEN_HEADERS, QWEN_CHAT_COMPLETIONS_URL
-from utils.cookie_parser import build_header
+from utils.session_cache import session_cache
+from utils.session_table import session_table, parse_keep_alive
+from utils.ollama_format import OllamaChunkWriter
 
 logger = logging.getLogger(__name__)
 
@@ -18,532 +16,215 @@ class OllamaService:
     
     def __init__(self):
         pass
+
+    def _open_session(self, session_key, model, client_key=None):
+        """Chọn chat upstream, trả về (chat_id, parent_id, session).
+
+        Thứ tự: session của `context` handle -> session ấm (keep_alive) của model + client
+        -> tạo chat mới. Session ấm chỉ tiết kiệm bước tạo chat: client Ollama gửi lại toàn bộ
+        lịch sử mỗi request (và mọi client local chung địa chỉ) nên lượt mới bắt đầu nhánh mới
+        (parent_id None), chỉ `context` handle mới nối tiếp hội thoại.
+        """
+        session = session_cache.get(session_key, model) if session_key is not None else None
+        if session:
+            return session['chat_id'], session['parent_id'], session
+        if client_key is not None:
+            warm = session_table.acquire(model, client_key)
+            if warm:
+                logger.info(f"Reusing warm chat {warm['chat_id']} for {model} ({client_key})")
+                return warm['chat_id'], None, None
+        return qwen_service.create_new_chat(model), None, None
+
+    def _close_session(self, model, client_key, keep_alive, session, chat_id, response_id, parent_id, completed):
+        """Trả chat về session table theo keep_alive (bỏ nếu request lỗi)"""
+        if client_key is None or session is not None or not chat_id:
+            return
+        if not completed:
+            session_table.discard(model, client_key, chat_id)
+            return
+        session_table.release(model, client_key, chat_id, response_id or parent_id, parse_keep_alive(keep_alive))
+
+    def _save_session(self, session_key, session, model, chat_id, response_id, request_state):
+        """Lưu/cập nhật session sau khi response xong, trả về context handle cho client"""
+        tokens = request_state.prompt_tokens + request_state.completion_tokens
+        if session is not None and session['chat_id'] == chat_id:
+            session_cache.update(
+                session_key,
+                parent_id=response_id or session['parent_id'],
+                token_count=session['token_count'] + tokens,
+            )
+        else:
+            session_key = session_cache.create(model, chat_id, response_id, tokens)
+        return session_cache.encode_context(session_key)
     
-    def stream_ollama_response(self, data):
-        """Stream Ollama response format - Direct Qwen API call with think mode support"""
+    def _writer(self, target, model, model_name=None):
+        """Chunk writer theo endpoint: /api/chat (mặc định) hoặc /api/generate"""
+        if target == "generate":
+            return OllamaChunkWriter(target, model_name or model)
+        return OllamaChunkWriter(target, model, f"{model}:latest")
+
+    def _last_user_text(self, data):
+        """User message cuối cùng (hiển thị trong Chat tab)"""
+        for m in reversed(data.get('messages') or []):
+            if isinstance(m, dict) and m.get('role') == 'user':
+                return str(m.get('content') or '')
+        return ""
+
+    def _lookup_cache(self, data, request_state, session_key, use_cache):
+        """Tra response cache; request tiếp tục `context` handle phụ thuộc lịch sử upstream nên không dùng cache"""
+        if session_key is not None:
+            return None, None
+        return qwen_upstream.lookup(data, request_state, use_cache)
+
+    def _context_of(self, upstream, session_key, session, model, request_state):
+        """Context handle cho client; response phát lại từ cache không có chat upstream nên trả []"""
+        if upstream.cached:
+            return []
+        return self._save_session(session_key, session, model, upstream.chat_id, upstream.response_id, request_state)
+
+    def stream_ollama_response(self, data, request_state=None, session_key=None, with_context=False,
+                               client_key=None, keep_alive=None, target="chat", model_name=None, use_cache=True):
+        """Stream Ollama response format - Direct Qwen API call with think mode support
+
+        session_key: tiếp tục chat upstream của session (Ollama `context`)
+        with_context: thêm `context` handle vào chunk cuối (/api/generate)
+        client_key/keep_alive: dùng lại và giữ chat ấm trong session_table
+        target: "chat" (message.content) hoặc "generate" (response); model_name là tên
+        model client gửi lên, dùng cho chunk của /api/generate
+        use_cache=False: bỏ qua response cache (header bypass của client)
+        """
         model = data.get('model', 'qwen3-235b-a22b')
-        request_id = str(uuid.uuid4())
-        request_state = RequestState(request_id, model)
+        writer = self._writer(target, model, model_name)
+        if request_state is None:
+            request_state = RequestState(str(uuid.uuid4()), model)
+        request_state.set_prompt(data.get('messages'))
+        chat_id = parent_id = session = upstream = None
                 
         try:
-            stream_start_ns = time.perf_counter_ns()
-            first_token_ns = None
-            output_token_count = 0
-            input_token_count = 0
-            # Ước lượng token đầu vào dựa trên số từ trong messages
-            try:
-                msgs = data.get('messages') or []
-                if isinstance(msgs, list):
-                    for m in msgs:
-                        if isinstance(m, dict):
-                            txt = m.get('content') or ""
-                            if isinstance(txt, str):
-                                input_token_count += max(1, len(txt.strip().split()))
-            except Exception:
-                pass
-            # Tạo chat mới
-            chat_id = qwen_service.create_new_chat(model)
-            if not chat_id:
-                logger.error("Failed to create chat for Ollama request")
-                yield json.dumps({"error": "Failed to create chat"}) + "\n"
-                return
-            
-            # Chuẩn bị request data
-            qwen_data = qwen_service.prepare_qwen_request(data, chat_id, model)
-            
-            # Gọi Qwen API với streaming
-            headers = build_header(QWEN_HEADERS)
-
-            response = requests.post(
-                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
-                headers=headers,
-                json=qwen_data,
-                stream=True,
-                timeout=300
-            )
-            
-            # Kiểm tra response content trước khi xử lý
-            try:
-                content_type = response.headers.get('content-type', '')
-                if 'application/json' in content_type:
+            upstream, cache_key = self._lookup_cache(data, request_state, session_key, use_cache)
+            if upstream is None:
+                # Tiếp tục session hoặc tạo chat mới
+                chat_id, parent_id, session = self._open_session(session_key, model, client_key)
+                if not chat_id:
+                    logger.error("Failed to create chat for Ollama request")
+                    yield json.dumps({"error": "Failed to create chat"}) + "\n"
+                    return
+                
+                upstream = qwen_upstream.open(data, model, chat_id, parent_id, request_state,
+                                              qwen_service.create_new_chat, cache_key=cache_key)
+            # Thu thập nội dung assistant để hiển thị vào Chat khi DONE
+            collected_answer = []
+            for kind, text in upstream.events():
+                if kind == ANSWER:
+                    collected_answer.append(text)
+                    yield writer.content(text)
+                elif kind == THINK:
+                    yield writer.content(text)
+                elif kind == THINK_START:
+                    yield writer.content("<think>")
+                elif kind == THINK_END:
+                    yield writer.content("</think>")
+                elif kind == FINISH:
+                    final_chunk = writer.final(**request_state.ollama_stats())
+                    if with_context:
+                        final_chunk["context"] = self._context_of(upstream, session_key, session, model, request_state)
+                    if upstream.cached:
+                        final_chunk["x_cache"] = upstream.cache_info
+                    # Đẩy lịch sử chat vào UI
                     try:
-                        response_json = response.json()
-                        
-                        if not response_json.get('success', True):
-                            error_code = response_json.get('data', {}).get('code', 'Unknown')
-                            error_details = response_json.get('data', {}).get('details', 'Unknown error')
-                            logger.error(f"Qwen API error: {error_code} - {error_details}")
-                            # If model not found, return Ollama-style error immediately
-                            if error_code == "Not_Found" and "Model not found" in str(error_details):
-                                err = {"error": f"model '{data.get('model', model)}' not found"}
-                                yield json.dumps(err) + "\n"
-                                return
-                            
-                            if error_code == "Bad_Request" and "parent_id" in error_details and "not exist" in error_details:
-                                # Xử lý lỗi parent_id không tồn tại
-                                logger.warning(f"Parent ID not exist error detected: {error_details}")
-                                
-                                # Tạo chat mới và reset parent_id
-                                new_chat_id = qwen_service.create_new_chat(model)
-                                if new_chat_id:
-                                    # Gửi lại request với parent_id = None
-                                    qwen_data = qwen_service.prepare_qwen_request(data, new_chat_id, model)
-                                    
-                                    retry_response = requests.post(
-                                        f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={new_chat_id}",
-                                        headers=headers,
-                                        json=qwen_data,
-                                        stream=True,
-                                        timeout=300
-                                    )
-                                    
-                                    if retry_response.status_code == 200:
-                                        # Tiếp tục xử lý response từ retry
-                                        response = retry_response
-                                    else:
-                                        logger.error(f"Retry failed with status: {retry_response.status_code}")
-                                        error_created_at = datetime.now().isoformat() + "Z"
-                                        error_chunk = {
-                                            "model": model,
-                                            "created_at": error_created_at,
-                                            "message": {
-                                                "role": "assistant",
-                                                "content": ""
-                                            },
-                                            "done": True,
-                                            "error": f"Failed to retry with new chat: {retry_response.status_code}"
-                                        }
-                                        yield json.dumps(error_chunk) + "\n"
-                                        return
-                                else:
-                                    logger.error("Failed to create new chat for retry")
-                                    error_created_at = datetime.now().isoformat() + "Z"
-                                    error_chunk = {
-                                        "model": model,
-                                        "created_at": error_created_at,
-                                        "message": {
-                                            "role": "assistant",
-                                            "content": ""
-                                        },
-                                        "done": True,
-                                        "error": "Failed to create new chat for retry"
-                                    }
-                                    yield json.dumps(error_chunk) + "\n"
-                                    return
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing JSON response: {e}")
-            except Exception as e:
-                logger.error(f"Error reading response content: {e}")
-            
-            if response.status_code == 200:
-                done_sent = False
-                # Thu thập nội dung assistant để hiển thị vào Chat khi DONE
-                collected_answer = []
-                last_user_text = ""
-                for line in response.iter_lines():
-                    if line:
-                        line_str = line.decode('utf-8')
-                        if line_str.startswith('data: '):
-                            if first_token_ns is None:
-                                first_token_ns = time.perf_counter_ns()
-                            try:
-                                chunk_data = json.loads(line_str[6:])
-                                
-                                # Xử lý response.created để lấy parent_id và response_id
-                                if 'response.created' in chunk_data:
-                                    response_created = chunk_data['response.created']
-                                    parent_id = response_created.get('parent_id')
-                                    response_id = response_created.get('response_id')
-                                    if parent_id and response_id:
-                                        chat_manager.update_parent_info(parent_id, response_id)
-                                    continue  # Bỏ qua chunk này
-                                
-                                if chunk_data.get('choices') and chunk_data['choices'][0].get('delta'):
-                                    delta = chunk_data['choices'][0]['delta']
-                                    content = delta.get('content', '')
-                                    finish_reason = chunk_data['choices'][0].get('finish_reason', None)
-                                    phase = delta.get('phase', None)
-                                    
-                                    # Log phase nếu có thay đổi
-                                    request_state.log_phase_change(phase)
-                                    
-                                    # Format timestamp như Ollama
-                                    created_at = datetime.now().isoformat() + "Z"
-                                    
-                                    # Xử lý think mode
-                                    if phase == "think":
-                                        # Nếu bắt đầu think mode và chưa gửi <think> tag
-                                        if not request_state.think_started:
-                                            request_state.think_started = True
-                                            # Gửi <think> tag
-                                            ollama_chunk = {
-                                                "model": model,
-                                                "created_at": created_at,
-                                                "message": {
-                                                    "role": "assistant",
-                                                    "content": "<think>"
-                                                },
-                                                "done": False
-                                            }
-                                            yield json.dumps(ollama_chunk) + "\n"
-
-                                        # Gửi content trong think mode
-                                        if content:
-                                            ollama_chunk = {
-                                                "model": model,
-                                                "created_at": created_at,
-                                                "message": {
-                                                    "role": "assistant",
-                                                    "content": content
-                                                },
-                                                "done": False
-                                            }
-                                            # Ước lượng token đầu ra (số từ)
-                                            output_token_count += max(1, len(content.strip().split()))
-                                            yield json.dumps(ollama_chunk) + "\n"
-
-                                        # Nếu think mode kết thúc (status finished)
-                                        if delta.get('status') == 'finished':
-                                            # Gửi </think> tag
-                                            ollama_chunk = {
-                                                "model": model,
-                                                "created_at": created_at,
-                                                "message": {
-                                                    "role": "assistant",
-                                                    "content": "</think>"
-                                                },
-                                                "done": False
-                                            }
-                                            yield json.dumps(ollama_chunk) + "\n"
-                                            # Reset think state
-                                            request_state.think_started = False
-                                    
-                                    elif phase == "answer" or phase is None:
-                                        # Normal content (answer phase hoặc không có phase)
-                                        if content:
-                                            ollama_chunk = {
-                                                "model": model,
-                                                "created_at": created_at,
-                                                "message": {
-                                                    "role": "assistant",
-                                                    "content": content
-                                                },
-                                                "done": False
-                                            }
-                                            # Thu thập content
-                                            try:
-                                                collected_answer.append(content)
-                                            except Exception:
-                                                pass
-                                            output_token_count += max(1, len(content.strip().split()))
-                                            yield json.dumps(ollama_chunk) + "\n"
-                                    
-                                    # Nếu có finish_reason, gửi done message
-                                    if finish_reason:
-                                        final_created_at = datetime.now().isoformat() + "Z"
-                                        total_duration = time.perf_counter_ns() - stream_start_ns
-                                        load_duration = (first_token_ns - stream_start_ns) if first_token_ns else 0
-                                        eval_duration = (time.perf_counter_ns() - first_token_ns) if first_token_ns else 0
-                                        final_chunk = {
-                                            "model": f"{model}:latest",
-                                            "created_at": final_created_at,
-                                            "message": {
-                                                "role": "assistant",
-                                                "content": ""
-                                            },
-                                            "done_reason": "stop",
-                                            "done": True,
-                                            "total_duration": int(total_duration),
-                                            "load_duration": int(load_duration),
-                                            "prompt_eval_count": int(input_token_count),
-                                            "prompt_eval_duration": int(load_duration),
-                                            "eval_count": int(output_token_count),
-                                            "eval_duration": int(eval_duration)
-                                        }
-                                        # Đẩy lịch sử chat vào UI
-                                        try:
-                                            full_answer = ''.join(collected_answer)
-                                            # Trích user text cuối cùng từ data
-                                            try:
-                                                msgs = data.get('messages') or []
-                                                for m in reversed(msgs):
-                                                    if isinstance(m, dict) and m.get('role') == 'user':
-                                                        last_user_text = str(m.get('content') or '')
-                                                        break
-                                            except Exception:
-                                                last_user_text = last_user_text or ""
-                                            ui_manager.add_chat_messages(last_user_text, full_answer)
-                                        except Exception:
-                                            pass
-                                        yield json.dumps(final_chunk) + "\n"
-                                        done_sent = True
-                                        break
-                                        
-                            except json.JSONDecodeError:
-                                continue
-                        elif line_str.startswith('data: [DONE]'):
-                            # Send final done message
-                            final_created_at = datetime.now().isoformat() + "Z"
-                            total_duration = time.perf_counter_ns() - stream_start_ns
-                            load_duration = (first_token_ns - stream_start_ns) if first_token_ns else 0
-                            eval_duration = (time.perf_counter_ns() - first_token_ns) if first_token_ns else 0
-                            
-                            final_chunk = {
-                                "model": f"{model}:latest",
-                                "created_at": final_created_at,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": ""
-                                },
-                                "done_reason": "stop",
-                                "done": True,
-                                "total_duration": int(total_duration),
-                                "load_duration": int(load_duration),
-                                "prompt_eval_count": int(input_token_count),
-                                "prompt_eval_duration": int(load_duration),
-                                "eval_count": int(output_token_count),
-                                "eval_duration": int(eval_duration)
-                            }
-                            try:
-                                full_answer = ''.join(collected_answer)
-                                # Trích user text cuối cùng từ data
-                                try:
-                                    msgs = data.get('messages') or []
-                                    for m in reversed(msgs):
-                                        if isinstance(m, dict) and m.get('role') == 'user':
-                                            last_user_text = str(m.get('content') or '')
-                                            break
-                                except Exception:
-                                    last_user_text = last_user_text or ""
-                                ui_manager.add_chat_messages(last_user_text, full_answer)
-                            except Exception:
-                                pass
-                            yield json.dumps(final_chunk) + "\n"
-                            done_sent = True
-                            break
-                # Nếu vì lý do nào đó không gửi final_chunk ở trên, gửi một bản mặc định
-                if not done_sent:
-                    final_created_at = datetime.now().isoformat() + "Z"
-                    total_duration = time.perf_counter_ns() - stream_start_ns
-                    load_duration = (first_token_ns - stream_start_ns) if first_token_ns else 0
-                    eval_duration = (time.perf_counter_ns() - first_token_ns) if first_token_ns else 0
-                    fallback_chunk = {
-                        "model": f"{model}:latest",
-                        "created_at": final_created_at,
-                        "message": {
-                            "role": "assistant",
-                            "content": ""
-                        },
-                        "done_reason": "stop",
-                        "done": True,
-                        "total_duration": int(total_duration),
-                        "load_duration": int(load_duration),
-                        "prompt_eval_count": int(input_token_count),
-                        "prompt_eval_duration": int(load_duration),
-                        "eval_count": int(output_token_count),
-                        "eval_duration": int(eval_duration)
-                    }
-                    yield json.dumps(fallback_chunk) + "\n"
-            else:
-                logger.error(f"Qwen API error: {response.status_code}")
-                error_created_at = datetime.now().isoformat() + "Z"
-                error_chunk = {
-                    "model": model,
-                    "created_at": error_created_at,
-                    "message": {
-                        "role": "assistant",
-                        "content": ""
-                    },
-                    "done": True,
-                    "error": f"Qwen API error: {response.status_code}"
-                }
-                yield json.dumps(error_chunk) + "\n"
+                        ui_manager.add_chat_messages(self._last_user_text(data), ''.join(collected_answer))
+                    except Exception:
+                        pass
+                    yield json.dumps(final_chunk) + "\n"
                 
+        except UpstreamError as e:
+            if e.model_not_found:
+                # Model không tồn tại: trả lỗi kiểu Ollama
+                yield json.dumps({"error": f"model '{data.get('model', model)}' not found"}) + "\n"
+            else:
+                yield writer.error(e.message)
         except Exception as e:
             logger.error(f"Error in stream_ollama_response: {e}")
-            error_created_at = datetime.now().isoformat() + "Z"
-            error_chunk = {
-                "model": model,
-                "created_at": error_created_at,
-                "message": {
-                    "role": "assistant",
-                    "content": ""
-                },
-                "done": True,
-                "error": str(e)
-            }
-            yield json.dumps(error_chunk) + "\n"
+            yield writer.error(str(e))
+        finally:
+            response_id = None
+            if upstream is not None:
+                chat_id, response_id = upstream.chat_id, upstream.response_id
+            self._close_session(model, client_key, keep_alive, session, chat_id, response_id, parent_id,
+                                request_state.finished_ns is not None)
 
-    def call_ollama_api_direct(self, data):
+    def call_ollama_api_direct(self, data, request_state=None, session_key=None, with_context=False,
+                               client_key=None, keep_alive=None, use_cache=True):
         """Gọi trực tiếp Qwen API và trả về non-streaming response cho Ollama"""
+        model = data.get('model', 'qwen3-235b-a22b')
+        if request_state is None:
+            request_state = RequestState(str(uuid.uuid4()), model)
+        chat_id = parent_id = session = upstream = None
         try:
-            model = data.get('model', 'qwen3-235b-a22b')
-            request_id = str(uuid.uuid4())
-            request_state = RequestState(request_id, model)
-                        
-            # Tạo chat mới
-            chat_id = qwen_service.create_new_chat(model)
-            if not chat_id:
-                logger.error("Failed to create chat for Ollama request")
-                return {'content': 'Error: Failed to create chat'}            
-            # Chuẩn bị request data
-            qwen_data = qwen_service.prepare_qwen_request(data, chat_id, model)
-            
-            # Force streaming để capture content
-            qwen_data['stream'] = True
-            qwen_data['incremental_output'] = True
-                        
-            # Gọi Qwen API với streaming để capture toàn bộ content
-            headers = build_header(QWEN_HEADERS)
-            response = requests.post(
-                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
-                headers=headers,
-                json=qwen_data,
-                stream=True,
-                timeout=300
-            )
-                        
-            # Kiểm tra response content trước khi xử lý
-            try:
-                content_type = response.headers.get('content-type', '')
-                if 'application/json' in content_type:
-                    try:
-                        response_json = response.json()
+            request_state.set_prompt(data.get('messages'))
                         
-                        if not response_json.get('success', True):
-                            error_code = response_json.get('data', {}).get('code', 'Unknown')
-                            error_details = response_json.get('data', {}).get('details', 'Unknown error')
-                            logger.error(f"Qwen API error: {error_code} - {error_details}")
-                            # Map model-not-found error to Ollama-style error
-                            if error_code == "Not_Found" and "Model not found" in str(error_details):
-                                return {"error": f"model '{data.get('model', model)}' not found"}
-                            
-                            if error_code == "Bad_Request" and "parent_id" in error_details and "not exist" in error_details:
-                                # Xử lý lỗi parent_id không tồn tại
-                                logger.warning(f"Parent ID not exist error detected: {error_details}")
-                                
-                                # Tạo chat mới và reset parent_id
-                                new_chat_id = qwen_service.create_new_chat(model)
-                                if new_chat_id:
-                                    # Gửi lại request với parent_id = None
-                                    qwen_data = qwen_service.prepare_qwen_request(data, new_chat_id, model)
-                                    
-                                    retry_response = requests.post(
-                                        f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={new_chat_id}",
-                                        headers=headers,
-                                        json=qwen_data,
-                                        stream=True,
-                                        timeout=300
-                                    )
-                                    
-                                    if retry_response.status_code == 200:
-                                        # Tiếp tục xử lý response từ retry
-                                        response = retry_response
-                                    else:
-                                        logger.error(f"Retry failed with status: {retry_response.status_code}")
-                                        return {'content': f'Error: Failed to retry with new chat: {retry_response.status_code}'}
-                                else:
-                                    logger.error("Failed to create new chat for retry")
-                                    return {'content': 'Error: Failed to create new chat for retry'}
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error parsing JSON response: {e}")
-            except Exception as e:
-                logger.error(f"Error reading response content: {e}")
-            
-            if response.status_code == 200:
-                # Capture toàn bộ content từ stream
-                full_content = ""
-                thinking_content = ""
-                
-                for line in response.iter_lines():
-                    if line:
-                        line_str = line.decode('utf-8')
-                        if line_str.startswith('data: '):
-                            try:
-                                chunk_data = json.loads(line_str[6:])
-                                
-                                # Xử lý response.created
-                                if 'response.created' in chunk_data:
-                                    response_created = chunk_data['response.created']
-                                    parent_id = response_created.get('parent_id')
-                                    response_id = response_created.get('response_id')
-                                    if parent_id and response_id:
-                                        chat_manager.update_parent_info(parent_id, response_id)
-                                    continue
-                                
-                                if chunk_data.get('choices') and chunk_data['choices'][0].get('delta'):
-                                    delta = chunk_data['choices'][0]['delta']
-                                    content = delta.get('content', '')
-                                    phase = delta.get('phase', None)
-                                    
-                                    # Log phase nếu có thay đổi
-                                    request_state.log_phase_change(phase)
-                                    
-                                    # Xử lý think mode
-                                    if phase == "think":
-                                        if content:
-                                            thinking_content += content
-                                        # Nếu think mode kết thúc, reset để chuẩn bị cho answer phase
-                                        if delta.get('status') == 'finished':
-                                            request_state.think_started = False
-                                    
-                                    elif phase == "answer" or phase is None:
-                                        # Normal content (answer phase hoặc không có phase)
-                                        if content:
-                                            full_content += content
-                                            
-                            except json.JSONDecodeError:
-                                continue
-                        elif line_str.startswith('data: [DONE]'):
-                            break
-                
-                return {'content': full_content, 'thinking': thinking_content}
-            else:
-                logger.error(f"Qwen API error: {response.status_code} - {response.text}")
-                return {'content': f'Error: {response.status_code}'}
+            upstream, cache_key = self._lookup_cache(data, request_state, session_key, use_cache)
+            if upstream is None:
+                # Tiếp tục session hoặc tạo chat mới
+                chat_id, parent_id, session = self._open_session(session_key, model, client_key)
+                if not chat_id:
+                    logger.error("Failed to create chat for Ollama request")
+                    return {'content': 'Error: Failed to create chat'}
+
+                # Luôn stream từ Qwen để capture toàn bộ content
+                upstream = qwen_upstream.open(data, model, chat_id, parent_id, request_state,
+                                              qwen_service.create_new_chat, cache_key=cache_key)
+            thinking_content, full_content = upstream.collect()
+            result = {'content': full_content, 'thinking': thinking_content}
+            if with_context:
+                result['context'] = self._context_of(upstream, session_key, session, model, request_state)
+            if upstream.cached:
+                result['x_cache'] = upstream.cache_info
+            return result
                 
+        except UpstreamError as e:
+            if e.model_not_found:
+                return {"error": f"model '{data.get('model', model)}' not found"}
+            return {'content': f'Error: {e.message}'}
         except Exception as e:
             logger.error(f"Error in call_ollama_api_direct: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
             return {'content': f'Error: {str(e)}'}
+        finally:
+            response_id = None
+            if upstream is not None:
+                chat_id, response_id = upstream.chat_id, upstream.response_id
+            self._close_session(model, client_key, keep_alive, session, chat_id, response_id, parent_id,
+                                request_state.finished_ns is not None)
 
-    def stream_ollama_response_non_streaming(self, data):
+    def stream_ollama_response_non_streaming(self, data, session_key=None, with_context=False,
+                                             client_key=None, keep_alive=None, target="chat", model_name=None,
+                                             use_cache=True):
         """Non-streaming Ollama response format - Direct Qwen API call"""
         model = data.get('model', 'qwen3-235b-a22b')
-        request_id = str(uuid.uuid4())
+        writer = self._writer(target, model, model_name)
+        request_state = RequestState(str(uuid.uuid4()), model)
                 
         try:
             # Gọi trực tiếp Qwen API và convert sang Ollama format
-            response = self.call_ollama_api_direct(data)
+            response = self.call_ollama_api_direct(data, request_state, session_key, with_context,
+                                                   client_key, keep_alive, use_cache)
             
             if response and isinstance(response, dict):
                 content = response.get('content', '')
                 thinking = response.get('thinking', '')
                 
-                # Format timestamp như Ollama
-                created_at = datetime.now().isoformat() + "Z"
-                
-                ollama_response = {
-                    "model": model,
-                    "created_at": created_at,
-                    "message": {
-                        "role": "assistant",
-                        "content": content
-                    },
-                    "done_reason": "stop",
-                    "done": True,
-                    "total_duration": 2497343200,
-                    "load_duration": 1837218100,
-                    "prompt_eval_count": 13,
-                    "prompt_eval_duration": 147000000,
-                    "eval_count": 31,
-                    "eval_duration": 511000000
-                }
-                
                 # Thêm thinking content vào content field với <think> tags nếu có
                 if thinking:
-                    ollama_response["message"]["content"] = f"<think>{thinking}</think>\n\n{content}"
+                    content = f"<think>{thinking}</think>\n\n{content}"
+                
+                ollama_response = writer.message(content, done_reason="stop", done=True,
+                                                 **request_state.ollama_stats())
+                if 'context' in response:
+                    ollama_response["context"] = response['context']
+                if 'x_cache' in response:
+                    ollama_response["x_cache"] = response['x_cache']
                 
                 # Push to chat history (only user request and full response content)
                 try:
@@ -553,7 +234,7 @@ class OllamaService:
                         if isinstance(m, dict) and m.get('role') == 'user':
                             user_text = str(m.get('content') or '')
                             break
-                    assistant_text = ollama_response.get('message', {}).get('content', '')
+                    assistant_text = content
                     ui_manager.add_chat_messages(user_text, assistant_text)
                 except Exception:
                     pass
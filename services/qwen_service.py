@@ -3,17 +3,23 @@ import time
 import uuid
 import json
 import logging
-import os
 import base64
-import hashlib
-from urllib.parse import urlparse, parse_qs, unquote_plus
-from config import QWEN_HEADERS, QWEN_MODELS_URL, QWEN_NEW_CHAT_URL, QWEN_CHAT_COMPLETIONS_URL, QWEN_COMPLETIONS_BODY_VERSION, QWEN_REFERER_NEW_CHAT, TMP_FOLDER, curl_user_agent, QWEN_API_BASE
+from config import QWEN_HEADERS, QWEN_MODELS_URL, QWEN_NEW_CHAT_URL, QWEN_CHAT_COMPLETIONS_URL, QWEN_COMPLETIONS_BODY_VERSION, QWEN_REFERER_NEW_CHAT, curl_user_agent, QWEN_API_BASE, QWEN_UPLOAD_URL
 from utils.cookie_parser import build_header
+from utils.attachment_ingest import ingest_attachment, MultipartFileStream
+from utils.file_types import detect_file_type
+from utils.image_preprocess import image_preprocessor
+from utils.singleflight import SingleFlight
+from utils.upload_cache import upload_cache
+from utils.metrics import UPLOADS, UPLOAD_BYTES, UPLOAD_DURATION
+from utils.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
-"""Cache global cho files đã upload: [{ 'file_url': str, 'hashed': str }]"""
-images_hashed = []
+# Gộp các upload đồng thời cùng nội dung (key: sha256)
+upload_flight = SingleFlight()
+# Timeout (giây) cho mỗi lần upload file
+UPLOAD_TIMEOUT = 30
 
 class QwenService:
     """Service để tương tác với Qwen API"""
@@ -80,19 +86,10 @@ class QwenService:
             logger.error(f"Error fetching models from Qwen API: {e}")
             return []
     
+    @tracer.traced("chat.create")
     def create_new_chat(self, model="qwen3-235b-a22b"):
         """Tạo chat mới từ Qwen API với model được chỉ định"""
         try:
-            # Clear cache files khi tạo chat mới
-            global images_hashed
-            try:
-                cache_size = len(images_hashed)
-                images_hashed.clear()
-                logger.info(f"Cleared file cache ({cache_size} files)")
-            except Exception:
-                images_hashed = []
-                logger.info("Reset file cache")
-
             chat_data = {
                 "title": "New Chat",
                 "models": [model],
@@ -142,6 +139,127 @@ class QwenService:
             logger.error(f"Error deleting all chats: {e}")
             return False
     
+    def _upload_attachment(self, attachment, file_type, ext, content_type):
+        """Upload attachment, dùng lại URL đã cache theo hash nội dung.
+
+        Các request đồng thời mang cùng nội dung (chưa có trong cache) chỉ upload một lần:
+        request đầu tiên upload, các request còn lại chờ và dùng chung kết quả.
+        Returns: entry cache { file_url, size, content_type } hoặc None nếu upload lỗi.
+        """
+        hashed = attachment.hashed
+        cached = upload_cache.get(hashed)
+        if cached:
+            logger.info(f"Using cached file URL for {hashed[:8]}...: {cached['file_url']}")
+            return cached
+
+        entry, shared = upload_flight.do(
+            hashed,
+            lambda: self._upload_new_attachment(attachment, file_type, ext, content_type),
+            timeout=UPLOAD_TIMEOUT * 2,
+        )
+        if shared and entry:
+            logger.info(f"Shared in-flight upload for {hashed[:8]}...: {entry['file_url']}")
+        return entry
+
+    @tracer.traced("upload")
+    def _upload_new_attachment(self, attachment, file_type, ext, content_type):
+        """Upload attachment chưa có trong cache lên 0x0.st và lưu vào cache"""
+        hashed = attachment.hashed
+        # Kiểm tra lại cache: một upload cùng nội dung có thể vừa hoàn tất
+        cached = upload_cache.get(hashed)
+        if cached:
+            return cached
+
+        source = attachment
+        # Thu nhỏ/nén lại ảnh nếu bật (cache theo hash ảnh gốc)
+        if file_type == 'image':
+            processed = image_preprocessor.process(attachment, content_type)
+            if processed:
+                source, ext, content_type = processed
+
+        ts_ms = int(time.time() * 1000)
+        filename = f"{file_type.upper()}_{ts_ms}_{uuid.uuid4().hex}.{ext}"
+        try:
+            # Body multipart được stream từ buffer (bộ nhớ hoặc file spool)
+            body = MultipartFileStream('file', filename, source.fileobj, source.size, content_type)
+            headers = {
+                'User-Agent': curl_user_agent,
+                'Accept': '*/*',
+                'Content-Type': body.content_type
+            }
+            upload_start = time.perf_counter()
+            try:
+                response = requests.post(QWEN_UPLOAD_URL, data=body, headers=headers, timeout=UPLOAD_TIMEOUT)
+            except Exception:
+                UPLOADS.inc(file_type, "error")
+                raise
+            UPLOAD_DURATION.observe(time.perf_counter() - upload_start, file_type)
+
+            if response.status_code != 200:
+                logger.warning(f"Upload to 0x0.st failed for {filename}: {response.status_code} - {response.text}")
+                UPLOADS.inc(file_type, "error")
+                return None
+            file_url = response.text.strip()
+            if not file_url.startswith('http'):
+                logger.warning(f"Invalid response from 0x0.st for {filename}: {file_url}")
+                UPLOADS.inc(file_type, "error")
+                return None
+
+            UPLOADS.inc(file_type, "ok")
+            UPLOAD_BYTES.inc(file_type, amount=source.size)
+            span = tracer.current()
+            span.set("upload.type", file_type)
+            span.set("upload.bytes", source.size)
+            logger.info(f"Upload {file_type} {filename} -> {file_url}")
+            entry = {
+                "file_url": file_url,
+                "size": source.size,
+                "content_type": content_type
+            }
+            # Lưu vào cache toàn cục
+            cache_size = upload_cache.put(hashed, entry)
+            logger.info(f"Saved to cache: {hashed[:8]}... -> {file_url} (cache size: {cache_size} files)")
+            return entry
+        finally:
+            if source is not attachment:
+                source.close()
+
+    def _build_file_entry(self, file_type, file_url, url_filename, size, content_type):
+        """Tạo entry file theo format Qwen cho message.files"""
+        now_ms = int(time.time() * 1000)
+        is_image = content_type.startswith("image/")
+        return {
+            "type": file_type,
+            "file": {
+                "created_at": now_ms,
+                "data": {},
+                "filename": url_filename,
+                "hash": None,
+                "id": str(uuid.uuid4()),
+                "user_id": str(uuid.uuid4()),
+                "meta": {
+                    "name": url_filename,
+                    "size": size,
+                    "content_type": content_type
+                },
+                "update_at": now_ms
+            },
+            "id": str(uuid.uuid4()),
+            "url": file_url,
+            "name": url_filename,
+            "collection_name": "",
+            "progress": 0,
+            "status": "uploaded",
+            "greenNet": "success",
+            "size": size,
+            "error": "",
+            "itemId": str(uuid.uuid4()),
+            "file_type": content_type,
+            "showType": "image" if is_image else "file",
+            "file_class": "vision" if is_image else "document",
+            "uploadTaskId": str(uuid.uuid4())
+        }
+
     def prepare_qwen_request(self, data, chat_id, model, parent_id=None):
         """Chuẩn bị request data cho Qwen API"""
         qwen_data = {
@@ -249,332 +367,37 @@ class QwenService:
                     logger.warning(f"Collect message files failed: {_e}")
                 
                 if files_to_upload:
-                    # Đảm bảo thư mục tạm
-                    try:
-                        if not os.path.isdir(TMP_FOLDER):
-                            os.makedirs(TMP_FOLDER, exist_ok=True)
-                    except Exception as _e:
-                        logger.warning(f"Cannot create tmp folder {TMP_FOLDER}: {_e}")
-
                     for file_item in files_to_upload:
                         file_type = file_item.get('type', 'image')
                         file_data = file_item.get('data')
                         
                         if not file_data:
                             continue
-                        # Decode base64 (hỗ trợ data URL)
-                        file_bytes = None
-                        ext = "bin"
-                        content_type = "application/octet-stream"
-                        
+                        # Decode base64 theo từng block (hỗ trợ data URL), hash + sniff trong cùng lượt
                         try:
-                            if isinstance(file_data, str) and file_data.startswith("data:") and ";base64," in file_data:
-                                header, b64data = file_data.split(",", 1)
-                                try:
-                                    mime = header.split(":", 1)[1].split(";")[0]
-                                    content_type = mime
-                                    # Lấy extension từ MIME type
-                                    if "/" in mime:
-                                        mime_type = mime.split("/", 1)[1]
-                                        if mime_type == "jpeg":
-                                            ext = "jpg"
-                                        elif mime_type == "png":
-                                            ext = "png"
-                                        elif mime_type == "gif":
-                                            ext = "gif"
-                                        elif mime_type == "webp":
-                                            ext = "webp"
-                                        elif mime_type == "svg+xml":
-                                            ext = "svg"
-                                        elif mime_type == "plain":
-                                            ext = "txt"
-                                        elif mime_type == "python":
-                                            ext = "py"
-                                        elif mime_type == "javascript":
-                                            ext = "js"
-                                        elif mime_type == "css":
-                                            ext = "css"
-                                        elif mime_type == "html":
-                                            ext = "html"
-                                        elif mime_type == "json":
-                                            ext = "json"
-                                        elif mime_type == "xml":
-                                            ext = "xml"
-                                        elif mime_type == "csv":
-                                            ext = "csv"
-                                        elif mime_type == "pdf":
-                                            ext = "pdf"
-                                        elif mime_type == "zip":
-                                            ext = "zip"
-                                        elif mime_type == "x-icon":
-                                            ext = "ico"
-                                        elif mime_type == "x-bat":
-                                            ext = "bat"
-                                        elif mime_type == "x-sh":
-                                            ext = "sh"
-                                        elif mime_type == "x-powershell":
-                                            ext = "ps1"
-                                        elif mime_type == "x-cmd":
-                                            ext = "cmd"
-                                        elif mime_type == "x-bash":
-                                            ext = "sh"
-                                        elif mime_type == "x-zsh":
-                                            ext = "zsh"
-                                        elif mime_type == "x-fish":
-                                            ext = "fish"
-                                        elif mime_type == "x-yaml":
-                                            ext = "yml"
-                                        elif mime_type == "x-toml":
-                                            ext = "toml"
-                                        elif mime_type == "x-ini":
-                                            ext = "ini"
-                                        elif mime_type == "x-config":
-                                            ext = "conf"
-                                        elif mime_type == "x-log":
-                                            ext = "log"
-                                        elif mime_type == "x-markdown":
-                                            ext = "md"
-                                        elif mime_type == "x-rst":
-                                            ext = "rst"
-                                        elif mime_type == "x-asciidoc":
-                                            ext = "adoc"
-                                        else:
-                                            ext = mime_type
-                                except Exception:
-                                    pass
-                                file_bytes = base64.b64decode(b64data)
-                            elif isinstance(file_data, str):
-                                file_bytes = base64.b64decode(file_data)
-                            elif isinstance(file_data, bytes):
-                                file_bytes = file_data
-                            else:
-                                continue
+                            attachment = ingest_attachment(file_data)
                         except Exception as _e:
                             logger.warning(f"Cannot decode file base64: {_e}")
                             continue
-                        
-                        # Detect file type từ content nếu chưa có extension rõ ràng
-                        if ext == "bin" and file_bytes:
-                            try:
-                                # Thử detect từ magic bytes
-                                if file_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
-                                    ext = "png"
-                                    content_type = "image/png"
-                                elif file_bytes.startswith(b'\xff\xd8\xff'):
-                                    ext = "jpg"
-                                    content_type = "image/jpeg"
-                                elif file_bytes.startswith(b'GIF87a') or file_bytes.startswith(b'GIF89a'):
-                                    ext = "gif"
-                                    content_type = "image/gif"
-                                elif file_bytes.startswith(b'RIFF') and file_bytes[8:12] == b'WEBP':
-                                    ext = "webp"
-                                    content_type = "image/webp"
-                                elif file_bytes.startswith(b'%PDF'):
-                                    ext = "pdf"
-                                    content_type = "application/pdf"
-                                elif file_bytes.startswith(b'PK\x03\x04'):
-                                    ext = "zip"
-                                    content_type = "application/zip"
-                                elif file_bytes.startswith(b'#!/usr/bin/env python') or file_bytes.startswith(b'#!python'):
-                                    ext = "py"
-                                    content_type = "text/x-python"
-                                elif file_bytes.startswith(b'#!/bin/bash') or file_bytes.startswith(b'#!/usr/bin/bash') or file_bytes.startswith(b'#!/bin/sh'):
-                                    ext = "sh"
-                                    content_type = "text/x-sh"
-                                elif file_bytes.startswith(b'@echo off') or file_bytes.startswith(b'@echo on'):
-                                    ext = "bat"
-                                    content_type = "text/x-bat"
-                                elif file_bytes.startswith(b'#Requires') or file_bytes.startswith(b'param(') or file_bytes.startswith(b'function '):
-                                    ext = "ps1"
-                                    content_type = "text/x-powershell"
-                                elif file_bytes.startswith(b'<?xml'):
-                                    ext = "xml"
-                                    content_type = "application/xml"
-                                elif file_bytes.startswith(b'{') or file_bytes.startswith(b'['):
-                                    ext = "json"
-                                    content_type = "application/json"
-                                elif file_bytes.startswith(b'<!DOCTYPE') or file_bytes.startswith(b'<html'):
-                                    ext = "html"
-                                    content_type = "text/html"
-                                elif file_bytes.startswith(b'/*') or file_bytes.startswith(b'@import'):
-                                    ext = "css"
-                                    content_type = "text/css"
-                                elif file_bytes.startswith(b'function') or file_bytes.startswith(b'var ') or file_bytes.startswith(b'const '):
-                                    ext = "js"
-                                    content_type = "application/javascript"
-                                elif file_bytes.startswith(b'---') and b'\n' in file_bytes:
-                                    ext = "yml"
-                                    content_type = "text/x-yaml"
-                                elif file_bytes.startswith(b'# ') and b'\n' in file_bytes:
-                                    ext = "md"
-                                    content_type = "text/x-markdown"
-                                elif file_bytes.startswith(b'#') and b'\n' in file_bytes:
-                                    # Có thể là text file với comments
-                                    ext = "txt"
-                                    content_type = "text/plain"
-                                else:
-                                    # Thử decode như text
-                                    try:
-                                        text_content = file_bytes.decode('utf-8')
-                                        if text_content.isprintable() or '\n' in text_content:
-                                            ext = "txt"
-                                            content_type = "text/plain"
-                                    except:
-                                        pass
-                            except Exception as _e:
-                                logger.warning(f"Error detecting file type: {_e}")
-
-                        # Hash nội dung file để kiểm tra cache
-                        try:
-                            hashed = hashlib.sha256(file_bytes).hexdigest()
-                            logger.info(f"File hash: {hashed[:8]}... (size: {len(file_bytes)} bytes, type: {file_type})")
-                        except Exception:
-                            hashed = None
-                            logger.warning("Cannot calculate file hash")
-
-                        # Nếu đã upload trước đó, tái sử dụng URL
-                        try:
-                            if hashed:
-                                logger.info(f"Looking for hash: {hashed[:8]}... in cache ({len(images_hashed)} items)")
-                                for i, cache_item in enumerate(images_hashed):
-                                    cache_hash = cache_item.get('hashed')
-                                    if cache_hash:
-                                        logger.info(f"Cache item {i}: {cache_hash[:8]}...")
-                                        if cache_hash == hashed:
-                                            cached = cache_item
-                                            logger.info(f"MATCH FOUND! Using cached image: {cached.get('file_url')}")
-                                            break
-                                else:
-                                    cached = None
-                                    logger.info(f"No cache match found for hash: {hashed[:8]}...")
-                            else:
-                                cached = None
-                        except Exception as _e:
-                            cached = None
-                            logger.warning(f"Error checking cache: {_e}")
-
-                        if cached and cached.get('file_url'):
-                            logger.info(f"Using cached file URL: {cached.get('file_url')}")
-                            # Lấy filename từ URL
-                            cached_url = cached.get('file_url')
-                            url_filename = cached_url.split('/')[-1].split('?')[0] if '/' in cached_url else f"cached_{uuid.uuid4().hex}.{ext}"
-                            
-                            uploaded_files.append({
-                                "type": file_type,
-                                "file": {
-                                    "created_at": int(time.time() * 1000),
-                                    "data": {},
-                                    "filename": url_filename,
-                                    "hash": None,
-                                    "id": str(uuid.uuid4()),
-                                    "user_id": str(uuid.uuid4()),
-                                    "meta": {
-                                        "name": url_filename,
-                                        "size": len(file_bytes),
-                                        "content_type": content_type
-                                    },
-                                    "update_at": int(time.time() * 1000)
-                                },
-                                "id": str(uuid.uuid4()),
-                                "url": cached_url,
-                                "name": url_filename,
-                                "collection_name": "",
-                                "progress": 0,
-                                "status": "uploaded",
-                                "greenNet": "success",
-                                "size": len(file_bytes),
-                                "error": "",
-                                "itemId": str(uuid.uuid4()),
-                                "file_type": content_type,
-                                "showType": "image" if content_type.startswith("image/") else "file",
-                                "file_class": "vision" if content_type.startswith("image/") else "document",
-                                "uploadTaskId": str(uuid.uuid4())
-                            })
+                        if attachment is None:
                             continue
 
-                        # Lưu file tạm
-                        ts_ms = int(time.time() * 1000)
-                        filename = f"{file_type.upper()}_{ts_ms}_{uuid.uuid4().hex}.{ext}"
-                        tmp_path = os.path.join(TMP_FOLDER, filename)
-                        try:
-                            with open(tmp_path, "wb") as f:
-                                f.write(file_bytes)
-                        except Exception as _e:
-                            logger.warning(f"Cannot write temp file {tmp_path}: {_e}")
-                            continue
+                        ext, content_type = detect_file_type(attachment.head, attachment.declared_mime)
 
-                        # Upload lên 0x0.st
+                        logger.info(f"File hash: {attachment.hashed[:8]}... (size: {attachment.size} bytes, type: {file_type})")
                         try:
-                            with open(tmp_path, 'rb') as f:
-                                files = {'file': (filename, f, content_type)}
-                                headers = {
-                                    'User-Agent': curl_user_agent,
-                                    'Accept': '*/*'
-                                }
-                                response = requests.post('https://0x0.st', files=files, headers=headers, timeout=30)
-                                
-                                if response.status_code == 200:
-                                    file_url = response.text.strip()
-                                    if file_url.startswith('http'):
-                                        logger.info(f"Upload {file_type} {filename} -> {file_url}")
-                                        # Lấy filename từ URL
-                                        url_filename = file_url.split('/')[-1].split('?')[0] if '/' in file_url else filename
-                                        
-                                        uploaded_files.append({
-                                            "type": file_type,
-                                            "file": {
-                                                "created_at": int(time.time() * 1000),
-                                                "data": {},
-                                                "filename": url_filename,
-                                                "hash": None,
-                                                "id": str(uuid.uuid4()),
-                                                "user_id": str(uuid.uuid4()),
-                                                "meta": {
-                                                    "name": url_filename,
-                                                    "size": len(file_bytes),
-                                                    "content_type": content_type
-                                                },
-                                                "update_at": int(time.time() * 1000)
-                                            },
-                                            "id": str(uuid.uuid4()),
-                                            "url": file_url,
-                                            "name": url_filename,
-                                            "collection_name": "",
-                                            "progress": 0,
-                                            "status": "uploaded",
-                                            "greenNet": "success",
-                                            "size": len(file_bytes),
-                                            "error": "",
-                                            "itemId": str(uuid.uuid4()),
-                                            "file_type": content_type,
-                                            "showType": "image" if content_type.startswith("image/") else "file",
-                                            "file_class": "vision" if content_type.startswith("image/") else "document",
-                                            "uploadTaskId": str(uuid.uuid4())
-                                        })
-                                        # Lưu vào cache toàn cục
-                                        try:
-                                            if hashed and file_url:
-                                                images_hashed.append({
-                                                    "file_url": file_url,
-                                                    "hashed": hashed
-                                                })
-                                                logger.info(f"Saved to cache: {hashed[:8]}... -> {file_url}")
-                                                logger.info(f"Cache size: {len(images_hashed)} files")
-                                        except Exception as _e:
-                                            logger.warning(f"Failed to save to cache: {_e}")
-                                    else:
-                                        logger.warning(f"Invalid response from 0x0.st for {filename}: {file_url}")
-                                else:
-                                    logger.warning(f"Upload to 0x0.st failed for {filename}: {response.status_code} - {response.text}")
+                            entry = self._upload_attachment(attachment, file_type, ext, content_type)
                         except Exception as _e:
-                            logger.warning(f"Upload {file_type} to 0x0.st failed for {filename}: {_e}")
+                            entry = None
+                            logger.warning(f"Upload {file_type} failed: {_e}")
                         finally:
-                            # Xóa file tạm
-                            try:
-                                if os.path.exists(tmp_path):
-                                    os.remove(tmp_path)
-                            except Exception as _e:
-                                logger.warning(f"Cannot remove temp file {tmp_path}: {_e}")
+                            attachment.close()
+
+                        if entry:
+                            file_url = entry['file_url']
+                            # Lấy filename từ URL
+                            url_filename = file_url.split('/')[-1].split('?')[0] if '/' in file_url else f"cached_{uuid.uuid4().hex}.{ext}"
+                            uploaded_files.append(self._build_file_entry(file_type, file_url, url_filename, entry['size'], entry['content_type']))
 
                     if uploaded_files:
                         qwen_msg["files"] = uploaded_files
@@ -0,0 +1,374 @@
+"""Engine gọi Qwen chat completions dùng chung cho ChatService và OllamaService.
+
+Engine lo toàn bộ phần upstream: gửi request, đọc lỗi JSON của Qwen và retry bằng chat
+mới khi parent_id không còn tồn tại, parse SSE, theo dõi phase think/answer và cập nhật
+RequestState (token, mốc thời gian). Service chỉ render event sang format API của mình:
+
+    (THINK_START, "")  bắt đầu phase think        (THINK, text)   nội dung think
+    (THINK_END, "")    kết thúc phase think        (ANSWER, text)  nội dung trả lời
+    (FINISH, reason)   kết thúc response (luôn là event cuối nếu stream không lỗi)
+"""
+
+import json
+import time
+import logging
+import requests
+from services.qwen_service import qwen_service
+from utils.chat_manager import chat_manager
+from utils.cookie_parser import build_header
+from utils.response_cache import response_cache, cache_key
+from utils.semantic_cache import semantic_cache, split_query
+from utils.metrics import ACTIVE_STREAMS, UPSTREAM_CONNECT, UPSTREAM_RETRIES, UPSTREAM_ERRORS
+from utils.tracing import tracer
+from config import QWEN_HEADERS, QWEN_CHAT_COMPLETIONS_URL, RESPONSE_CACHE_REPLAY_DELAY
+
+logger = logging.getLogger(__name__)
+
+THINK_START = "think_start"
+THINK = "think"
+THINK_END = "think_end"
+ANSWER = "answer"
+FINISH = "finish"
+
+# Timeout cho mỗi lần đọc socket và cho toàn bộ stream (giây)
+REQUEST_TIMEOUT = 300
+STREAM_TIMEOUT = 300
+
+_SSE_PREFIX = b"data: "
+_SSE_DONE = b"[DONE]"
+
+
+class UpstreamError(Exception):
+    """Qwen trả lỗi (JSON success=false, status khác 200, retry thất bại...)"""
+
+    def __init__(self, message, code=None, details=None, status=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.details = details
+        self.status = status
+
+    @property
+    def model_not_found(self):
+        return self.code == "Not_Found" and "Model not found" in str(self.details)
+
+    @property
+    def parent_missing(self):
+        details = str(self.details or "")
+        return self.code == "Bad_Request" and "parent_id" in details and "not exist" in details
+
+
+class CacheKey:
+    """Key của request trong các lớp cache: exact (response_cache) và semantic (semantic_cache)"""
+
+    __slots__ = ("exact", "model", "context_hash", "vector")
+
+    def __init__(self):
+        self.exact = None
+        self.model = None
+        self.context_hash = None
+        self.vector = None
+
+    def store(self, events):
+        if self.exact is not None:
+            response_cache.put(self.exact, events)
+        if self.vector is not None:
+            semantic_cache.add(self.model, self.context_hash, self.vector, events)
+
+
+class UpstreamStream:
+    """Một response của Qwen: chat_id thực tế (sau retry), response_id và iterator event
+
+    cache_key: CacheKey từ QwenUpstream.lookup(), chuỗi event được ghi vào cache khi
+    response hoàn tất
+    track_parent=False: không cập nhật parent_id của chat hiện tại (chat riêng, vd. batch)
+    """
+
+    # Marker khi được phát lại từ cache: {"type": "exact"} hoặc {"type": "semantic", "similarity": ...}
+    cache_info = None
+
+    @property
+    def cached(self):
+        """True nếu được phát lại từ cache (không có chat upstream)"""
+        return self.cache_info is not None
+
+    def __init__(self, response, chat_id, request_state, cache_key=None, track_parent=True):
+        self.response = response
+        self.chat_id = chat_id
+        self.request_state = request_state
+        self.cache_key = cache_key
+        self.track_parent = track_parent
+        self.response_id = None
+        self.finish_reason = None
+
+    def events(self):
+        """Iterator event (kind, text) của response"""
+        if self.cache_key is None:
+            return self._parse_events()
+        return self._recording(self._parse_events())
+
+    def _recording(self, events):
+        recorded = []
+        for event in events:
+            recorded.append(event)
+            if event[0] == FINISH and any(kind == ANSWER for kind, _text in recorded):
+                self.cache_key.store(recorded)
+            yield event
+
+    def _parse_events(self):
+        """Parse SSE thành các event (kind, text); hot loop dùng chung cho mọi API"""
+        request_state = self.request_state
+        started = time.monotonic()
+        span = tracer.start_span("upstream.stream", {"chat_id": self.chat_id})
+        ACTIVE_STREAMS.inc()
+        try:
+            for line in self.response.iter_lines():
+                if not line.startswith(_SSE_PREFIX):
+                    continue
+                payload = line[6:]
+                if payload.startswith(_SSE_DONE):
+                    break
+                if time.monotonic() - started > STREAM_TIMEOUT:
+                    raise UpstreamError("Stream reading timeout")
+                try:
+                    chunk = json.loads(payload)
+                except ValueError as e:
+                    logger.error(f"JSON decode error in Qwen stream: {e}")
+                    continue
+
+                # response.created: lưu parent_id/response_id cho lượt sau
+                created = chunk.get('response.created')
+                if created is not None:
+                    parent_id = created.get('parent_id')
+                    response_id = created.get('response_id')
+                    if parent_id and response_id and self.track_parent:
+                        chat_manager.update_parent_info(parent_id, response_id)
+                    self.response_id = response_id or self.response_id
+                    continue
+
+                choices = chunk.get('choices')
+                if not choices:
+                    continue
+                choice = choices[0]
+                delta = choice.get('delta') or {}
+                content = delta.get('content')
+                phase = delta.get('phase')
+                request_state.log_phase_change(phase)
+
+                if phase == "think":
+                    if not request_state.think_started:
+                        request_state.think_started = True
+                        yield THINK_START, ""
+                    if content:
+                        request_state.add_output(content)
+                        yield THINK, content
+                    if delta.get('status') == 'finished':
+                        request_state.think_started = False
+                        yield THINK_END, ""
+                elif phase == "answer" or phase is None:
+                    # Qwen chuyển sang answer mà không báo think finished: tự đóng think
+                    if request_state.think_started:
+                        request_state.think_started = False
+                        yield THINK_END, ""
+                    if content:
+                        request_state.add_output(content)
+                        yield ANSWER, content
+
+                finish_reason = choice.get('finish_reason')
+                if finish_reason:
+                    self.finish_reason = finish_reason
+                    break
+        except Exception as e:
+            span.set_error(e)
+            request_state.error = type(e).__name__
+            raise
+        finally:
+            ACTIVE_STREAMS.dec()
+            span.set("output_tokens", request_state.completion_tokens)
+            span.set("finish_reason", self.finish_reason)
+            span.end()
+            self.response.close()
+
+        if request_state.think_started:
+            request_state.think_started = False
+            yield THINK_END, ""
+        request_state.mark_finished()
+        yield FINISH, self.finish_reason or "stop"
+
+    def collect(self):
+        """Đọc hết stream, trả về (thinking, answer)"""
+        thinking, answer = [], []
+        for kind, text in self.events():
+            if kind == THINK:
+                thinking.append(text)
+            elif kind == ANSWER:
+                answer.append(text)
+        return ''.join(thinking), ''.join(answer)
+
+
+class ReplayStream(UpstreamStream):
+    """Phát lại chuỗi event từ response cache thay cho một response của Qwen"""
+
+    def __init__(self, events, request_state, cache_info, delay=0.0):
+        super().__init__(None, None, request_state)
+        request_state.replayed = True
+        self._events = events
+        self.cache_info = cache_info
+        self.delay = delay
+
+    def events(self):
+        request_state = self.request_state
+        for kind, text in self._events:
+            if kind == THINK or kind == ANSWER:
+                if self.delay:
+                    time.sleep(self.delay)
+                request_state.add_output(text)
+            elif kind == FINISH:
+                self.finish_reason = text
+                request_state.mark_finished()
+            yield kind, text
+
+    def collect(self):
+        # Body đầy đủ: không cần giãn nhịp
+        self.delay = 0
+        return super().collect()
+
+
+class QwenUpstream:
+    """Gửi request tới Qwen chat completions, xử lý lỗi + retry một lần với chat mới"""
+
+    def _replay(self, events, request_state, cache_info):
+        request_state.mark_upstream_start()
+        request_state.mark_connected()
+        return ReplayStream(events, request_state, cache_info, RESPONSE_CACHE_REPLAY_DELAY)
+
+    def lookup(self, data, request_state, use_cache=True):
+        """Tra cache trước khi mở chat upstream: exact-match rồi semantic.
+
+        Trả về (ReplayStream hoặc None, CacheKey hoặc None); CacheKey truyền vào open()
+        để ghi response khi miss. use_cache=False: client bypass (vẫn được đếm).
+        """
+        if not response_cache.enabled and not semantic_cache.enabled:
+            return None, None
+        if not use_cache:
+            response_cache.note_bypass()
+            return None, None
+        key = CacheKey()
+        if response_cache.enabled:
+            key.exact = cache_key(data)
+            events = response_cache.get(key.exact)
+            if events is not None:
+                return self._replay(events, request_state, {"type": "exact"}), key
+        if semantic_cache.enabled:
+            query = split_query(data)
+            if query is not None:
+                try:
+                    key.context_hash, text = query
+                    key.model = data.get('model')
+                    key.vector = semantic_cache.embed(text)
+                except Exception as e:
+                    logger.warning(f"Semantic cache disabled for request: {e}")
+                    key.vector = None
+                if key.vector is not None:
+                    found = semantic_cache.search(key.model, key.context_hash, key.vector)
+                    if found is not None:
+                        events, similarity = found
+                        return self._replay(events, request_state,
+                                            {"type": "semantic", "similarity": round(similarity, 4)}), key
+        return None, key
+
+    def _post(self, chat_id, headers, qwen_data, stream):
+        with tracer.span("upstream.request", {"chat_id": chat_id, "model": qwen_data.get("model")}) as span:
+            response = requests.post(
+                f"{QWEN_CHAT_COMPLETIONS_URL}?chat_id={chat_id}",
+                headers=headers,
+                json=qwen_data,
+                stream=stream,
+                timeout=REQUEST_TIMEOUT
+            )
+            span.set("http.status_code", response.status_code)
+            return response
+
+    @tracer.traced("prompt.build")
+    def _prepare(self, data, chat_id, model, parent_id, stream):
+        qwen_data = qwen_service.prepare_qwen_request(data, chat_id, model, parent_id)
+        qwen_data['stream'] = stream
+        qwen_data['incremental_output'] = stream
+        return qwen_data
+
+    def _error_of(self, response):
+        """UpstreamError nếu Qwen trả JSON success=false, ngược lại None"""
+        if 'application/json' not in response.headers.get('content-type', ''):
+            return None
+        try:
+            response_json = response.json()
+        except ValueError as e:
+            logger.error(f"Error parsing JSON response: {e}")
+            return None
+        if not isinstance(response_json, dict) or response_json.get('success', True):
+            return None
+        error_data = response_json.get('data') or {}
+        code = error_data.get('code', 'Unknown')
+        details = error_data.get('details', 'Unknown error')
+        logger.error(f"Qwen API error: {code} - {details}")
+        if code == "Bad_Request" and "chat is in progress" in str(details):
+            message = "Chat is currently in progress. Please wait for the current request to complete."
+        else:
+            message = f"Qwen API error: {code} - {details}"
+        return UpstreamError(message, code=code, details=details, status=response.status_code)
+
+    def open(self, data, model, chat_id, parent_id, request_state, new_chat, stream=True, cache_key=None,
+             track_parent=True):
+        """Gửi request, trả về UpstreamStream. Raise UpstreamError nếu Qwen báo lỗi.
+
+        new_chat(model): tạo chat mới khi parent_id không còn tồn tại trên Qwen
+        stream=False: response là JSON đầy đủ (đọc qua UpstreamStream.response)
+        cache_key: CacheKey từ lookup(), ghi chuỗi event vào cache khi xong
+        track_parent=False: chat riêng, không ghi parent_id vào chat_manager
+        """
+        headers = build_header(QWEN_HEADERS)
+        qwen_data = self._prepare(data, chat_id, model, parent_id, stream)
+
+        request_state.mark_upstream_start()
+        response = self._post(chat_id, headers, qwen_data, stream)
+        request_state.mark_connected()
+
+        error = self._error_of(response)
+        if error is not None and error.parent_missing:
+            logger.warning(f"Parent ID not exist error detected: {error.details}")
+            UPSTREAM_RETRIES.inc("parent_missing")
+            request_state.retries += 1
+            # Trả connection của response lỗi về pool trước khi gọi lại
+            response.close()
+            chat_id = new_chat(model)
+            if not chat_id:
+                logger.error("Failed to create new chat for retry")
+                raise UpstreamError("Failed to create new chat for retry")
+            qwen_data = self._prepare(data, chat_id, model, None, stream)
+            response = self._post(chat_id, headers, qwen_data, stream)
+            request_state.mark_connected()
+            if response.status_code != 200:
+                logger.error(f"Retry failed with status: {response.status_code}")
+                UPSTREAM_ERRORS.inc(str(response.status_code))
+                request_state.error = f"UpstreamError:{response.status_code}"
+                response.close()
+                raise UpstreamError(f"Failed to retry with new chat: {response.status_code}",
+                                    status=response.status_code)
+            error = self._error_of(response)
+        if error is not None:
+            UPSTREAM_ERRORS.inc(str(error.code or error.status))
+            request_state.error = f"UpstreamError:{error.code or error.status}"
+            response.close()
+            raise error
+        if response.status_code != 200:
+            logger.error(f"Qwen API error: {response.status_code}")
+            UPSTREAM_ERRORS.inc(str(response.status_code))
+            request_state.error = f"UpstreamError:{response.status_code}"
+            response.close()
+            raise UpstreamError(f"Error from Qwen API: {response.status_code}", status=response.status_code)
+        UPSTREAM_CONNECT.observe(request_state.connect_ns / 1e9)
+        return UpstreamStream(response, chat_id, request_state, cache_key if stream else None, track_parent)
+
+
+# Global Qwen upstream instance
+qwen_upstream = QwenUpstream()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Chạy pytest từ thư mục gốc repo: import được config, services, utils...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+from services.batch_service import BatchService
+
+
+class Upload:
+    def __init__(self, text):
+        self.text = text
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.text)
+
+
+class Crash(Exception):
+    pass
+
+
+def _input_lines(count):
+    return "".join(
+        json.dumps({"custom_id": f"req-{i}", "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": "qwen3", "messages": [{"role": "user", "content": f"q{i}"}]}}) + "\n"
+        for i in range(count)
+    )
+
+
+def _service(directory, calls):
+    def execute(body, request_state):
+        calls.append(body["messages"][0]["content"])
+        return {"object": "chat.completion", "choices": []}
+
+    service = BatchService(directory=str(directory), concurrency=2, execute=execute)
+    # Chạy batch trực tiếp trong test thay vì runner nền
+    service._ensure_runner = lambda: None
+    return service
+
+
+def test_resume_during_finalize_only_finishes_finalize(tmp_path):
+    first_calls = []
+    service = _service(tmp_path, first_calls)
+    input_file = service.create_file(Upload(_input_lines(3)), "input.jsonl", "batch")
+    batch = service.create_batch(input_file["id"], "/v1/chat/completions")
+
+    register = service._register_file
+
+    def register_then_crash(path, filename, purpose, file_id=None):
+        # Dừng ngay sau khi output đã được chuyển vào files/, trước khi ghi metadata
+        os.replace(path, service._file_path(file_id))
+        raise Crash()
+
+    service._register_file = register_then_crash
+    with pytest.raises(Crash):
+        service._run_batch(service._batches[batch["id"]])
+    service._register_file = register
+    assert len(first_calls) == 3
+
+    resumed_calls = []
+    resumed = _service(tmp_path, resumed_calls)
+    resumed._load()
+    record = resumed._batches[batch["id"]]
+    assert record["status"] == "finalizing"
+    resumed._run_batch(record)
+
+    assert resumed_calls == []
+    view = resumed.get_batch(batch["id"])
+    assert view["status"] == "completed"
+    assert "_finalize" not in view
+    assert view["output_file_id"] == record["output_file_id"]
+    outputs = resumed.list_files(purpose="batch_output")["data"]
+    assert [f["id"] for f in outputs] == [view["output_file_id"]]
+    with open(resumed.file_content_path(view["output_file_id"]), encoding="utf-8") as f:
+        assert sorted(json.loads(line)["custom_id"] for line in f) == ["req-0", "req-1", "req-2"]
@@ -0,0 +1,30 @@
+import numpy as np
+
+from services.embedding_service import EmbeddingService
+from utils.embedding_codec import truncate_dimensions
+
+
+def _reduced(texts, dimensions):
+    service = EmbeddingService(dim=768, backend="hashing", cache_dir="")
+    return truncate_dimensions(service.embed(texts), dimensions, service.fold_dimensions)
+
+
+def test_reduced_hashing_vectors_are_never_zero():
+    texts = ["a", "b", "hi", "cat", "dog", "ok"]
+    for dimensions in (1, 2, 8, 64, 256):
+        matrix = _reduced(texts, dimensions)
+        assert matrix.shape == (len(texts), dimensions)
+        assert np.allclose(np.linalg.norm(matrix, axis=1), 1.0, atol=1e-5)
+
+
+def test_similar_inputs_stay_similar_after_reduction():
+    texts = [
+        "the quick brown fox jumps over the lazy dog",
+        "the quick brown fox jumped over the lazy dog",
+        "quarterly revenue grew eight percent year over year",
+    ]
+    matrix = _reduced(texts, 64)
+    near = float(matrix[0] @ matrix[1])
+    far = float(matrix[0] @ matrix[2])
+    assert near > 0.7
+    assert near > far + 0.3
@@ -0,0 +1,46 @@
+import hashlib
+
+import numpy as np
+
+from utils import embedding_store as store_module
+from utils.embedding_store import EmbeddingStore
+
+
+def _keys(count, prefix="k"):
+    return [hashlib.sha256(f"{prefix}{i}".encode()).digest() for i in range(count)]
+
+
+def test_get_many_returns_views_of_the_memmap(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=4, max_rows=100)
+    keys = _keys(5)
+    matrix = np.arange(20, dtype=np.float32).reshape(5, 4)
+    store.add_many(keys, matrix)
+
+    positions, vectors = store.get_many([keys[3], b"\0" * 32, keys[1]])
+    assert positions == [0, 2]
+    assert np.array_equal(vectors[0], matrix[3]) and np.array_equal(vectors[1], matrix[1])
+    assert all(np.shares_memory(v, store._mmap) for v in vectors)
+
+
+def test_compaction_is_postponed_when_the_file_is_locked(tmp_path, monkeypatch):
+    store = EmbeddingStore(str(tmp_path), dim=4, max_rows=10)
+    replace = store_module.os.replace
+
+    def locked_replace(src, dst):
+        if dst == store.vectors_path:
+            raise PermissionError("file is mapped")
+        return replace(src, dst)
+
+    monkeypatch.setattr(store_module.os, "replace", locked_replace)
+    keys = _keys(11)
+    store.add_many(keys, np.ones((11, 4), dtype=np.float32))
+    # Không thay được file: store giữ nguyên và vẫn đọc được
+    assert len(store) == 11
+    assert np.array_equal(store.get(keys[0]), np.ones(4, dtype=np.float32))
+
+    monkeypatch.setattr(store_module.os, "replace", replace)
+    # Thử lại khi store lớn thêm max_rows // 10 row
+    store.add_many(_keys(1, "more"), np.zeros((1, 4), dtype=np.float32))
+    assert len(store) == 12
+    store.add_many(_keys(1, "last"), np.zeros((1, 4), dtype=np.float32))
+    assert len(store) == int(10 * store_module.COMPACT_KEEP_RATIO)
@@ -0,0 +1,47 @@
+from services import ollama_service as ollama_module
+from services.qwen_upstream import ANSWER, FINISH
+from utils.session_table import SessionTable
+
+
+class FakeUpstream:
+    cached = False
+    cache_info = None
+
+    def __init__(self, chat_id, response_id, request_state):
+        self.chat_id = chat_id
+        self.response_id = response_id
+        self.request_state = request_state
+
+    def events(self):
+        self.request_state.add_output("ok")
+        yield ANSWER, "ok"
+        self.request_state.mark_finished()
+        yield FINISH, "stop"
+
+
+def test_warm_session_does_not_chain_unrelated_conversations(monkeypatch):
+    table = SessionTable()
+    created, opened = [], []
+
+    def create_new_chat(model):
+        created.append(model)
+        return f"chat-{len(created)}"
+
+    def open_upstream(data, model, chat_id, parent_id, request_state, new_chat, cache_key=None):
+        opened.append((chat_id, parent_id, data["messages"][-1]["content"]))
+        return FakeUpstream(chat_id, f"resp-{len(opened)}", request_state)
+
+    monkeypatch.setattr(ollama_module, "session_table", table)
+    monkeypatch.setattr(ollama_module.qwen_service, "create_new_chat", create_new_chat)
+    monkeypatch.setattr(ollama_module.qwen_upstream, "open", open_upstream)
+    monkeypatch.setattr(ollama_module.qwen_upstream, "lookup", lambda data, state, use_cache: (None, None))
+
+    service = ollama_module.OllamaService()
+    for question in ("What is Python?", "Translate 'cat' to French"):
+        data = {"model": "qwen3", "messages": [{"role": "user", "content": question}]}
+        list(service.stream_ollama_response(data, client_key="127.0.0.1", keep_alive="5m"))
+
+    # Chat ấm được dùng lại (chỉ tạo một chat) nhưng lượt thứ hai không nối vào response của lượt đầu
+    assert created == ["qwen3"]
+    assert opened == [("chat-1", None, "What is Python?"), ("chat-1", None, "Translate 'cat' to French")]
+    assert [s["chat_id"] for s in table.live_sessions()] == ["chat-1"]
@@ -0,0 +1,53 @@
+import pytest
+
+from models.request_state import RequestState
+from services import qwen_upstream as upstream_module
+from services.qwen_upstream import QwenUpstream, UpstreamError
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.headers = {"content-type": "application/json"} if body is not None else {}
+        self._body = body
+        self.closed = False
+
+    def json(self):
+        return self._body
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize("responses", [
+    [FakeResponse(502)],
+    [FakeResponse(200, {"success": False, "data": {"code": "RateLimited", "details": "slow down"}})],
+    [FakeResponse(200, {"success": False, "data": {"code": "Bad_Request", "details": "The parent_id x does not exist"}}),
+     FakeResponse(500)],
+])
+def test_error_responses_are_closed(monkeypatch, responses):
+    pending = list(responses)
+    upstream = QwenUpstream()
+    monkeypatch.setattr(upstream_module, "build_header", lambda headers: {})
+    monkeypatch.setattr(upstream, "_prepare", lambda *args: {"model": "qwen3"})
+    monkeypatch.setattr(upstream, "_post", lambda *args: pending.pop(0))
+
+    with pytest.raises(UpstreamError):
+        upstream.open({}, "qwen3", "chat-1", "parent-1", RequestState("r", "qwen3"), lambda model: "chat-2")
+    assert not pending
+    assert all(response.closed for response in responses)
+
+
+def test_cache_replay_is_not_recorded_as_upstream_latency():
+    from services.qwen_upstream import ReplayStream, ANSWER, FINISH
+    from utils.metrics import TTFT, INTER_TOKEN, TOKENS_PER_SECOND
+
+    def samples():
+        return [metric.render() for metric in (TTFT, INTER_TOKEN, TOKENS_PER_SECOND)]
+
+    before = samples()
+    state = RequestState("r", "qwen3")
+    stream = ReplayStream([(ANSWER, "Hello"), (ANSWER, " world"), (FINISH, "stop")], state, {"type": "exact"})
+    assert stream.collect() == ("", "Hello world")
+    assert state.first_token_ns is not None and state.completion_tokens > 0
+    assert samples() == before
@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import os
+import tempfile
+import uuid
+import logging
+from config import TMP_FOLDER, UPLOAD_SPOOL_THRESHOLD, UPLOAD_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Số byte đầu file giữ lại để sniff loại file
+SNIFF_BYTES = 4096
+# Số ký tự base64 decode mỗi lượt (bội số của 4)
+B64_BLOCK_CHARS = (UPLOAD_CHUNK_SIZE // 3) * 4
+
+_WHITESPACE = (" ", "\n", "\r", "\t")
+
+
+class IngestedAttachment:
+    """Attachment đã decode: buffer upload (bộ nhớ hoặc spool đĩa) + metadata"""
+
+    def __init__(self, fileobj, size, hashed, head, declared_mime=None):
+        self.fileobj = fileobj
+        self.size = size
+        self.hashed = hashed
+        self.head = head
+        self.declared_mime = declared_mime
+
+    def close(self):
+        try:
+            self.fileobj.close()
+        except Exception:
+            pass
+
+
+def _iter_b64_blocks(text, start):
+    """Decode base64 từ text[start:] theo từng block cố định, không tạo bản sao toàn bộ chuỗi"""
+    carry = ""
+    length = len(text)
+    for offset in range(start, length, B64_BLOCK_CHARS):
+        piece = carry + text[offset:offset + B64_BLOCK_CHARS]
+        if any(ws in piece for ws in _WHITESPACE):
+            piece = "".join(piece.split())
+        cut = len(piece) - (len(piece) % 4)
+        carry = piece[cut:]
+        if cut:
+            yield base64.b64decode(piece[:cut])
+    if carry:
+        # Phần dư không đủ 4 ký tự: bổ sung padding như b64decode mặc định sẽ báo lỗi
+        yield base64.b64decode(carry + "=" * (-len(carry) % 4))
+
+
+def ingest_attachment(file_data):
+    """Decode attachment (base64, data URL hoặc bytes) theo từng block.
+
+    SHA-256 và sniff header được cập nhật trong cùng lượt decode; dữ liệu được
+    giữ trong bộ nhớ đến UPLOAD_SPOOL_THRESHOLD rồi tự spool ra TMP_FOLDER, nên
+    bộ nhớ đỉnh cho mỗi attachment bị chặn bất kể kích thước file.
+    Returns: IngestedAttachment hoặc None nếu không có dữ liệu.
+    """
+    if not file_data:
+        return None
+
+    declared_mime = None
+    if isinstance(file_data, (bytes, bytearray)):
+        blocks = (bytes(file_data[i:i + UPLOAD_CHUNK_SIZE]) for i in range(0, len(file_data), UPLOAD_CHUNK_SIZE))
+    elif isinstance(file_data, str):
+        start = 0
+        if file_data.startswith("data:"):
+            comma = file_data.find(",", 0, 512)
+            if comma != -1 and ";base64" in file_data[:comma]:
+                try:
+                    declared_mime = file_data[5:comma].split(";")[0] or None
+                except Exception:
+                    declared_mime = None
+                start = comma + 1
+        blocks = _iter_b64_blocks(file_data, start)
+    else:
+        return None
+
+    os.makedirs(TMP_FOLDER, exist_ok=True)
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, dir=TMP_FOLDER)
+    hasher = hashlib.sha256()
+    head = bytearray()
+    size = 0
+    try:
+        for block in blocks:
+            if not block:
+                continue
+            hasher.update(block)
+            if len(head) < SNIFF_BYTES:
+                head += block[:SNIFF_BYTES - len(head)]
+            spool.write(block)
+            size += len(block)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+
+    if size == 0:
+        spool.close()
+        return None
+    return IngestedAttachment(spool, size, hasher.hexdigest(), bytes(head), declared_mime)
+
+
+class MultipartFileStream:
+    """Body multipart/form-data đọc dần từ file object, dùng làm `data=` cho requests.
+
+    Có __len__ nên requests gửi Content-Length thay vì chunked, và http.client
+    đọc body theo block nên file không bị nạp toàn bộ vào bộ nhớ.
+    """
+
+    def __init__(self, field, filename, fileobj, size, content_type):
+        self.boundary = uuid.uuid4().hex
+        self._preamble = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        self._epilogue = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._fileobj = fileobj
+        self._length = len(self._preamble) + size + len(self._epilogue)
+        self._parts = [self._preamble, fileobj, self._epilogue]
+        self._index = 0
+        self._pending = b""
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        out = bytearray()
+        while len(out) < size and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                if not self._pending:
+                    self._pending = part
+                take = self._pending[:size - len(out)]
+                self._pending = self._pending[len(take):]
+                out += take
+                if not self._pending:
+                    self._index += 1
+            else:
+                chunk = part.read(size - len(out))
+                if chunk:
+                    out += chunk
+                else:
+                    self._index += 1
+        return bytes(out)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
@@ -1,6 +1,7 @@
 import json
 import logging
 from typing import List, Dict, Any, Tuple
+from utils.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
@@ -125,6 +126,7 @@ class ContextManager:
             logger.error(f"Error trimming messages: {e}")
             return messages
     
+    @tracer.traced("context.trim")
     def process_messages_for_context(self, messages: List[Dict], model_id: str, cached_models: List[Dict]) -> Tuple[List[Dict], Dict[str, Any]]:
         """
         Xử lý messages và trả về trimmed messages cùng với thông tin context
@@ -139,6 +141,9 @@ class ContextManager:
                 "threshold_tokens": int(max_tokens * self.context_threshold),
                 "trimmed": should_trim
             }
+            span = tracer.current()
+            span.set("context.tokens", current_tokens)
+            span.set("context.trimmed", should_trim)
             
             if should_trim:
                 trimmed_messages = self.trim_messages_to_fit_context(messages, model_id, cached_models)
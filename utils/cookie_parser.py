@@ -69,6 +69,8 @@ def build_header(base_headers: dict, cookie_raw: str | None = None):
                     settings = json.load(f) or {}
         except Exception:
             settings = {}
+    # Chưa có ui_settings.json (chạy lần đầu / offline với mock server)
+    settings = settings or {}
     bx_ua = (settings.get("bx_ua") or "").strip()
     bx_umidtoken = (settings.get("bx_umidtoken") or "").strip()
     if bx_ua:
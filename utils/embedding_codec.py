@@ -0,0 +1,84 @@
+"""Encode ma trận embedding cho response (OpenAI /v1/embeddings, Ollama /api/embed).
+
+- dimensions: cắt còn N chiều đầu (vector dày) hoặc gập cột c -> c % N (vector chiếu thưa
+  của backend hashing) rồi chuẩn hóa L2 lại
+- encoding_format: "float" (list số), "base64" (buffer float32 little-endian như OpenAI),
+  "float16" (opt-in, buffer float16 little-endian dạng base64 - nhỏ bằng nửa base64)
+
+Vector base64 được encode thẳng từ mảng NumPy, không tạo list float Python.
+"""
+
+import base64
+import numpy as np
+
+ENCODING_DTYPES = {
+    "base64": "<f4",
+    "float16": "<f2",
+}
+ENCODING_FORMATS = ("float",) + tuple(ENCODING_DTYPES)
+
+
+def parse_dimensions(value, max_dim):
+    """Kiểm tra tham số dimensions, trả về int hoặc None. Raise ValueError nếu không hợp lệ"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("dimensions must be an integer")
+    if value < 1 or value > max_dim:
+        raise ValueError(f"dimensions must be between 1 and {max_dim}")
+    return value
+
+
+def parse_encoding_format(value):
+    """Kiểm tra encoding_format, mặc định "float". Raise ValueError nếu không hỗ trợ"""
+    if value is None:
+        return "float"
+    if value not in ENCODING_FORMATS:
+        raise ValueError(f"encoding_format must be one of: {', '.join(ENCODING_FORMATS)}")
+    return value
+
+
+def truncate_dimensions(matrix, dimensions, fold=False):
+    """Giảm còn `dimensions` chiều và chuẩn hóa L2 lại từng hàng.
+
+    fold=False: giữ các chiều đầu (chỉ đúng với vector kiểu Matryoshka/dày).
+    fold=True: cộng cột c vào chiều c % dimensions - vector chiếu thưa (HashingEmbedder) chỉ
+    có vài chiều khác 0 nên cắt prefix gần như luôn ra vector 0, còn gập thì giữ mọi chiều
+    và vẫn là một phép chiếu tuyến tính (độ tương đồng giữa các input được giữ gần đúng).
+    Hàng khác 0 không bao giờ thành vector 0: nếu các chiều triệt tiêu nhau thì gập trị tuyệt đối.
+    """
+    if not dimensions or dimensions >= matrix.shape[1]:
+        return matrix
+    if not fold:
+        out = np.array(matrix[:, :dimensions], dtype=np.float32)
+    else:
+        out = _fold(matrix, dimensions)
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    lost = (norms[:, 0] == 0) & np.any(matrix != 0, axis=1)
+    if lost.any():
+        out[lost] = _fold(np.abs(matrix[lost]), dimensions)
+        norms[lost] = np.linalg.norm(out[lost], axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out
+
+
+def _fold(matrix, dimensions):
+    out = np.zeros((matrix.shape[0], dimensions), dtype=np.float32)
+    for start in range(0, matrix.shape[1], dimensions):
+        block = matrix[:, start:start + dimensions]
+        out[:, :block.shape[1]] += block
+    return out
+
+
+def encode_vectors(matrix, encoding_format="float"):
+    """Trả về list vector đã encode theo encoding_format (list float hoặc chuỗi base64)"""
+    dtype = ENCODING_DTYPES.get(encoding_format)
+    if dtype is None:
+        return matrix.tolist()
+    packed = np.ascontiguousarray(matrix, dtype=dtype)
+    row_bytes = packed.shape[1] * packed.itemsize
+    buf = packed.tobytes()
+    return [
+        base64.b64encode(buf[i:i + row_bytes]).decode("ascii")
+        for i in range(0, len(buf), row_bytes)
+    ]
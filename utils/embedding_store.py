@@ -0,0 +1,177 @@
+import os
+import threading
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Kích thước key (SHA-256 digest của text)
+KEY_BYTES = 32
+# Khi vượt max_rows, compaction giữ lại tỉ lệ này (theo lần dùng gần nhất)
+COMPACT_KEEP_RATIO = 0.75
+
+INDEX_FILE = "index.bin"
+VECTORS_FILE = "vectors.f32"
+
+
+class EmbeddingStore:
+    """Cache embedding trên đĩa: index key -> row + ma trận float32 append-only.
+
+    - index.bin: digest 32 byte của text, nối tiếp theo thứ tự row
+    - vectors.f32: ma trận float32 little-endian (rows, dim), đọc qua np.memmap nên
+      khởi động không nạp vector vào RAM và mỗi vector trả về là một slice không copy
+    Khi số row vượt max_rows, compaction ghi lại hai file chỉ với các row dùng gần nhất.
+    Slice trả về chỉ dùng ngắn hạn (copy ra trước khi giữ lâu): trên Windows file đang còn
+    view thì không thay được, khi đó compaction được hoãn tới khi store lớn thêm.
+    """
+
+    def __init__(self, directory, dim, max_rows):
+        self.directory = directory
+        self.dim = dim
+        self.max_rows = max_rows
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.vectors_path = os.path.join(directory, VECTORS_FILE)
+        self._row_bytes = dim * 4
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._last_used = []
+        self._clock = 0
+        self._mmap = None
+        self._mapped_rows = 0
+        # Ngưỡng số row để compaction lần tới (tăng lên nếu lần trước không thay được file)
+        self._compact_at = max_rows
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _load(self):
+        """Đọc index, cắt bỏ phần ghi dở (index và vectors lệch nhau sau crash)"""
+        keys = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                keys = f.read()
+        vector_bytes = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        count = min(len(keys) // KEY_BYTES, vector_bytes // self._row_bytes)
+
+        if len(keys) != count * KEY_BYTES or vector_bytes != count * self._row_bytes:
+            logger.warning(f"Embedding store {self.directory}: truncating to {count} consistent rows")
+            for path, size in ((self.index_path, count * KEY_BYTES), (self.vectors_path, count * self._row_bytes)):
+                with open(path, "ab") as f:
+                    f.truncate(size)
+
+        self._rows = {keys[i * KEY_BYTES:(i + 1) * KEY_BYTES]: i for i in range(count)}
+        self._last_used = list(range(count))
+        self._clock = count
+        self._remap(count)
+        if count:
+            logger.info(f"Embedding store {self.directory}: {count} cached vectors")
+
+    def _remap(self, count):
+        self._mmap = None
+        self._mapped_rows = count
+        if count:
+            self._mmap = np.memmap(self.vectors_path, dtype="<f4", mode="r", shape=(count, self.dim))
+
+    def _touch(self, row):
+        self._clock += 1
+        self._last_used[row] = self._clock
+
+    def get_many(self, keys):
+        """Trả về (positions, vectors): vị trí trong `keys` có trong store và các vector tương ứng.
+
+        vectors là list slice từng row của memmap (chỉ đọc, không copy); fancy index
+        self._mmap[rows] sẽ luôn copy cả khối.
+        """
+        with self._lock:
+            positions, rows = [], []
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is not None:
+                    positions.append(i)
+                    rows.append(row)
+                    self._touch(row)
+            if not rows:
+                return [], None
+            if max(rows) >= self._mapped_rows:
+                self._remap(len(self._last_used))
+            mmap = self._mmap
+            return positions, [mmap[row] for row in rows]
+
+    def get(self, key):
+        """Trả về vector (slice memmap, không copy) hoặc None"""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            self._touch(row)
+            if row >= self._mapped_rows:
+                self._remap(len(self._last_used))
+            return self._mmap[row]
+
+    def add_many(self, keys, matrix):
+        """Append các vector chưa có trong store (vector trước, index sau)"""
+        with self._lock:
+            fresh = [i for i, key in enumerate(keys) if key not in self._rows]
+            # Bỏ key trùng trong cùng batch
+            seen = set()
+            fresh = [i for i in fresh if not (keys[i] in seen or seen.add(keys[i]))]
+            if not fresh:
+                return
+            block = np.ascontiguousarray(matrix[fresh], dtype="<f4")
+            with open(self.vectors_path, "ab") as f:
+                f.write(block.tobytes())
+            with open(self.index_path, "ab") as f:
+                f.write(b"".join(keys[i] for i in fresh))
+            for i in fresh:
+                row = len(self._last_used)
+                self._rows[keys[i]] = row
+                self._last_used.append(0)
+                self._touch(row)
+            if len(self._rows) > self._compact_at:
+                self._compact_locked(int(self.max_rows * COMPACT_KEEP_RATIO))
+
+    def compact(self, keep=None):
+        """Ghi lại store chỉ với `keep` row dùng gần nhất (mặc định: toàn bộ row)"""
+        with self._lock:
+            self._compact_locked(len(self._rows) if keep is None else keep)
+
+    def _compact_locked(self, keep):
+        count = len(self._last_used)
+        if not count:
+            return
+        self._remap(count)
+        order = np.argsort(np.asarray(self._last_used, dtype=np.int64), kind="stable")[::-1][:keep]
+        keep_rows = np.sort(order)
+        by_row = {row: key for key, row in self._rows.items()}
+        new_keys = [by_row[int(row)] for row in keep_rows]
+
+        tmp_index = self.index_path + ".tmp"
+        tmp_vectors = self.vectors_path + ".tmp"
+        with open(tmp_vectors, "wb") as f:
+            for start in range(0, len(keep_rows), 4096):
+                f.write(np.ascontiguousarray(self._mmap[keep_rows[start:start + 4096]]).tobytes())
+        with open(tmp_index, "wb") as f:
+            f.write(b"".join(new_keys))
+
+        # Đóng memmap trước khi thay file (Windows không cho replace file đang map)
+        self._remap(0)
+        try:
+            os.replace(tmp_vectors, self.vectors_path)
+        except PermissionError as e:
+            # Windows: slice từ get()/get_many() còn giữ file; giữ nguyên store, thử lại sau
+            for path in (tmp_vectors, tmp_index):
+                os.remove(path)
+            self._remap(count)
+            self._compact_at = len(self._rows) + max(1, self.max_rows // 10)
+            logger.warning(f"Embedding store {self.directory}: compaction postponed ({e})")
+            return
+        os.replace(tmp_index, self.index_path)
+        self._compact_at = self.max_rows
+
+        last_used = [self._last_used[int(row)] for row in keep_rows]
+        self._rows = {key: i for i, key in enumerate(new_keys)}
+        self._last_used = last_used
+        self._remap(len(new_keys))
+        logger.info(f"Embedding store {self.directory}: compacted {count} -> {len(new_keys)} rows")
@@ -0,0 +1,176 @@
+"""Nhận diện loại file dùng chung cho các endpoint nhận file.
+
+- MIME -> extension: tra dict theo subtype (giống quy ước cũ: subtype lạ thì dùng luôn subtype)
+- Magic bytes: bảng signature dựng thành trie theo prefix, khớp prefix dài nhất trên SIGNATURE_WINDOW byte đầu
+- Text: chỉ decode một đoạn đầu giới hạn TEXT_SAMPLE_BYTES
+"""
+
+import codecs
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXT = "bin"
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# Số byte đầu dùng để tra trie signature
+SIGNATURE_WINDOW = 16
+# Số byte tối đa dùng để đoán file text
+TEXT_SAMPLE_BYTES = 1024
+
+MIME_SUBTYPE_TO_EXT = {
+    "jpeg": "jpg",
+    "png": "png",
+    "gif": "gif",
+    "webp": "webp",
+    "svg+xml": "svg",
+    "plain": "txt",
+    "python": "py",
+    "javascript": "js",
+    "css": "css",
+    "html": "html",
+    "json": "json",
+    "xml": "xml",
+    "csv": "csv",
+    "pdf": "pdf",
+    "zip": "zip",
+    "x-icon": "ico",
+    "x-bat": "bat",
+    "x-sh": "sh",
+    "x-powershell": "ps1",
+    "x-cmd": "cmd",
+    "x-bash": "sh",
+    "x-zsh": "zsh",
+    "x-fish": "fish",
+    "x-yaml": "yml",
+    "x-toml": "toml",
+    "x-ini": "ini",
+    "x-config": "conf",
+    "x-log": "log",
+    "x-markdown": "md",
+    "x-rst": "rst",
+    "x-asciidoc": "adoc",
+}
+
+
+def _has_newline(head):
+    return b"\n" in head
+
+
+def _is_webp(head):
+    return head[8:12] == b"WEBP"
+
+
+# (prefix, ext, content_type, check) - check nhận head bytes, None = luôn khớp
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png", None),
+    (b"\xff\xd8\xff", "jpg", "image/jpeg", None),
+    (b"GIF87a", "gif", "image/gif", None),
+    (b"GIF89a", "gif", "image/gif", None),
+    (b"RIFF", "webp", "image/webp", _is_webp),
+    (b"%PDF", "pdf", "application/pdf", None),
+    (b"PK\x03\x04", "zip", "application/zip", None),
+    (b"#!/usr/bin/env python", "py", "text/x-python", None),
+    (b"#!python", "py", "text/x-python", None),
+    (b"#!/bin/bash", "sh", "text/x-sh", None),
+    (b"#!/usr/bin/bash", "sh", "text/x-sh", None),
+    (b"#!/bin/sh", "sh", "text/x-sh", None),
+    (b"@echo off", "bat", "text/x-bat", None),
+    (b"@echo on", "bat", "text/x-bat", None),
+    (b"#Requires", "ps1", "text/x-powershell", None),
+    (b"param(", "ps1", "text/x-powershell", None),
+    (b"function ", "ps1", "text/x-powershell", None),
+    (b"<?xml", "xml", "application/xml", None),
+    (b"{", "json", "application/json", None),
+    (b"[", "json", "application/json", None),
+    (b"<!DOCTYPE", "html", "text/html", None),
+    (b"<html", "html", "text/html", None),
+    (b"/*", "css", "text/css", None),
+    (b"@import", "css", "text/css", None),
+    (b"function", "js", "application/javascript", None),
+    (b"var ", "js", "application/javascript", None),
+    (b"const ", "js", "application/javascript", None),
+    (b"---", "yml", "text/x-yaml", _has_newline),
+    (b"# ", "md", "text/x-markdown", _has_newline),
+    (b"#", "txt", "text/plain", _has_newline),
+]
+
+# Key đặc biệt trong node trie chứa danh sách signature kết thúc tại node đó
+_ENTRIES = -1
+
+
+def _build_trie(signatures):
+    root = {}
+    for prefix, ext, content_type, check in signatures:
+        node = root
+        for byte in prefix[:SIGNATURE_WINDOW]:
+            node = node.setdefault(byte, {})
+        # Signature dài hơn cửa sổ trie: kiểm tra nốt phần còn lại khi khớp
+        full_prefix = prefix if len(prefix) > SIGNATURE_WINDOW else None
+        node.setdefault(_ENTRIES, []).append((ext, content_type, check, full_prefix))
+    return root
+
+
+_SIGNATURE_TRIE = _build_trie(SIGNATURES)
+
+
+def ext_for_mime(mime):
+    """Lấy extension từ MIME type (vd: image/jpeg -> jpg)"""
+    if not mime or "/" not in mime:
+        return DEFAULT_EXT
+    subtype = mime.split("/", 1)[1]
+    return MIME_SUBTYPE_TO_EXT.get(subtype, subtype)
+
+
+def sniff_signature(head):
+    """Tra magic bytes, trả về (ext, content_type) của prefix khớp dài nhất hoặc None"""
+    node = _SIGNATURE_TRIE
+    matched = []
+    for byte in head[:SIGNATURE_WINDOW]:
+        node = node.get(byte)
+        if node is None:
+            break
+        entries = node.get(_ENTRIES)
+        if entries:
+            matched.append(entries)
+    for entries in reversed(matched):
+        for ext, content_type, check, full_prefix in entries:
+            if full_prefix is not None and not head.startswith(full_prefix):
+                continue
+            if check is None or check(head):
+                return ext, content_type
+    return None
+
+
+def looks_like_text(head):
+    """Đoán file text dựa trên TEXT_SAMPLE_BYTES byte đầu"""
+    sample = head[:TEXT_SAMPLE_BYTES]
+    if not sample:
+        return False
+    try:
+        # Decoder incremental: không báo lỗi nếu sample cắt ngang ký tự nhiều byte
+        text = codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return False
+    return text.isprintable() or "\n" in text
+
+
+def detect_file_type(head, declared_mime=None):
+    """Xác định (ext, content_type) từ MIME khai báo hoặc nội dung đầu file"""
+    content_type = DEFAULT_CONTENT_TYPE
+    if declared_mime:
+        ext = ext_for_mime(declared_mime)
+        if ext != DEFAULT_EXT:
+            return ext, declared_mime
+        content_type = declared_mime
+    if not head:
+        return DEFAULT_EXT, content_type
+    try:
+        found = sniff_signature(head)
+        if found:
+            return found
+        if looks_like_text(head):
+            return "txt", "text/plain"
+    except Exception as e:
+        logger.warning(f"Error detecting file type: {e}")
+    return DEFAULT_EXT, content_type
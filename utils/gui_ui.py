@@ -12,7 +12,7 @@ import logging
 import requests
 import json
 from .cookie_parser import build_header
-from config import QWEN_HEADERS
+from config import QWEN_HEADERS, QWEN_API_BASE
 
 logger = logging.getLogger(__name__)
 
@@ -794,7 +794,7 @@ Escape    - Close popup windows
             
         try:
             headers = build_header(QWEN_HEADERS, self.cookie_value)
-            response = requests.get("https://chat.qwen.ai/api/v2/users/user/settings", headers=headers, timeout=5)
+            response = requests.get(f"{QWEN_API_BASE}/v2/users/user/settings", headers=headers, timeout=5)
             if response.status_code == 200:
                 data = response.json()
                 if data.get("success"):
@@ -869,7 +869,7 @@ Escape    - Close popup windows
             headers = build_header(QWEN_HEADERS, self.cookie_value)
             headers["Content-Type"] = "application/json"
             payload = {section: {key: value}}
-            url = "https://chat.qwen.ai/api/v2/users/user/settings/update"
+            url = f"{QWEN_API_BASE}/v2/users/user/settings/update"
             response = requests.post(url, headers=headers, json=payload, timeout=5)
             
             if response.status_code == 200 and response.json().get("success"):
@@ -965,7 +965,7 @@ Escape    - Close popup windows
             
             payload = {"forget_all": True}
             
-            url = "https://chat.qwen.ai/api/v2/memories/delete"
+            url = f"{QWEN_API_BASE}/v2/memories/delete"
             response = requests.post(url, headers=headers, json=payload, timeout=10)
             
             if response.status_code == 200:
@@ -994,7 +994,7 @@ Escape    - Close popup windows
         try:
             headers = build_header(QWEN_HEADERS, self.cookie_value)
             # Fetch first page, 50 items
-            url = "https://chat.qwen.ai/api/v2/memories/?page_size=50&page_num=1"
+            url = f"{QWEN_API_BASE}/v2/memories/?page_size=50&page_num=1"
             response = requests.get(url, headers=headers, timeout=5)
             
             if response.status_code == 200:
@@ -0,0 +1,132 @@
+import io
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from config import (
+    IMAGE_PREPROCESS_ENABLED,
+    IMAGE_MAX_DIMENSION,
+    IMAGE_OUTPUT_FORMAT,
+    IMAGE_OUTPUT_QUALITY,
+    IMAGE_PREPROCESS_MIN_BYTES,
+    IMAGE_PREPROCESS_CACHE_BYTES,
+)
+from utils.attachment_ingest import IngestedAttachment, SNIFF_BYTES
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+except Exception:  # Pillow là optional
+    Image = None
+    ImageOps = None
+
+# Số entry tối đa trong cache (kể cả entry "không nén được")
+_CACHE_MAX_ENTRIES = 1024
+
+# Các loại ảnh được phép xử lý lại (GIF động / SVG giữ nguyên)
+_PROCESSABLE_TYPES = ("image/png", "image/jpeg", "image/webp", "image/bmp", "image/tiff")
+
+_OUTPUT_MIME = {
+    "webp": ("image/webp", "webp"),
+    "jpeg": ("image/jpeg", "jpg"),
+}
+
+
+class ImagePreprocessor:
+    """Thu nhỏ + nén lại ảnh trước khi upload (chỉ khi có Pillow và được bật trong config)"""
+
+    def __init__(self):
+        self.enabled = IMAGE_PREPROCESS_ENABLED and Image is not None
+        self.max_dimension = IMAGE_MAX_DIMENSION
+        self.output_format = IMAGE_OUTPUT_FORMAT if IMAGE_OUTPUT_FORMAT in _OUTPUT_MIME else "webp"
+        self.quality = IMAGE_OUTPUT_QUALITY
+        self.min_bytes = IMAGE_PREPROCESS_MIN_BYTES
+        self.cache_limit = IMAGE_PREPROCESS_CACHE_BYTES
+        # source hash -> bytes đã xử lý (None nếu xử lý không có lợi)
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        if IMAGE_PREPROCESS_ENABLED and Image is None:
+            logger.warning("Image preprocessing enabled but Pillow is not installed; images are uploaded as-is")
+
+    def _cache_get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return False, None
+            self._cache.move_to_end(key)
+            return True, self._cache[key]
+
+    def _cache_put(self, key, value):
+        size = len(value) if value else 0
+        if size > self.cache_limit:
+            return
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old:
+                self._cache_bytes -= len(old)
+            self._cache[key] = value
+            self._cache_bytes += size
+            while self._cache and (self._cache_bytes > self.cache_limit or len(self._cache) > _CACHE_MAX_ENTRIES):
+                _, evicted = self._cache.popitem(last=False)
+                if evicted:
+                    self._cache_bytes -= len(evicted)
+
+    def _encode(self, fileobj):
+        """Decode ảnh, bỏ EXIF (giữ hướng xoay), giới hạn kích thước và encode lại"""
+        with Image.open(fileobj) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+            if self.output_format == "jpeg":
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                save_kwargs = {"quality": self.quality, "optimize": True}
+            else:
+                if img.mode not in ("RGB", "RGBA", "L", "LA"):
+                    img = img.convert("RGBA")
+                save_kwargs = {"quality": self.quality, "method": 4}
+            out = io.BytesIO()
+            # Không truyền exif=... nên metadata EXIF bị loại bỏ
+            img.save(out, format=self.output_format.upper(), **save_kwargs)
+            return out.getvalue()
+
+    def process(self, attachment, content_type):
+        """Trả về (IngestedAttachment mới, ext, content_type) hoặc None nếu giữ nguyên ảnh gốc.
+
+        Kết quả được cache theo hash của ảnh gốc.
+        """
+        if not self.enabled or content_type not in _PROCESSABLE_TYPES:
+            return None
+        if attachment.size < self.min_bytes:
+            return None
+
+        found, data = self._cache_get(attachment.hashed)
+        if not found:
+            try:
+                attachment.fileobj.seek(0)
+                data = self._encode(attachment.fileobj)
+                if len(data) >= attachment.size:
+                    data = None
+            except Exception as e:
+                logger.warning(f"Image preprocessing failed, uploading original: {e}")
+                data = None
+            finally:
+                attachment.fileobj.seek(0)
+            self._cache_put(attachment.hashed, data)
+        if not data:
+            return None
+
+        out_mime, out_ext = _OUTPUT_MIME[self.output_format]
+        logger.info(f"Image preprocessed: {attachment.size} -> {len(data)} bytes ({out_mime})")
+        processed = IngestedAttachment(
+            io.BytesIO(data),
+            len(data),
+            hashlib.sha256(data).hexdigest(),
+            data[:SNIFF_BYTES],
+            out_mime,
+        )
+        return processed, out_ext, out_mime
+
+
+# Global image preprocessor instance
+image_preprocessor = ImagePreprocessor()
@@ -1,6 +1,7 @@
 import logging
 import os
 from datetime import datetime
+from utils.tracing import RequestIdFilter
 
 def setup_logging():
     """Cấu hình logging cho server"""
@@ -13,13 +14,14 @@ def setup_logging():
     log_file = os.path.join(log_dir, f"{today}.log")
     file_handler = logging.FileHandler(log_file, encoding='utf-8')
     file_handler.setLevel(logging.INFO)
-    file_formatter = logging.Formatter('%(asctime)s  [%(levelname)s]\n [LM STUDIO SERVER] %(message)s')
+    file_formatter = logging.Formatter('%(asctime)s  [%(levelname)s] [%(request_id)s]\n [LM STUDIO SERVER] %(message)s')
     file_handler.setFormatter(file_formatter)
+    file_handler.addFilter(RequestIdFilter())
     
     # Console handler chỉ cho route info và errors
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
-    console_formatter = logging.Formatter('%(asctime)s  [%(levelname)s] %(message)s')
+    console_formatter = logging.Formatter('%(asctime)s  [%(levelname)s] [%(request_id)s] %(message)s')
     console_handler.setFormatter(console_formatter)
     
     # Tạo custom filter để chỉ log route info ra console
@@ -28,6 +30,7 @@ def setup_logging():
             return 'ROUTE:' in record.getMessage() or record.levelno >= logging.WARNING
     
     console_handler.addFilter(RouteFilter())
+    console_handler.addFilter(RequestIdFilter())
     
     # Cấu hình root logger
     logging.basicConfig(
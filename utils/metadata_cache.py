@@ -0,0 +1,82 @@
+import json
+import time
+import hashlib
+import threading
+from flask import Response, request
+
+
+def _dumps(obj):
+    """JSON gọn (không indent, không khoảng trắng thừa) dạng bytes"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MetadataCache:
+    """Body đã serialize sẵn cho các endpoint metadata (/v1/models, /api/tags, /api/show...).
+
+    Mỗi entry là (version, body bytes, etag); chỉ dựng lại khi danh sách model thay đổi
+    (set_catalogue) hoặc khi version truyền vào khác (vd. trạng thái session của /api/ps).
+    IDE plugin poll các endpoint này liên tục: request lặp lại chỉ tốn một lần tra dict,
+    và client gửi If-None-Match đúng ETag nhận 304 không body.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._catalogue_digest = None
+        # Thời điểm danh sách model thay đổi lần cuối: dùng cho created/modified_at
+        self.updated_at = int(time.time())
+        self.builds = 0
+        self.not_modified = 0
+
+    def set_catalogue(self, models):
+        """Ghi nhận danh sách model mới; xóa mọi body đã dựng nếu nội dung khác lần trước"""
+        digest = hashlib.sha1(_dumps(models)).hexdigest()
+        with self._lock:
+            if digest == self._catalogue_digest:
+                return False
+            self._catalogue_digest = digest
+            self._entries.clear()
+            self.updated_at = int(time.time())
+            return True
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key, build, version=None):
+        """(body, etag) của key; gọi build() -> dict để dựng khi chưa có hoặc version đổi"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+        body = _dumps(build())
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries[key] = (version, body, etag)
+            self.builds += 1
+        return body, etag
+
+    def respond(self, key, build, version=None):
+        """Response JSON với ETag; 304 nếu If-None-Match khớp (GET/HEAD)"""
+        body, etag = self.get(key, build, version)
+        if request.method in ("GET", "HEAD") and request.if_none_match.contains(etag):
+            with self._lock:
+                self.not_modified += 1
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "builds": self.builds,
+                "not_modified": self.not_modified,
+                "updated_at": self.updated_at,
+            }
+
+
+# Global metadata cache instance
+metadata_cache = MetadataCache()
@@ -0,0 +1,183 @@
+"""Metrics kiểu Prometheus (text exposition format 0.0.4) cho endpoint /metrics.
+
+Counter/Gauge/Histogram giữ giá trị theo bộ label trong dict, mỗi lần ghi chỉ lấy lock riêng
+của metric đó (không có lock toàn cục). Histogram dùng bucket cố định: ghi một mẫu là một lần
+bisect + cộng count/sum, không giữ danh sách mẫu. Metric có callback được đọc lúc scrape
+(queue depth, bộ đếm cache) nên hot path không tốn gì.
+"""
+
+import bisect
+import math
+import threading
+
+# Bucket cố định (giây / token mỗi giây)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+RATE_BUCKETS = (1.0, 5.0, 10.0, 20.0, 40.0, 60.0, 80.0, 100.0, 150.0, 200.0, 300.0, 500.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set_callback(self, callback):
+        """Đọc giá trị lúc scrape: callback() -> số (không label) hoặc {tuple label: số}"""
+        self.callback = callback
+
+    def _samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            return value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            samples = dict(self._values)
+        if not samples and not self.labelnames:
+            samples[()] = 0
+        return samples
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self._samples().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # bisect_left: value == cận trên vẫn thuộc bucket đó (le = "less or equal")
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = {labels: (list(state[0]), state[1], state[2]) for labels, state in self._values.items()}
+        if not samples and not self.labelnames:
+            samples[()] = ([0] * (len(self.buckets) + 1), 0.0, 0)
+        for labels, (counts, total, count) in sorted(samples.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, ('le', _number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Danh sách metric theo thứ tự đăng ký; render() ra text exposition format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Counter(name, help_text, labelnames, callback))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+# Global metrics registry instance
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    "qwen_http_requests_total", "HTTP requests by route, method and status", ("endpoint", "method", "status"))
+HTTP_DURATION = metrics.histogram(
+    "qwen_http_request_duration_seconds", "Time until the response (or the first byte of a stream) is returned",
+    ("endpoint",))
+QUEUE_DEPTH = metrics.gauge("qwen_queue_depth", "Interactive requests waiting for the chat lock")
+QUEUE_PROCESSING = metrics.gauge("qwen_queue_processing", "1 while an interactive request holds the chat lock")
+QUEUE_WAIT = metrics.histogram("qwen_queue_wait_seconds", "Time spent waiting for the chat lock")
+QUEUE_TIMEOUTS = metrics.counter("qwen_queue_timeouts_total", "Requests that gave up waiting for the chat lock")
+UPSTREAM_CONNECT = metrics.histogram("qwen_upstream_connect_seconds", "Time until Qwen returned response headers")
+UPSTREAM_RETRIES = metrics.counter("qwen_upstream_retries_total", "Upstream requests retried on a new chat", ("reason",))
+UPSTREAM_ERRORS = metrics.counter("qwen_upstream_errors_total", "Upstream requests that failed", ("code",))
+ACTIVE_STREAMS = metrics.gauge("qwen_active_streams", "Upstream streams currently being read")
+TTFT = metrics.histogram("qwen_time_to_first_token_seconds", "Time from request received to first output token")
+INTER_TOKEN = metrics.histogram(
+    "qwen_inter_token_latency_seconds", "Gap between consecutive output deltas", buckets=TOKEN_GAP_BUCKETS)
+TOKENS_PER_SECOND = metrics.histogram(
+    "qwen_output_tokens_per_second", "Output tokens per second of generation per response", buckets=RATE_BUCKETS)
+OUTPUT_TOKENS = metrics.counter("qwen_output_tokens_total", "Output tokens produced (estimated)")
+UPLOADS = metrics.counter("qwen_uploads_total", "Attachment uploads by file type and result", ("type", "result"))
+UPLOAD_BYTES = metrics.counter("qwen_upload_bytes_total", "Bytes of attachments uploaded", ("type",))
+UPLOAD_DURATION = metrics.histogram("qwen_upload_duration_seconds", "Attachment upload latency", ("type",))
+CACHE_LOOKUPS = metrics.counter(
+    "qwen_cache_lookups_total", "Response cache lookups by cache layer and result", ("cache", "result"))
+CACHE_HIT_RATIO = metrics.gauge("qwen_cache_hit_ratio", "Hit ratio since start by cache layer", ("cache",))
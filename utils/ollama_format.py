@@ -0,0 +1,70 @@
+"""Dựng dòng NDJSON cho Ollama /api/chat và /api/generate.
+
+Mỗi token chỉ được serialize một lần: phần đầu/cuối của chunk (model, role, done)
+được dựng sẵn theo target, chỉ `content` và `created_at` được chèn vào mỗi chunk.
+Output giống hệt json.dumps(dict) với separators mặc định.
+"""
+
+import json
+import time
+from datetime import datetime, timezone
+
+OLLAMA_TARGETS = ("chat", "generate")
+
+_created_at_cache = (0, "")
+
+
+def created_at():
+    """Timestamp ISO 8601 (UTC) cho field created_at, cache theo từng millisecond"""
+    global _created_at_cache
+    ms = time.time_ns() // 1_000_000
+    cached_ms, text = _created_at_cache
+    if ms != cached_ms:
+        stamp = datetime.fromtimestamp(ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+        text = stamp.isoformat(timespec="milliseconds") + "Z"
+        _created_at_cache = (ms, text)
+    return text
+
+
+class OllamaChunkWriter:
+    """Tạo các chunk của một response Ollama theo target ("chat" hoặc "generate")
+
+    model: tên model trong chunk nội dung; final_model: tên model trong chunk cuối
+    (chat trả "<model>:latest", generate trả đúng tên client gửi lên).
+    """
+
+    def __init__(self, target, model, final_model=None):
+        if target not in OLLAMA_TARGETS:
+            raise ValueError(f"Unknown Ollama target: {target}")
+        self.target = target
+        self.model = model
+        self.final_model = final_model or model
+        self._head = '{"model": ' + json.dumps(model) + ', "created_at": "'
+        if target == "generate":
+            self._body = '", "response": '
+            self._tail = ', "done": false}\n'
+        else:
+            self._body = '", "message": {"role": "assistant", "content": '
+            self._tail = '}, "done": false}\n'
+
+    def content(self, text):
+        """Dòng NDJSON cho một đoạn nội dung (done: false)"""
+        return self._head + created_at() + self._body + json.dumps(text) + self._tail
+
+    def message(self, content, model=None, **fields):
+        """Dict response đầy đủ (chunk cuối, lỗi, non-streaming) theo target"""
+        chunk = {"model": model or self.model, "created_at": created_at()}
+        if self.target == "generate":
+            chunk["response"] = content
+        else:
+            chunk["message"] = {"role": "assistant", "content": content}
+        chunk.update(fields)
+        return chunk
+
+    def final(self, content="", **fields):
+        """Dict chunk cuối (done: true, done_reason: stop) + stats/context"""
+        return self.message(content, model=self.final_model, done_reason="stop", done=True, **fields)
+
+    def error(self, message):
+        """Dòng NDJSON báo lỗi (done: true)"""
+        return json.dumps(self.message("", done=True, error=message)) + "\n"
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+def _frame_label(code, root):
+    """Tên frame dạng "func (path:firstline)"; path rút gọn theo thư mục project"""
+    filename = code.co_filename
+    if filename.startswith(root):
+        filename = filename[len(root):].lstrip(os.sep)
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Profiler lấy mẫu stack của mọi thread qua sys._current_frames() trên một thread nền.
+
+    Chỉ chạy khi được gọi (profile(seconds)); lúc rảnh không có thread hay hook nào nên không
+    tốn chi phí. Kết quả là collapsed stack ("thread;frame;frame N"), đưa thẳng vào
+    flamegraph.pl / speedscope / inferno. Mỗi lần chỉ một phiên profile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    @property
+    def running(self):
+        return self._running
+
+    def profile(self, seconds, interval=0.01):
+        """Lấy mẫu trong `seconds` giây (block tới khi xong); None nếu đang có phiên khác"""
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+        try:
+            stacks = Counter()
+            result = {"samples": 0}
+            sampler = threading.Thread(target=self._sample, args=(stacks, result, seconds, interval),
+                                       daemon=True, name="sampling-profiler")
+            sampler.start()
+            sampler.join()
+            result["stacks"] = stacks
+            return result
+        finally:
+            self._running = False
+
+    def _sample(self, stacks, result, seconds, interval):
+        own_id = threading.get_ident()
+        labels = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code, self._root)
+                    parts.append(label)
+                    frame = frame.f_back
+                parts.append(names.get(thread_id, f"thread-{thread_id}"))
+                stacks[";".join(reversed(parts))] += 1
+            result["samples"] += 1
+            time.sleep(interval)
+
+    @staticmethod
+    def collapsed(stacks):
+        """Text collapsed stack, stack nhiều mẫu nhất lên đầu"""
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# Global sampling profiler instance
+sampling_profiler = SamplingProfiler()
@@ -2,6 +2,8 @@ import time
 import threading
 from collections import deque
 import logging
+from utils.metrics import QUEUE_WAIT, QUEUE_TIMEOUTS
+from utils.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +31,12 @@ class QueueManager:
     
     def acquire_lock(self, request_id, request_data=None):
         """Acquire lock cho request - nếu đang busy thì thêm vào queue và đợi"""
+        with tracer.span("queue.acquire", {"queue.depth": len(self.chat_queue)}) as span:
+            acquired = self._acquire_lock(request_id, request_data)
+            span.set("acquired", acquired)
+            return acquired
+
+    def _acquire_lock(self, request_id, request_data=None):
         start_wait_time = time.time()
         wait_timeout = 300  # 5 phút timeout cho queue
         
@@ -37,6 +45,7 @@ class QueueManager:
             if not self.current_processing:
                 self.current_processing = True
                 self.current_processing_start_time = time.time()
+                QUEUE_WAIT.observe(0.0)
                 return True
             
             # Nếu đang có request chạy, thêm vào queue
@@ -52,6 +61,7 @@ class QueueManager:
                 # Xóa khỏi queue nếu timeout
                 with self.chat_lock:
                     self.chat_queue = deque([(rid, data) for rid, data in self.chat_queue if rid != request_id])
+                QUEUE_TIMEOUTS.inc()
                 return False
             
             # Kiểm tra và reset lock nếu bị treo
@@ -65,6 +75,7 @@ class QueueManager:
                     self.current_processing = True
                     self.current_processing_start_time = time.time()
                     logger.info(f"Request {request_id} started processing from queue")
+                    QUEUE_WAIT.observe(time.time() - start_wait_time)
                     return True
             
             # Đợi một chút trước khi kiểm tra lại
@@ -81,6 +92,11 @@ class QueueManager:
                 next_request_id, next_request_data = self.chat_queue[0]
                 logger.info(f"Request {request_id} completed, next request {next_request_id} will start")
     
+    def busy(self):
+        """Có request interactive đang chạy hoặc đang đợi (batch nhường lượt)"""
+        with self.chat_lock:
+            return self.current_processing or bool(self.chat_queue)
+
     def get_status(self):
         """Lấy trạng thái queue"""
         with self.chat_lock:
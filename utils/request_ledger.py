@@ -0,0 +1,192 @@
+import time
+import threading
+import contextvars
+
+_current_record = contextvars.ContextVar("qwen_request_record", default=None)
+
+_MAX_TEXT = 200
+
+
+class RequestRecord:
+    """Bản ghi gọn của một HTTP request (lưu trong ring buffer của RequestLedger)"""
+
+    __slots__ = ("request_id", "started_at", "method", "endpoint", "path", "client", "model", "status",
+                 "queue_wait_ms", "ttft_ms", "total_ms", "bytes_in", "bytes_out", "prompt_tokens",
+                 "completion_tokens", "error", "retries", "_start_ns", "_states")
+
+    def __init__(self, method, path, client, bytes_in):
+        self.request_id = None
+        self.started_at = time.time()
+        self.method = method
+        self.endpoint = None
+        self.path = path[:_MAX_TEXT]
+        self.client = client
+        self.model = None
+        self.status = None
+        self.queue_wait_ms = 0.0
+        self.ttft_ms = None
+        self.total_ms = None
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.error = None
+        self.retries = 0
+        self._start_ns = time.perf_counter_ns()
+        self._states = []
+
+    def finish(self):
+        """Chốt thời gian + gộp số liệu từ các RequestState (fan-out: nhiều state) rồi bỏ tham chiếu"""
+        self.total_ms = round((time.perf_counter_ns() - self._start_ns) / 1e6, 3)
+        for state in self._states:
+            if self.model is None:
+                self.model = str(state.model)[:_MAX_TEXT]
+            self.prompt_tokens += state.prompt_tokens
+            self.completion_tokens += state.completion_tokens
+            self.retries += state.retries
+            self.queue_wait_ms = max(self.queue_wait_ms, round(state.queue_wait_ns / 1e6, 3))
+            if state.first_token_ns is not None:
+                ttft_ms = round(state.ttft_ns / 1e6, 3)
+                self.ttft_ms = ttft_ms if self.ttft_ms is None else min(self.ttft_ms, ttft_ms)
+            if self.error is None and state.error:
+                self.error = state.error
+        self._states = None
+        if self.error is None and self.status is not None and self.status >= 400:
+            self.error = f"HTTP {self.status}"
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")}
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile trên list đã sort"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class RequestLedger:
+    """Ring buffer kích thước cố định các RequestRecord gần nhất.
+
+    Bộ nhớ không đổi dưới mọi tải: ghi đè bản ghi cũ nhất, mỗi bản ghi dùng __slots__ và chuỗi
+    bị cắt ngắn. Percentile tính lúc query trên bản sao đã lọc, không có cấu trúc phụ.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._buffer = [None] * self.size
+        self._next = 0
+        self._total = 0
+        self._lock = threading.Lock()
+
+    # --- ghi ---
+
+    def begin(self, method, path, client, bytes_in):
+        record = RequestRecord(method, path, client, bytes_in)
+        _current_record.set(record)
+        return record
+
+    @staticmethod
+    def current():
+        return _current_record.get()
+
+    @staticmethod
+    def attach(request_state):
+        """Gắn RequestState vào record của request hiện tại (nếu có)"""
+        record = _current_record.get()
+        if record is not None and record._states is not None:
+            record._states.append(request_state)
+
+    def add(self, record):
+        record.finish()
+        with self._lock:
+            self._buffer[self._next] = record
+            self._next = (self._next + 1) % self.size
+            self._total += 1
+
+    # --- đọc ---
+
+    def records(self):
+        """Các record, mới nhất trước"""
+        with self._lock:
+            ordered = self._buffer[self._next:] + self._buffer[:self._next]
+        return [r for r in reversed(ordered) if r is not None]
+
+    def query(self, model=None, endpoint=None, errors=False, slowest=None, limit=100):
+        records = self.records()
+        if model:
+            records = [r for r in records if r.model == model]
+        if endpoint:
+            records = [r for r in records if r.endpoint == endpoint]
+        if errors:
+            records = [r for r in records if r.error]
+        summary = self.summarize(records)
+        if slowest:
+            records = sorted(records, key=lambda r: r.total_ms or 0, reverse=True)[:slowest]
+        else:
+            records = records[:limit]
+        return {
+            "capacity": self.size,
+            "recorded_total": self._total,
+            "summary": summary,
+            "data": [r.to_dict() for r in records],
+        }
+
+    @staticmethod
+    def summarize(records):
+        summary = {
+            "count": len(records),
+            "errors": sum(1 for r in records if r.error),
+        }
+        for field in ("total_ms", "ttft_ms", "queue_wait_ms"):
+            values = sorted(getattr(r, field) for r in records if getattr(r, field) is not None)
+            summary[field] = {f"p{pct}": _percentile(values, pct) for pct in (50, 90, 95, 99)}
+            summary[field]["max"] = values[-1] if values else None
+        return summary
+
+
+class LedgerMiddleware:
+    """WSGI middleware: mở record khi request tới, đếm byte body trả về và chốt record khi
+    response đã gửi xong (kể cả stream, hoặc khi client ngắt)"""
+
+    def __init__(self, wsgi_app, ledger):
+        self.wsgi_app = wsgi_app
+        self.ledger = ledger
+
+    def __call__(self, environ, start_response):
+        try:
+            bytes_in = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            bytes_in = 0
+        record = self.ledger.begin(environ.get("REQUEST_METHOD", ""), environ.get("PATH_INFO", ""),
+                                   environ.get("REMOTE_ADDR"), bytes_in)
+
+        def _start_response(status, headers, exc_info=None):
+            try:
+                record.status = int(status.split(" ", 1)[0])
+            except ValueError:
+                pass
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, _start_response)
+        except Exception as e:
+            record.error = type(e).__name__
+            self.ledger.add(record)
+            raise
+        return self._counted(body, record)
+
+    def _counted(self, body, record):
+        try:
+            for chunk in body:
+                record.bytes_out += len(chunk)
+                yield chunk
+        except Exception as e:
+            record.error = record.error or type(e).__name__
+            raise
+        finally:
+            close = getattr(body, "close", None)
+            if close is not None:
+                close()
+            self.ledger.add(record)
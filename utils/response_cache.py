@@ -0,0 +1,137 @@
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_BYPASS_HEADER,
+)
+
+logger = logging.getLogger(__name__)
+
+# Field không ảnh hưởng nội dung trả lời: bỏ khỏi key để stream/non-stream dùng chung entry
+IGNORED_FIELDS = frozenset(("stream", "stream_options", "incremental_output", "keep_alive", "context"))
+# Overhead ước lượng cho mỗi event khi tính dung lượng cache
+_EVENT_OVERHEAD_BYTES = 64
+
+
+def cache_key(data):
+    """SHA-256 của request đã chuẩn hóa (bỏ field vận chuyển, sort key, JSON gọn)"""
+    canonical = {k: v for k, v in data.items() if k not in IGNORED_FIELDS and v is not None}
+    blob = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def bypass_requested(headers):
+    """Client yêu cầu bỏ qua cache: X-Cache-Bypass: 1 hoặc Cache-Control: no-cache/no-store"""
+    value = (headers.get(RESPONSE_CACHE_BYPASS_HEADER) or "").strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    cache_control = (headers.get("Cache-Control") or "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+
+class ResponseCache:
+    """Cache response exact-match: key -> chuỗi event (kind, text) của upstream.
+
+    Lưu chuỗi delta thay vì body đã render nên một entry phát lại được cho mọi API
+    (OpenAI/Ollama, stream hoặc không). Giới hạn bởi số entry, tổng dung lượng text
+    và TTL tính từ lúc ghi; đếm hit/miss/bypass để theo dõi hiệu quả.
+    """
+
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, max_entries=RESPONSE_CACHE_SIZE,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+
+    @staticmethod
+    def _size_of(events):
+        return sum(len(text) for _kind, text in events) + _EVENT_OVERHEAD_BYTES * len(events)
+
+    def _drop_locked(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+
+    def _evict_locked(self, now):
+        # Entry cũ nhất (ít dùng nhất) nằm đầu OrderedDict
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry['stored'] <= self.ttl and len(self._entries) <= self.max_entries \
+                    and self._bytes <= self.max_bytes:
+                break
+            self._drop_locked(key)
+
+    def get(self, key):
+        """Chuỗi event đã cache (tuple) hoặc None; cập nhật bộ đếm hit/miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry['stored'] > self.ttl:
+                self._drop_locked(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry['events']
+
+    def put(self, key, events):
+        events = tuple(events)
+        size = self._size_of(events)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            self._entries[key] = {'events': events, 'size': size, 'stored': now}
+            self._bytes += size
+            self.stores += 1
+            self._evict_locked(now)
+
+    def note_bypass(self):
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            self._evict_locked(time.time())
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "stores": self.stores,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# Global response cache instance
+response_cache = ResponseCache()
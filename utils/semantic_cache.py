@@ -0,0 +1,173 @@
+import json
+import time
+import hashlib
+import threading
+import logging
+import numpy as np
+from config import (
+    SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, EMBEDDING_DIM,
+)
+from utils.response_cache import IGNORED_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Role được coi là "lượt user cuối" (chat: user, /api/generate: prompt)
+QUERY_ROLES = ("user", "prompt")
+
+
+def _message_text(content):
+    """Text của content dạng chuỗi hoặc list part (OpenAI vision format)"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            str(part.get("text") or "") if isinstance(part, dict) else str(part)
+            for part in content
+            if isinstance(part, str) or (isinstance(part, dict) and part.get("type") == "text")
+        )
+    return "" if content is None else str(content)
+
+
+def split_query(data):
+    """Tách request thành (context_hash, query_text) hoặc None nếu không có lượt user cuối.
+
+    query_text: lượt user cuối, chuẩn hóa chữ thường + gộp khoảng trắng.
+    context_hash: uint64 của mọi thứ còn lại (system, lịch sử, tham số) - chỉ so khớp
+    ngữ nghĩa giữa các request có cùng context.
+    """
+    messages = data.get("messages")
+    if not isinstance(messages, list):
+        return None
+    last = None
+    for i in range(len(messages) - 1, -1, -1):
+        message = messages[i]
+        if isinstance(message, dict) and message.get("role") in QUERY_ROLES:
+            last = i
+            break
+    if last is None:
+        return None
+    text = " ".join(_message_text(messages[last].get("content")).lower().split())
+    if not text:
+        return None
+    rest = {k: v for k, v in data.items() if k not in IGNORED_FIELDS and k != "messages" and v is not None}
+    rest["messages"] = messages[:last] + messages[last + 1:]
+    blob = json.dumps(rest, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    context_hash = int.from_bytes(hashlib.blake2b(blob.encode("utf-8"), digest_size=8).digest(), "little")
+    return context_hash, text
+
+
+class _ModelIndex:
+    """Index vector của một model: ma trận cấp phát sẵn, tìm kiếm brute-force bằng một phép nhân"""
+
+    def __init__(self, capacity, dim):
+        self.capacity = capacity
+        self.count = 0
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.contexts = np.zeros(capacity, dtype=np.uint64)
+        self.stored = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.events = [None] * capacity
+
+    def search(self, context_hash, vector, now, ttl):
+        """(row, similarity) của vector gần nhất cùng context còn hạn, hoặc (None, 0.0)"""
+        n = self.count
+        if not n:
+            return None, 0.0
+        scores = self.vectors[:n] @ vector
+        invalid = (self.contexts[:n] != np.uint64(context_hash)) | (now - self.stored[:n] > ttl)
+        scores[invalid] = -np.inf
+        row = int(np.argmax(scores))
+        if not np.isfinite(scores[row]):
+            return None, 0.0
+        return row, float(scores[row])
+
+    def add(self, context_hash, vector, events, now, ttl):
+        if self.count < self.capacity:
+            row = self.count
+            self.count += 1
+        else:
+            # Ưu tiên ghi đè entry hết hạn, sau đó entry dùng lâu nhất (LRU)
+            candidates = self.last_used.copy()
+            candidates[now - self.stored > ttl] = -1.0
+            row = int(np.argmin(candidates))
+        self.vectors[row] = vector
+        self.contexts[row] = np.uint64(context_hash)
+        self.stored[row] = now
+        self.last_used[row] = now
+        self.events[row] = events
+
+
+class SemanticCache:
+    """Cache response theo ngữ nghĩa của lượt user cuối, mỗi model một index.
+
+    Lượt user cuối được embed bằng embedding cục bộ (services.embedding_service), so
+    cosine với các câu đã cache cùng model + cùng context; >= threshold thì phát lại
+    chuỗi event đã lưu. Mỗi index tối đa max_entries entry (thay entry hết hạn/LRU).
+    Tìm kiếm brute-force: với vài nghìn entry x 768 chiều chỉ là một phép nhân ma trận.
+    """
+
+    def __init__(self, enabled=SEMANTIC_CACHE_ENABLED, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 max_entries=SEMANTIC_CACHE_SIZE, ttl=SEMANTIC_CACHE_TTL, dim=EMBEDDING_DIM, embed=None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dim = dim
+        self._embed = embed
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def embed(self, text):
+        """Vector float32 (dim,) đã chuẩn hóa L2 của query"""
+        if self._embed is None:
+            from services.embedding_service import embedding_service
+            self._embed = embedding_service.embed
+        return np.asarray(self._embed([text])[0], dtype=np.float32)
+
+    def search(self, model, context_hash, vector):
+        """Trả về (events, similarity) nếu có entry đủ giống, ngược lại None"""
+        now = time.time()
+        with self._lock:
+            index = self._indexes.get(model)
+            row, similarity = (None, 0.0) if index is None else index.search(context_hash, vector, now, self.ttl)
+            if row is None or similarity < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            index.last_used[row] = now
+            return index.events[row], similarity
+
+    def add(self, model, context_hash, vector, events):
+        now = time.time()
+        with self._lock:
+            index = self._indexes.get(model)
+            if index is None:
+                index = self._indexes[model] = _ModelIndex(self.max_entries, self.dim)
+            index.add(context_hash, vector, tuple(events), now, self.ttl)
+            self.stores += 1
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "threshold": self.threshold,
+                "models": {model: index.count for model, index in self._indexes.items()},
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Global semantic cache instance
+semantic_cache = SemanticCache()
@@ -0,0 +1,112 @@
+import time
+import secrets
+import threading
+import logging
+from collections import OrderedDict
+from config import SESSION_CACHE_SIZE, SESSION_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Phần tử đầu của context handle, phân biệt với context token thật của Ollama
+CONTEXT_MAGIC = 0x5157
+_KEY_BITS = 62
+_HALF_MASK = (1 << 31) - 1
+
+
+class SessionCache:
+    """Cache session upstream cho Ollama `context`: key -> chat_id/parent_id/token count.
+
+    Client chỉ nhận một handle ngắn [CONTEXT_MAGIC, key_hi, key_lo] trong `context`;
+    gửi lại handle đó thì request tiếp tục đúng chat upstream và chỉ cần gửi prompt mới.
+    Số entry bị chặn bởi LRU (max_entries) và mỗi entry hết hạn sau ttl giây không dùng.
+    """
+
+    def __init__(self, max_entries=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode_context(key):
+        return [CONTEXT_MAGIC, key >> 31, key & _HALF_MASK]
+
+    @staticmethod
+    def decode_context(context):
+        """Trả về session key từ `context` hoặc None nếu không phải handle của server"""
+        if not isinstance(context, list) or len(context) != 3 or context[0] != CONTEXT_MAGIC:
+            return None
+        hi, lo = context[1], context[2]
+        if not isinstance(hi, int) or not isinstance(lo, int) or hi < 0 or not 0 <= lo <= _HALF_MASK:
+            return None
+        return (hi << 31) | lo
+
+    def _expired(self, entry, now):
+        return now - entry['last_used'] > self.ttl
+
+    def _evict_locked(self, now):
+        # Entry cũ nhất nằm đầu OrderedDict: dừng ở entry đầu tiên còn hạn
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if not self._expired(entry, now):
+                break
+            self._entries.popitem(last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def create(self, model, chat_id, parent_id, token_count=0):
+        """Tạo session mới, trả về key"""
+        now = time.time()
+        key = secrets.randbits(_KEY_BITS)
+        with self._lock:
+            self._entries[key] = {
+                'model': model,
+                'chat_id': chat_id,
+                'parent_id': parent_id,
+                'token_count': token_count,
+                'created': now,
+                'last_used': now,
+            }
+            self._evict_locked(now)
+        return key
+
+    def get(self, key, model=None):
+        """Lấy bản sao entry còn hạn (và đúng model nếu truyền vào), None nếu không có"""
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                del self._entries[key]
+                return None
+            if model is not None and entry['model'] != model:
+                return None
+            entry['last_used'] = now
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def update(self, key, **fields):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry.update(fields)
+            entry['last_used'] = time.time()
+            self._entries.move_to_end(key)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            self._evict_locked(time.time())
+            return len(self._entries)
+
+
+# Global session cache instance
+session_cache = SessionCache()
@@ -0,0 +1,138 @@
+import re
+import time
+import threading
+import logging
+from config import SESSION_KEEP_ALIVE_DEFAULT, SESSION_REAPER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ns|us|µs|ms|s|m|h)")
+_UNIT_SECONDS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_keep_alive(value, default=SESSION_KEEP_ALIVE_DEFAULT):
+    """Đổi keep_alive của Ollama ra giây.
+
+    Hỗ trợ số (giây) và chuỗi duration kiểu Go ("5m", "1h30m", "10s").
+    Trả về None nếu giữ vô hạn (giá trị âm), 0 nếu giải phóng ngay.
+    """
+    if value is None or value == "":
+        value = default
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        text = str(value).strip()
+        try:
+            seconds = float(text)
+        except ValueError:
+            sign = -1 if text.startswith("-") else 1
+            parts = _DURATION_RE.findall(text.lstrip("+-"))
+            if not parts:
+                logger.warning(f"Invalid keep_alive '{value}', using default {default}")
+                return 300.0 if value == default else parse_keep_alive(default)
+            seconds = sign * sum(float(num) * _UNIT_SECONDS[unit] for num, unit in parts)
+    if seconds < 0:
+        return None
+    return seconds
+
+
+class SessionTable:
+    """Bảng session upstream "ấm" theo (model, client), thời gian sống theo keep_alive.
+
+    Request Ollama lấy session rảnh của đúng model + client để dùng lại chat_id (bỏ qua
+    bước tạo chat; lượt mới không nối vào parent_id cũ), xong thì trả lại kèm parent_id
+    mới (chỉ để hiển thị) và hạn mới. Thread reaper dọn các session hết hạn; /api/ps đọc danh sách session sống.
+    """
+
+    def __init__(self, reaper_interval=SESSION_REAPER_INTERVAL):
+        self.reaper_interval = reaper_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _ensure_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap_loop, name="session-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reaper_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Session reaper error: {e}")
+
+    @staticmethod
+    def _expired(session, now):
+        return session['expires_at'] is not None and session['expires_at'] <= now
+
+    def reap(self):
+        """Xóa session hết hạn (trừ session đang được dùng), trả về số session đã xóa"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, s in self._sessions.items() if not s['in_use'] and self._expired(s, now)]
+            for key in expired:
+                del self._sessions[key]
+        if expired:
+            logger.info(f"Session reaper evicted {len(expired)} expired session(s)")
+        return len(expired)
+
+    def acquire(self, model, client):
+        """Lấy session rảnh còn hạn cho (model, client); đánh dấu đang dùng. None nếu không có"""
+        key = (model, client)
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session['in_use']:
+                return None
+            if self._expired(session, now):
+                del self._sessions[key]
+                return None
+            session['in_use'] = True
+            return dict(session)
+
+    def release(self, model, client, chat_id, parent_id, keep_alive):
+        """Trả session về bảng với parent_id và hạn mới (keep_alive giây, None = vô hạn, 0 = bỏ)"""
+        key = (model, client)
+        with self._lock:
+            current = self._sessions.get(key)
+            if keep_alive == 0 or not chat_id:
+                if current is not None and current['chat_id'] == chat_id:
+                    del self._sessions[key]
+                return
+            if current is not None and current['chat_id'] != chat_id and current['in_use']:
+                # Session khác đang được request khác giữ: không ghi đè
+                return
+            now = time.time()
+            self._sessions[key] = {
+                'model': model,
+                'client': client,
+                'chat_id': chat_id,
+                'parent_id': parent_id,
+                'in_use': False,
+                'created': current['created'] if current is not None and current['chat_id'] == chat_id else now,
+                'last_used': now,
+                'expires_at': None if keep_alive is None else now + keep_alive,
+            }
+            self._ensure_reaper()
+
+    def discard(self, model, client, chat_id=None):
+        """Bỏ session (vd: request lỗi) nếu đúng chat_id"""
+        key = (model, client)
+        with self._lock:
+            current = self._sessions.get(key)
+            if current is not None and (chat_id is None or current['chat_id'] == chat_id):
+                del self._sessions[key]
+
+    def live_sessions(self):
+        """Danh sách bản sao các session còn hạn"""
+        now = time.time()
+        with self._lock:
+            return [dict(s) for s in self._sessions.values() if s['in_use'] or not self._expired(s, now)]
+
+
+# Global session table instance
+session_table = SessionTable()
@@ -0,0 +1,59 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """Một lượt thực thi đang chạy cho một key"""
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Gộp các lời gọi đồng thời cùng key: chỉ lời gọi đầu tiên thực thi, các lời gọi
+    đến sau (khi lời gọi đầu chưa xong) chờ và dùng chung kết quả."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """Thực thi fn() một lần cho mỗi key đang bay.
+
+        Returns: (result, shared) - shared=True nếu kết quả lấy từ lời gọi của request khác.
+        Exception của fn() được raise lại cho mọi lời gọi đang chờ.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight call {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    def in_flight(self):
+        """Số key đang được thực thi"""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,59 @@
+"""Bộ đếm token dùng chung cho usage (OpenAI) và *_count (Ollama).
+
+Qwen web API không trả số token, nên ước lượng theo kiểu BPE: từ ngắn = 1 token,
+từ dài thêm 1 token mỗi 4 ký tự, số tách nhóm 3 chữ số, mỗi ký tự CJK và mỗi dấu
+câu là 1 token. Mọi endpoint dùng cùng hàm nên số liệu nhất quán giữa các API.
+"""
+
+import re
+
+# Overhead mỗi message (role + phân cách), giống cách OpenAI tính cho chat
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_TOKEN_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]"  # CJK: 1 ký tự = 1 token
+    r"|\d{1,3}"
+    r"|[^\W\d_]+"
+    r"|[^\w\s]"
+)
+
+
+def count_tokens(text):
+    """Ước lượng số token của một đoạn text"""
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    total = 0
+    for piece in _TOKEN_RE.findall(text):
+        length = len(piece)
+        total += 1 if length <= 6 else 1 + (length - 3) // 4
+    return total
+
+
+def _content_text(content):
+    """Lấy phần text từ content dạng chuỗi hoặc list part (OpenAI vision format)"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                parts.append(str(part.get("text") or ""))
+            elif isinstance(part, str):
+                parts.append(part)
+        return "\n".join(parts)
+    return "" if content is None else str(content)
+
+
+def count_message_tokens(messages):
+    """Ước lượng số token prompt của danh sách messages"""
+    if not isinstance(messages, list):
+        return count_tokens(_content_text(messages))
+    total = 0
+    for message in messages:
+        if isinstance(message, dict):
+            total += MESSAGE_OVERHEAD_TOKENS + count_tokens(_content_text(message.get("content")))
+        else:
+            total += count_tokens(_content_text(message))
+    return total
@@ -0,0 +1,286 @@
+"""Tracing nhẹ theo request: span quanh queue, trim context, build prompt, upload, tạo chat,
+request upstream và đọc stream.
+
+Trace hiện tại nằm trong contextvar (mỗi thread/request một giá trị; fan-out copy context sang
+thread worker). Request không được sample thì span() trả về span rỗng dùng chung, không cấp phát
+gì. Span xong được đẩy vào queue, thread exporter ghi JSONL (file xoay vòng) và tùy chọn POST
+OTLP-JSON tới collector cục bộ (vd. http://localhost:4318/v1/traces).
+
+Request id luôn được gán (kể cả khi không sample) và gắn vào mọi dòng log qua RequestIdFilter.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import functools
+import logging
+import threading
+import contextvars
+from logging.handlers import RotatingFileHandler
+from config import (TRACE_SAMPLE_RATE, TRACE_DIR, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS,
+                    TRACE_OTLP_ENDPOINT, TRACE_QUEUE_SIZE, VERSION)
+
+logger = logging.getLogger(__name__)
+
+_request_id = contextvars.ContextVar("qwen_request_id", default="-")
+_current_span = contextvars.ContextVar("qwen_current_span", default=None)
+
+_OTLP_STATUS_ERROR = 2
+_EXPORT_BATCH = 256
+_EXPORT_FLUSH_INTERVAL = 1.0
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error",
+                 "_tracer", "_token")
+
+    def __init__(self, tracer, trace_id, parent_id, name, attributes=None):
+        self._tracer = tracer
+        self._token = None
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes) if attributes else {}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self._tracer._export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and self.error is None:
+            self.set_error(exc)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Span của request không được sample: mọi thao tác đều bỏ qua"""
+    __slots__ = ()
+    trace_id = None
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span):
+    record = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1 if span.parent_id else 2,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+    }
+    if span.parent_id:
+        record["parentSpanId"] = span.parent_id
+    if span.error:
+        record["status"] = {"code": _OTLP_STATUS_ERROR, "message": span.error}
+    return record
+
+
+class Tracer:
+    """Tạo span theo trace trong contextvar và export bất đồng bộ"""
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, trace_dir=TRACE_DIR, otlp_endpoint=TRACE_OTLP_ENDPOINT):
+        self.sample_rate = sample_rate
+        self.trace_dir = trace_dir
+        self.otlp_endpoint = otlp_endpoint
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._exporter = None
+        self._exporter_lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    # --- request id ---
+
+    def begin_request(self, request_id=None):
+        """Gán request id cho context hiện tại (lấy từ X-Request-ID nếu hợp lệ)"""
+        if not request_id or len(request_id) > 64 or not request_id.isprintable():
+            request_id = uuid.uuid4().hex[:16]
+        _request_id.set(request_id)
+        return request_id
+
+    @staticmethod
+    def request_id():
+        return _request_id.get()
+
+    # --- span ---
+
+    def start_trace(self, name, attributes=None):
+        """Root span của request (theo sample_rate); kích hoạt làm span hiện tại"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            _current_span.set(None)
+            return NOOP_SPAN
+        span = Span(self, os.urandom(16).hex(), None, name, attributes)
+        span.set("request_id", _request_id.get())
+        _current_span.set(span)
+        return span
+
+    def span(self, name, attributes=None):
+        """Span con của span hiện tại, dùng với `with` (kích hoạt trong block)"""
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, parent.trace_id, parent.span_id, name, attributes)
+
+    def start_span(self, name, attributes=None):
+        """Span con không kích hoạt, tự gọi end() (dùng trong generator stream)"""
+        return self.span(name, attributes)
+
+    @staticmethod
+    def current():
+        """Span đang kích hoạt (NOOP_SPAN nếu không có) để gắn thêm attribute"""
+        return _current_span.get() or NOOP_SPAN
+
+    def traced(self, name):
+        """Decorator: bọc cả hàm trong một span"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # --- export ---
+
+    def _export(self, span):
+        self._ensure_exporter()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_exporter(self):
+        if self._exporter is not None:
+            return
+        with self._exporter_lock:
+            if self._exporter is None:
+                self._exporter = threading.Thread(target=self._export_loop, daemon=True, name="trace-exporter")
+                self._exporter.start()
+
+    def _open_file_handler(self):
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(self.trace_dir, "spans.jsonl"), maxBytes=TRACE_FILE_MAX_BYTES,
+                                          backupCount=TRACE_FILE_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            return handler
+        except OSError as e:
+            logger.error(f"Cannot open trace file in {self.trace_dir}: {e}")
+            return None
+
+    def _export_loop(self):
+        handler = self._open_file_handler()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + _EXPORT_FLUSH_INTERVAL
+            while len(batch) < _EXPORT_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if handler is not None:
+                for span in batch:
+                    handler.emit(logging.makeLogRecord({"msg": json.dumps(span.to_dict(), ensure_ascii=False)}))
+                handler.flush()
+            if self.otlp_endpoint:
+                self._post_otlp(batch)
+            self.exported += len(batch)
+
+    def _post_otlp(self, batch):
+        import requests
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": "qwen-to-api"}},
+                {"key": "service.version", "value": {"stringValue": VERSION}},
+            ]},
+            "scopeSpans": [{"scope": {"name": "qwentoapi"}, "spans": [_otlp_span(span) for span in batch]}],
+        }]}
+        try:
+            requests.post(self.otlp_endpoint, json=payload, timeout=5)
+        except Exception as e:
+            logger.warning(f"OTLP export to {self.otlp_endpoint} failed: {e}")
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+            "otlp_endpoint": self.otlp_endpoint or None,
+        }
+
+
+class RequestIdFilter(logging.Filter):
+    """Gắn record.request_id (request id của context hiện tại, "-" nếu ngoài request)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+# Global tracer instance
+tracer = Tracer()
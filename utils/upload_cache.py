@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import OrderedDict
+from config import UPLOAD_CACHE_SIZE, UPLOAD_CACHE_TTL
+
+
+class UploadCache:
+    """Cache URL của file đã upload theo hash nội dung: hashed -> { file_url, size, content_type }.
+
+    Số entry bị chặn bởi LRU (max_entries) và mỗi entry hết hạn sau ttl giây kể từ lúc upload
+    (URL bên ngoài không còn dùng được mãi); không phụ thuộc vào việc tạo chat mới hay session ấm.
+    """
+
+    def __init__(self, max_entries=UPLOAD_CACHE_SIZE, ttl=UPLOAD_CACHE_TTL):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, hashed):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(hashed)
+            if item is None:
+                return None
+            stored_at, entry = item
+            if now - stored_at > self.ttl:
+                del self._entries[hashed]
+                return None
+            self._entries.move_to_end(hashed)
+            return entry
+
+    def put(self, hashed, entry):
+        """Lưu entry, trả về số entry sau khi lưu"""
+        now = time.time()
+        with self._lock:
+            self._entries[hashed] = (now, entry)
+            self._entries.move_to_end(hashed)
+            # Entry cũ nhất nằm đầu OrderedDict
+            while self._entries:
+                stored_at, _entry = next(iter(self._entries.values()))
+                if now - stored_at <= self.ttl and len(self._entries) <= self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            size = len(self._entries)
+            self._entries.clear()
+        return size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# Global upload cache instance
+upload_cache = UploadCache()